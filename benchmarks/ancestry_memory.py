@@ -0,0 +1,84 @@
+# git-dendrify --- transform git histories (ancestry memory benchmark)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the memory taken by the flattened ancestry of a dendrified branch
+
+Run as 'python -m benchmarks.ancestry_memory' from the top of the source tree.
+
+Usage:
+  benchmarks.ancestry_memory [options]
+
+Options:
+  --n-commits=<n>         Number of commits [default: 100000]
+  --depth=<n>             Nesting depth of sections [default: 3]
+  --section-length=<n>    Normal commits per level of each section [default: 8]
+
+The Python heap allocated for each of these is measured with tracemalloc,
+and reported per commit:
+
+  pairs              the list of (type, oid) pairs from flattened_ancestry()
+  pairs+fields       those pairs, extended with the data needed to rewrite each
+                     commit (its CommitFields and message) as Python objects
+  flat               the FlatAncestry from flat_ancestry(), which holds the same
+                     as 'pairs+fields', in buffers
+  flat (structure)   the part of that FlatAncestry holding the same as 'pairs'
+"""
+
+import tempfile
+import tracemalloc
+import docopt
+
+import dendrify
+from benchmarks import synthetic
+
+
+def _allocated_bytes(fun):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fun()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+
+def main(_argv=None):
+    args = docopt.docopt(__doc__, argv=_argv)
+    n_commits = int(args['--n-commits'])
+    with tempfile.TemporaryDirectory(prefix='dendrify-bench-') as workdir:
+        synthetic.create_repo(workdir, n_commits, int(args['--depth']),
+                              int(args['--section-length']), 1, 'base', 'linear')
+        dendrifier = dendrify.Dendrifier(workdir)
+        dendrifier.dendrify('dendrified', 'base', 'linear')
+        _, n_pairs_bytes = _allocated_bytes(
+            lambda: dendrifier.flattened_ancestry('base', 'dendrified'))
+        flat, n_flat_bytes = _allocated_bytes(
+            lambda: dendrifier.flat_ancestry('base', 'dendrified'))
+        _, n_pairs_and_fields_bytes = _allocated_bytes(
+            lambda: [(tp, oid, flat.commits.fields(idx),
+                      flat.commits.raw_message(idx))
+                     for idx, (tp, oid) in enumerate(flat)])
+        n_structure_bytes = len(flat.raw_oids) + len(flat.type_codes)
+        for label, n_bytes in [('pairs', n_pairs_bytes),
+                               ('pairs+fields', n_pairs_and_fields_bytes),
+                               ('flat', n_flat_bytes),
+                               ('flat (structure)', n_structure_bytes)]:
+            print('{:>18}: {:8.1f} bytes/commit'.format(label, n_bytes / n_commits))
+
+
+if __name__ == '__main__':
+    main()
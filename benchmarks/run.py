@@ -0,0 +1,306 @@
+# git-dendrify --- transform git histories (benchmark runner)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark git-dendrify on synthetic histories
+
+Run as 'python -m benchmarks.run' from the top of the source tree.
+
+Usage:
+  benchmarks.run [options]
+  benchmarks.run --compare <old-results> <new-results>
+
+Options:
+  --sizes=<list>          Comma-separated numbers of commits [default: 1000,10000,100000]
+  --depth=<n>             Nesting depth of sections [default: 3]
+  --section-length=<n>    Normal commits per level of each section [default: 8]
+  --tree-size=<n>         Number of files in the tree [default: 100]
+  --operations=<list>     Comma-separated operations to time, from dendrify,
+                          linearize, round-trip, flatten, verify, section-index,
+                          startup-version, startup-no-op
+                          [default: dendrify,linearize,round-trip]
+  --output=<kind>         How to write new commits: odb, background (odb, from
+                          a separate thread), or pack [default: odb]
+  --results=<file>        Write results as JSON to this file [default: bench-results.json]
+  --commit-graph          Write a commit-graph file (untimed) before the
+                          timed work
+  --workdir=<dir>         Create repositories under this directory
+                          (default: a temporary directory)
+  --compare               Compare the wall times of two sets of results
+
+Each operation is timed in a fresh process, working on a fresh copy of the
+generated repository, so that it sees cold caches and its peak RSS is its own.
+Peak RSS covers the whole measuring process, including the untimed set-up
+(e.g., creating the dendrified branch which 'linearize' starts from).
+
+The 'flatten' operation times only the structural walks of a linearize: the
+flattened ancestry of the dendrified branch, without keeping commit data, and
+the linear ancestry of the source branch.  The 'section-index' operation
+times making the section index of the dendrified branch from scratch.
+
+The 'startup-version' and 'startup-no-op' operations time ten runs of the
+command-line tool, each in a new Python process: 'git-dendrify --version', and
+an incremental dendrify which finds nothing new to rewrite.  These catch
+regressions in start-up time, such as a module imported eagerly.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+import docopt
+import pygit2 as git
+
+from benchmarks import synthetic
+from dendrify._version import __version__
+
+
+base_branch = 'base'
+linear_branch = 'linear'
+dendrified_branch = 'bench-dendrified'
+linearized_branch = 'bench-linearized'
+
+# The command-line tool, as run by its installed script:
+cli_command = [sys.executable, '-c', 'import sys, dendrify.cli; sys.exit(dendrify.cli.main())']
+source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+n_startup_runs = 10
+
+
+def n_objects(repo_path):
+    """
+    Number of objects, loose plus packed, in the repository at ``repo_path``.
+    """
+    output = subprocess.run(['git', 'count-objects', '-v'], cwd=repo_path,
+                            check=True, stdout=subprocess.PIPE).stdout.decode()
+    counts = dict(line.split(': ') for line in output.splitlines())
+    return int(counts['count']) + int(counts['in-pack'])
+
+
+def _make_dendrifier(repo_path, output_kind):
+    import dendrify
+    output = {'odb': dendrify.ObjectDatabaseOutput,
+              'background': dendrify.BackgroundObjectDatabaseOutput,
+              'pack': dendrify.PackfileOutput}[output_kind]
+    return dendrify.Dendrifier(repo_path, output=output)
+
+
+def _do_dendrify(dendrifier):
+    dendrifier.dendrify(dendrified_branch, base_branch, linear_branch)
+
+
+def _do_linearize(dendrifier):
+    dendrifier.linearize(linearized_branch, base_branch, dendrified_branch)
+
+
+def _do_round_trip(dendrifier):
+    _do_dendrify(dendrifier)
+    _do_linearize(dendrifier)
+
+
+def _do_verify(dendrifier):
+    dendrifier.verify(base_branch, linear_branch, dendrified_branch)
+
+
+def _do_flatten(dendrifier):
+    dendrifier.flattened_ancestry(base_branch, dendrified_branch)
+    dendrifier.linear_ancestry(base_branch, linear_branch)
+
+
+def _do_section_index(dendrifier):
+    dendrifier.section_index(base_branch, dendrified_branch).close()
+
+
+def _do_dendrify_incremental(dendrifier):
+    dendrifier.dendrify(dendrified_branch, base_branch, linear_branch, incremental=True)
+
+
+def _run_cli(dendrifier, args):
+    python_path = [source_dir] + os.environ.get('PYTHONPATH', '').split(os.pathsep)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, python_path)))
+    for _ in range(n_startup_runs):
+        subprocess.run(cli_command + args, cwd=dendrifier.repo.path, env=env,
+                       check=True, stdout=subprocess.DEVNULL)
+
+
+def _do_startup_version(dendrifier):
+    _run_cli(dendrifier, ['--version'])
+
+
+def _do_startup_no_op(dendrifier):
+    _run_cli(dendrifier, ['dendrify', '--quiet', '--incremental',
+                          dendrified_branch, base_branch, linear_branch])
+
+
+# For each operation, the untimed set-up and the timed work:
+operations = {'dendrify': (None, _do_dendrify),
+              'linearize': (_do_dendrify, _do_linearize),
+              'round-trip': (None, _do_round_trip),
+              'flatten': (_do_dendrify, _do_flatten),
+              'verify': (_do_dendrify, _do_verify),
+              'section-index': (_do_dendrify, _do_section_index),
+              'startup-version': (None, _do_startup_version),
+              'startup-no-op': (_do_dendrify_incremental, _do_startup_no_op)}
+
+
+def _measure(repo_path, operation, output_kind, commit_graph, results_queue):
+    import resource
+    set_up, work = operations[operation]
+    dendrifier = _make_dendrifier(repo_path, output_kind)
+    if set_up is not None:
+        set_up(dendrifier)
+    if commit_graph:
+        subprocess.run(['git', 'commit-graph', 'write', '--reachable'],
+                       cwd=repo_path, check=True)
+    n_objects_before = n_objects(repo_path)
+    t0 = time.perf_counter()
+    work(dendrifier)
+    wall_time = time.perf_counter() - t0
+    n_objects_after = n_objects(repo_path)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss_kb //= 1024  # pragma nocover
+    results_queue.put({'wall_time_s': wall_time,
+                       'peak_rss_kb': peak_rss_kb,
+                       'objects_written': n_objects_after - n_objects_before})
+
+
+def measure(repo_path, operation, output_kind, commit_graph=False):
+    """
+    Time ``operation`` on the repository at ``repo_path`` in a fresh process,
+    and return a dict of its measurements.
+    """
+    context = multiprocessing.get_context('spawn')
+    results_queue = context.Queue()
+    process = context.Process(target=_measure,
+                              args=(repo_path, operation, output_kind, commit_graph,
+                                    results_queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('{} failed on {} (exit code {})'
+                           .format(operation, repo_path, process.exitcode))
+    return results_queue.get()
+
+
+def run(workdir, sizes, depth, section_length, tree_size, operation_names, output_kind,
+        commit_graph=False):
+    results = []
+    for n_commits in sizes:
+        template_path = os.path.join(workdir, 'template-{}'.format(n_commits))
+        t0 = time.perf_counter()
+        synthetic.create_repo(template_path, n_commits, depth, section_length, tree_size,
+                              base_branch, linear_branch)
+        generation_time = time.perf_counter() - t0
+        sys.stderr.write('generated {} commits in {:.2f}s\n'
+                         .format(n_commits, generation_time))
+
+        for operation in operation_names:
+            repo_path = os.path.join(workdir, '{}-{}'.format(operation, n_commits))
+            shutil.copytree(template_path, repo_path)
+            measurements = measure(repo_path, operation, output_kind, commit_graph)
+            shutil.rmtree(repo_path)
+            result = {'n_commits': n_commits,
+                      'depth': depth,
+                      'section_length': section_length,
+                      'tree_size': tree_size,
+                      'operation': operation,
+                      'output': output_kind,
+                      'commit_graph': commit_graph}
+            result.update(measurements)
+            results.append(result)
+            sys.stderr.write('{operation:>10} {n_commits:>8} commits:'
+                             ' {wall_time_s:8.3f}s {peak_rss_kb:>8}kB'
+                             ' {objects_written:>8} objects\n'.format(**result))
+
+        shutil.rmtree(template_path)
+    return results
+
+
+def environment():
+    return {'dendrify_version': __version__,
+            'pygit2_version': git.__version__,
+            'libgit2_version': git.LIBGIT2_VERSION,
+            'python_version': platform.python_version(),
+            'platform': platform.platform()}
+
+
+def _result_key(result):
+    return (tuple(result[k] for k in ['operation', 'output', 'n_commits', 'depth',
+                                      'section_length', 'tree_size'])
+            + (result.get('commit_graph', False),))
+
+
+def compare(old_results, new_results):
+    """
+    Yield a line of text for each measurement present in both ``old_results``
+    and ``new_results``, giving the ratio new/old of the wall times.
+    """
+    old_from_key = {_result_key(r): r for r in old_results['results']}
+    yield ('{:>10} {:>8} {:>10} {:>10} {:>7}'
+           .format('operation', 'commits', 'old (s)', 'new (s)', 'ratio'))
+    for new in new_results['results']:
+        old = old_from_key.get(_result_key(new))
+        if old is None:
+            continue
+        yield ('{:>10} {:>8} {:10.3f} {:10.3f} {:7.2f}'
+               .format(new['operation'], new['n_commits'],
+                       old['wall_time_s'], new['wall_time_s'],
+                       new['wall_time_s'] / old['wall_time_s']))
+
+
+def main(_argv=None):
+    args = docopt.docopt(__doc__, argv=_argv)
+
+    if args['--compare']:
+        with open(args['<old-results>'], 'rt') as f_in:
+            old_results = json.load(f_in)
+        with open(args['<new-results>'], 'rt') as f_in:
+            new_results = json.load(f_in)
+        for line in compare(old_results, new_results):
+            print(line)
+        return
+
+    sizes = [int(s) for s in args['--sizes'].split(',')]
+    operation_names = args['--operations'].split(',')
+    for name in operation_names:
+        if name not in operations:
+            raise docopt.DocoptExit('unknown operation "{}"'.format(name))
+    if args['--output'] not in ['odb', 'background', 'pack']:
+        raise docopt.DocoptExit('unknown output "{}"'.format(args['--output']))
+
+    workdir = args['--workdir']
+    made_workdir = (workdir is None)
+    if made_workdir:
+        workdir = tempfile.mkdtemp(prefix='dendrify-bench-')
+    try:
+        results = run(workdir, sizes,
+                      int(args['--depth']), int(args['--section-length']),
+                      int(args['--tree-size']), operation_names, args['--output'],
+                      args['--commit-graph'])
+    finally:
+        if made_workdir:
+            shutil.rmtree(workdir)
+
+    with open(args['--results'], 'wt') as f_out:
+        json.dump({'environment': environment(), 'results': results}, f_out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
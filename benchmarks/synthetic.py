@@ -0,0 +1,119 @@
+# git-dendrify --- transform git histories (synthetic histories for benchmarks)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generate large linear histories, marked up with ``<s>`` and ``</s>``, using
+``git fast-import``.
+
+As in the tests, a history is described by a string of descriptors: ``[``
+for a section-start commit, ``]`` for a section-end commit, and ``.`` for a
+normal commit.  Normal commits change one file of the tree; section-start
+and section-end commits are empty.
+"""
+
+import subprocess
+
+
+def section_descriptors(depth, section_length):
+    """
+    Descriptors for one top-level section nested ``depth`` deep, with
+    ``section_length`` normal commits at each level.
+    """
+    if depth == 0:
+        return ''
+    return ('[' + '.' * section_length
+            + section_descriptors(depth - 1, section_length)
+            + ']')
+
+
+def history_descriptors(n_commits, depth, section_length):
+    """
+    Descriptors for a history of exactly ``n_commits`` commits, made of
+    consecutive top-level sections as given by ``section_descriptors()``, padded
+    out with normal commits.
+    """
+    block = section_descriptors(depth, section_length) or '.'
+    n_blocks = n_commits // len(block)
+    return block * n_blocks + '.' * (n_commits - n_blocks * len(block))
+
+
+def _file_name(idx):
+    return 'file-{:06d}'.format(idx)
+
+
+def fast_import_stream(descriptors, tree_size, base_branch, linear_branch):
+    """
+    Generate, in chunks of bytes, a ``git fast-import`` stream creating a base
+    commit with ``tree_size`` files on ``base_branch``, and, on top of it, the
+    linear history described by ``descriptors`` on ``linear_branch``.
+    """
+    timestamp = 1500000000
+    ident = b'Bench Mark <bench@example.com>'
+
+    def commit(ref, mark, message, parent_mark, file_changes):
+        msg = message.encode()
+        lines = [b'commit refs/heads/' + ref.encode(),
+                 b'mark :%d' % mark,
+                 b'author %s %d +0000' % (ident, timestamp + mark),
+                 b'committer %s %d +0000' % (ident, timestamp + mark),
+                 b'data %d' % len(msg),
+                 msg]
+        if parent_mark is not None:
+            lines.append(b'from :%d' % parent_mark)
+        for path, content in file_changes:
+            data = content.encode()
+            lines.extend([b'M 100644 inline ' + path.encode(),
+                          b'data %d' % len(data),
+                          data])
+        return b'\n'.join(lines) + b'\n\n'
+
+    yield commit(base_branch, 1, 'Base commit for benchmark', None,
+                 [(_file_name(i), 'initial\n') for i in range(tree_size)])
+    yield b'reset refs/heads/' + linear_branch.encode() + b'\nfrom :1\n\n'
+
+    for idx, descr in enumerate(descriptors):
+        mark = idx + 2
+        if descr == '[':
+            message, changes = '<s>Start work {}'.format(idx), []
+        elif descr == ']':
+            message, changes = '</s>Finish work {}'.format(idx), []
+        else:
+            message = 'Work item {}'.format(idx)
+            changes = [(_file_name(idx % tree_size), '{}\n'.format(idx))]
+        yield commit(linear_branch, mark, message, mark - 1, changes)
+
+
+def create_repo(path, n_commits, depth, section_length, tree_size,
+                base_branch='base', linear_branch='linear'):
+    """
+    Create a bare repository at ``path`` holding a synthetic history of
+    ``n_commits`` commits on top of a base commit.  Return the descriptors of
+    the history.
+    """
+    subprocess.run(['git', 'init', '--quiet', '--bare', path], check=True)
+    descriptors = history_descriptors(n_commits, depth, section_length)
+    fast_import = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                   cwd=path, stdin=subprocess.PIPE)
+    try:
+        for chunk in fast_import_stream(descriptors, tree_size,
+                                        base_branch, linear_branch):
+            fast_import.stdin.write(chunk)
+    finally:
+        fast_import.stdin.close()
+        returncode = fast_import.wait()
+    if returncode != 0:
+        raise RuntimeError('git fast-import failed with code {}'.format(returncode))
+    return descriptors
@@ -0,0 +1,139 @@
+# git-dendrify --- transform git histories (compact ancestry)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from array import array
+from enum import Enum
+import pygit2 as git
+
+from dendrify.output import CommitFields, signature_bytes
+
+
+CommitType = Enum('CommitType', 'SectionStart SectionEnd Normal')
+
+
+class CommitStore:
+    """
+    The parts of a sequence of commits needed to rewrite them, kept from when
+    the commits were first read, so that they need not be read again.
+
+    Rather than a Python object per commit, everything is held in one buffer.
+    Each commit's entry holds its raw tree id and the lengths of its author,
+    committer, and message encoding, then those three, then its raw message.
+    An empty encoding stands for none.  ``offsets[i]`` is where entry ``i``
+    starts.
+    """
+    _header = struct.Struct('<20sIIB')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, commit):
+        author = signature_bytes(commit.author)
+        committer = signature_bytes(commit.committer)
+        encoding = (commit.message_encoding or '').encode()
+        self.data += self._header.pack(commit.tree_id.raw,
+                                       len(author), len(committer), len(encoding))
+        self.data += author
+        self.data += committer
+        self.data += encoding
+        self.data += commit.raw_message
+        self.offsets.append(len(self.data))
+
+    def _entry(self, idx):
+        """
+        The tree id, the extents of the author, committer and encoding, and
+        the start of the raw message, of entry ``idx``.
+        """
+        tree_raw, n_author, n_committer, n_encoding = self._header.unpack_from(
+            self.data, self.offsets[idx])
+        author_start = self.offsets[idx] + self._header.size
+        committer_start = author_start + n_author
+        encoding_start = committer_start + n_committer
+        message_start = encoding_start + n_encoding
+        return tree_raw, author_start, committer_start, encoding_start, message_start
+
+    def fields(self, idx):
+        (tree_raw, author_start, committer_start,
+         encoding_start, message_start) = self._entry(idx)
+        encoding = self.data[encoding_start:message_start].decode()
+        return CommitFields(git.Oid(raw=tree_raw),
+                            bytes(self.data[author_start:committer_start]),
+                            bytes(self.data[committer_start:encoding_start]),
+                            encoding or None)
+
+    def raw_message(self, idx):
+        message_start = self._entry(idx)[-1]
+        return bytes(self.data[message_start:self.offsets[idx + 1]])
+
+    @property
+    def n_bytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class FlatAncestry:
+    """
+    Flattened ancestry of a dendrified branch, as made by
+    ``Dendrifier.flat_ancestry()``.  Iterating gives the (CommitType, oid)
+    pairs.
+
+    The oids are held as one buffer of raw 20-byte oids, and the types as a
+    bytearray of CommitType values, with the commits themselves (if kept) in
+    a CommitStore.  The oids and types take 21 bytes per commit, against c.104
+    for a list of (CommitType, Oid) pairs.  On a synthetic history with short
+    messages, the whole FlatAncestry takes c.177 bytes per commit, against
+    c.448 for the pairs plus the same commit data held as Python objects.
+    See ``benchmarks/ancestry_memory.py``.
+    """
+    def __init__(self):
+        self.raw_oids = bytearray()
+        self.type_codes = bytearray()
+        self.commits = CommitStore()
+
+    def __len__(self):
+        return len(self.type_codes)
+
+    def append(self, commit_type, raw_oid):
+        """
+        Append the commit with the given raw oid.  Its data, if wanted, must
+        be added to ``commits`` separately.
+        """
+        self.raw_oids += raw_oid
+        self.type_codes.append(commit_type.value)
+
+    def raw_oid(self, idx):
+        return bytes(self.raw_oids[20 * idx : 20 * (idx + 1)])
+
+    def oid(self, idx):
+        return git.Oid(raw=self.raw_oid(idx))
+
+    def commit_type(self, idx):
+        return CommitType(self.type_codes[idx])
+
+    def set_commit_type(self, idx, commit_type):
+        self.type_codes[idx] = commit_type.value
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield (self.commit_type(idx), self.oid(idx))
+
+    @property
+    def n_bytes(self):
+        return len(self.raw_oids) + len(self.type_codes) + self.commits.n_bytes
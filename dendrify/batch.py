@@ -0,0 +1,110 @@
+# git-dendrify --- transform git histories (batches of jobs)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run many dendrify/linearize jobs, possibly on different repositories, across
+a pool of worker processes.
+
+A job file has one job per line, of the form
+
+    <repo-path> <operation> <new-branch> <base-commit> <source-branch>
+
+where ``<operation>`` is ``dendrify`` or ``linearize``.  Fields are split as by
+a POSIX shell, so may be quoted.  Blank lines and lines starting with ``#``
+are ignored.  A relative ``<repo-path>`` is taken relative to the directory
+containing the job file.
+"""
+
+import os
+import time
+import shlex
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dendrify
+from dendrify.core import dendrifier_for_path
+
+
+Job = namedtuple('Job', 'repo_path operation new_branch base source')
+
+# ``error`` is None for a job which succeeded.
+JobResult = namedtuple('JobResult', 'job error n_commits_written seconds')
+
+operations = ['dendrify', 'linearize']
+
+
+def jobs_from_file(path):
+    jobs = []
+    job_file_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'rt') as f_in:
+        for line_number, line in enumerate(f_in, start=1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) != len(Job._fields):
+                raise ValueError('{}:{}: expected {} fields but got {}'
+                                 .format(path, line_number, len(Job._fields), len(fields)))
+            job = Job(*fields)
+            if job.operation not in operations:
+                raise ValueError('{}:{}: unknown operation "{}"'
+                                 .format(path, line_number, job.operation))
+            jobs.append(job._replace(repo_path=os.path.join(job_file_dir, job.repo_path)))
+    return jobs
+
+
+def run_job(job, verification=dendrify.Verification.TreeId):
+    """
+    Run the given job, returning a JobResult.  Errors are captured in the
+    result rather than raised.
+    """
+    t0 = time.perf_counter()
+    try:
+        dendrifier = dendrifier_for_path(job.repo_path, verification=verification)
+        action = getattr(dendrifier, job.operation)
+        action(job.new_branch, job.base, job.source)
+        error = None
+        n_commits_written = dendrifier.stats.n_commits_written
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        n_commits_written = 0
+    return JobResult(job, error, n_commits_written, time.perf_counter() - t0)
+
+
+def run_jobs(jobs, n_processes=None, verification=dendrify.Verification.TreeId):
+    """
+    Run the given jobs on a pool of ``n_processes`` processes (by default, one
+    per CPU), yielding a JobResult for each as it finishes.
+    """
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        job_from_future = {executor.submit(run_job, job, verification): job
+                           for job in jobs}
+        for future in as_completed(job_from_future):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield JobResult(job_from_future[future],
+                                'worker failed: {}: {}'.format(type(e).__name__, e),
+                                0, 0.0)
+
+
+def result_summary(result):
+    job = result.job
+    description = '{} {}: {} {}'.format(job.repo_path, job.operation,
+                                        job.new_branch, job.source)
+    if result.error is None:
+        return ('ok      {} ({} commits, {:.2f}s)'
+                .format(description, result.n_commits_written, result.seconds))
+    return 'FAILED  {}: {}'.format(description, result.error)
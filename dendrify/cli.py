@@ -21,38 +21,280 @@ Usage:
   git-dendrify --version
   git-dendrify dendrify [options] <new-branch> <base-commit> <linear-commit>
   git-dendrify linearize [options] <new-branch> <base-commit> <dendrified-commit>
+  git-dendrify dendrify-all [options] --glob=<pattern> --dest-prefix=<prefix> <base-commit>
+  git-dendrify verify [options] <base-commit> <linear-commit> <dendrified-commit>
+  git-dendrify show [options] <base-commit> <branch>
+  git-dendrify sections [options] <base-commit> <branch> <commit>
+  git-dendrify batch [options] <job-file>
+  git-dendrify watch [options] <job-file>
+  git-dendrify (status | trigger) [options] <job-file>
 
 Options:
   -h --help    Show this help info
   --version    Display version info and exit
   -q --quiet   Do not print commits as they are made
+  --progress   Instead of printing commits as they are made, show a
+               progress line on standard error
+  --verify=<level>  How to check section merges when linearizing or verifying:
+                    none, tree-id, or full [default: tree-id]
+  --verify-workers=<n>  With --verify=full, compute the diffs in this many
+                    worker processes [default: 1]
+  --commits-only    Read only commits, never trees or blobs, so that a
+                    partial clone ('git clone --filter=...') suffices
+                    (the default in a partial clone)
+  --incremental     (dendrify only) Record how each commit is rewritten, and
+                    if <new-branch> exists, only rewrite commits added to
+                    the linear history since it was made
+  --bulk-write      Hold new commits in memory and write them as a
+                    single packfile once the whole history is rewritten
+  --background-write  Write new commits in a separate thread, while the
+                    next ones are made (ignored with --bulk-write)
+  --fast-import=<file>  Do not write new commits; instead write a
+                    'git fast-import' stream describing them to the given
+                    file ('-' for standard output)
+  --dry-run         Check the history and print the plan of the new
+                    commits, but write nothing
+  --update-refs=<patterns>  Move each ref matching any of these
+                    comma-separated patterns (e.g. 'refs/tags/*') from a
+                    source commit to its rewritten form, atomically with
+                    creating <new-branch>
+  --max-depth=<n>   (show only) Fold away the contents of sections nested
+                    deeper than this
+  --glob=<pattern>  (dendrify-all only) Dendrify each local branch whose
+                    name matches this pattern
+  --dest-prefix=<prefix>  (dendrify-all only) Name each new branch by this
+                    prefix followed by the part of its source branch's name
+                    from the pattern's first wildcard on
+  --processes=<n>   (batch only) Number of worker processes to run jobs on
+                    (default: one per CPU)
+  --socket=<path>   (watch, status, trigger) Unix-domain socket on which
+                    the watch daemon listens (default: <job-file>.sock)
+  --poll=<seconds>  (watch only) Poll for ref changes this often, instead
+                    of using inotify
+  --stats           Print timings and counters to standard error when done
+  --stats-json=<file>  Write timings and counters as JSON to the given file
+                    ('-' for standard output) when done
 """
 
 import os
-import pygit2 as git
+import re
+import sys
+import json
+import fnmatch
+import functools
 import dendrify
-import docopt
 from dendrify._version import __version__
 
-def dendrifier_for_path(dirname, _ceiling_dir_for_testing='', report_to_stdout=False):
-    repo = git.discover_repository(dirname, False, _ceiling_dir_for_testing)
-    if repo is None:
-        raise ValueError('could not find git repo starting from {}'.format(dirname))
-    kwargs = {'report': dendrify.ReportToStdout()} if report_to_stdout else {}
-    return dendrify.Dendrifier(repo, **kwargs)
+# Only light modules are imported above; 'dendrify' itself only imports
+# pygit2 when first used.  Docopt is imported once the arguments need
+# parsing.
+
+verification_from_name = {'none': dendrify.Verification.Off,
+                          'tree-id': dendrify.Verification.TreeId,
+                          'full': dendrify.Verification.FullDiff}
+
+def branch_names_for_glob(repo, pattern, dest_prefix):
+    """
+    Pairs (new branch name, source branch name), one for each local branch
+    of ``repo`` whose name matches the glob ``pattern``, in order of name.
+    Each new branch is named by ``dest_prefix`` followed by the part of its
+    source branch's name from the pattern's first wildcard on.
+    """
+    fixed_prefix_len = len(re.match(r'[^*?[]*', pattern).group(0))
+    source_names = sorted(name for name in repo.branches.local
+                          if fnmatch.fnmatchcase(name, pattern))
+    if not source_names:
+        raise ValueError('no branches match "{}"'.format(pattern))
+    return [(dest_prefix + name[fixed_prefix_len:], name) for name in source_names]
+
+def _reporter(args):
+    if args['--quiet']:
+        return dendrify.DoNotReport()
+    if args['--progress']:
+        return dendrify.ReportProgress()
+    if args['--fast-import'] == '-':
+        return dendrify.DoNotReport()
+    return dendrify.ReportToStdout()
 
 def main(_argv=None):
-    args = docopt.docopt(__doc__, argv=_argv, version='git-dendrify {}'.format(__version__))
-    dendrifier = dendrifier_for_path(os.getcwd(),
-                                     report_to_stdout=(not args['--quiet']))
+    argv = sys.argv[1:] if _argv is None else _argv
+    # Answer the trivial requests without importing anything more:
+    if argv == ['--version']:
+        print('git-dendrify {}'.format(__version__))
+        return
+    if argv in (['-h'], ['--help']):
+        print(__doc__.strip('\n'))
+        return
+    import docopt
+    args = docopt.docopt(__doc__, argv=argv, version='git-dendrify {}'.format(__version__))
+    verify_name = args['--verify']
+    if verify_name not in verification_from_name:
+        raise docopt.DocoptExit('unknown verification level "{}"'.format(verify_name))
+    if args['batch']:
+        return _run_batch(args, verification_from_name[verify_name])
+    if args['watch']:
+        return _run_watch(args, verification_from_name[verify_name])
+    if args['status'] or args['trigger']:
+        return _run_watch_client(args)
+    fast_import_path = args['--fast-import']
+    dendrifier = dendrify.dendrifier_for_path(
+        os.getcwd(),
+        report=_reporter(args),
+        verification=verification_from_name[verify_name],
+        n_verification_workers=int(args['--verify-workers']),
+        commits_only=args['--commits-only'] or None)
+    if args['show']:
+        return _run_show(dendrifier, args)
+    if args['sections']:
+        _run_sections(dendrifier, args)
+        _emit_stats(dendrifier.stats, args)
+        return
+    if args['verify']:
+        exit_status = _run_verify(dendrifier, args)
+        _emit_stats(dendrifier.stats, args)
+        return exit_status
+    if args['--background-write']:
+        dendrifier.output = dendrify.BackgroundObjectDatabaseOutput
+    if args['--bulk-write']:
+        dendrifier.output = dendrify.PackfileOutput
+    if fast_import_path is None:
+        _run_action(dendrifier, args)
+    elif fast_import_path == '-':
+        _run_action_to_fast_import(dendrifier, args, sys.stdout.buffer)
+    else:
+        with open(fast_import_path, 'wb') as stream:
+            _run_action_to_fast_import(dendrifier, args, stream)
+    _emit_stats(dendrifier.stats, args)
+
+def _emit_stats(stats, args):
+    if args['--stats']:
+        sys.stderr.write(stats.as_text())
+        sys.stderr.write('\n')
+    stats_json_path = args['--stats-json']
+    if stats_json_path == '-':
+        json.dump(stats.as_dict(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif stats_json_path is not None:
+        with open(stats_json_path, 'wt') as f_out:
+            json.dump(stats.as_dict(), f_out, indent=2)
+
+def _run_action_to_fast_import(dendrifier, args, stream):
+    dendrifier.output = functools.partial(dendrify.FastImportOutput, stream=stream)
+    _run_action(dendrifier, args)
+
+def _run_action(dendrifier, args):
+    ref_patterns = args['--update-refs']
+    update_refs = ref_patterns.split(',') if ref_patterns else ()
     if args['dendrify']:
-        dendrifier.dendrify(args['<new-branch>'],
-                            args['<base-commit>'],
-                            args['<linear-commit>'])
+        result = dendrifier.dendrify(args['<new-branch>'],
+                                     args['<base-commit>'],
+                                     args['<linear-commit>'],
+                                     incremental=args['--incremental'],
+                                     dry_run=args['--dry-run'],
+                                     update_refs=update_refs)
+    elif args['dendrify-all']:
+        result = dendrifier.dendrify_many(args['<base-commit>'],
+                                          branch_names_for_glob(dendrifier.repo,
+                                                                args['--glob'],
+                                                                args['--dest-prefix']),
+                                          dry_run=args['--dry-run'],
+                                          update_refs=update_refs)
     elif args['linearize']:
-        dendrifier.linearize(args['<new-branch>'],
-                             args['<base-commit>'],
-                             args['<dendrified-commit>'])
+        result = dendrifier.linearize(args['<new-branch>'],
+                                      args['<base-commit>'],
+                                      args['<dendrified-commit>'],
+                                      dry_run=args['--dry-run'],
+                                      update_refs=update_refs)
     else:
         raise RuntimeError('unknown action'
                            ' (docopt should have handled this situation)')  # pragma nocover
+    if args['--dry-run']:
+        for line in result.description_lines():
+            print(line)
+
+def _run_show(dendrifier, args):
+    max_depth = args['--max-depth']
+    if max_depth is not None:
+        max_depth = int(max_depth)
+    lines = dendrifier.outline(args['<base-commit>'], args['<branch>'], max_depth)
+    try:
+        for line in lines:
+            print(line)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader (e.g., 'head') has all it wants; discard the rest quietly.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def _run_sections(dendrifier, args):
+    oid = dendrifier.repo.revparse_single(args['<commit>']).id
+    with dendrifier.section_index(args['<base-commit>'], args['<branch>']) as index:
+        sections = index.sections_containing(oid)
+    if sections is None:
+        raise ValueError('"{}" is not in the history of "{}"'
+                         .format(args['<commit>'], args['<branch>']))
+    if not sections:
+        print('not within any section')
+    for section in sections:
+        print('section at depth {}: commits {} to {}, ended by {}'
+              .format(section.depth, section.start + 1, section.end + 1,
+                      str(section.merge_oid)[:12]))
+
+def _run_verify(dendrifier, args):
+    divergence = dendrifier.verify(args['<base-commit>'],
+                                   args['<linear-commit>'],
+                                   args['<dendrified-commit>'])
+    if divergence is None:
+        if not args['--quiet']:
+            print('histories match')
+        return 0
+    print('histories differ at commit {}: {}'.format(divergence.index + 1,
+                                                     divergence.reason))
+    for label, oid in [('linear', divergence.linear_oid),
+                       ('dendrified', divergence.dendrified_oid)]:
+        if oid is not None:
+            print('  {:>10}: {}'.format(label, oid))
+    return 1
+
+def _run_batch(args, verification):
+    import dendrify.batch
+    jobs = dendrify.batch.jobs_from_file(args['<job-file>'])
+    n_processes = args['--processes']
+    if n_processes is not None:
+        n_processes = int(n_processes)
+    n_failed = 0
+    for result in dendrify.batch.run_jobs(jobs, n_processes, verification):
+        if result.error is not None:
+            n_failed += 1
+        if not args['--quiet']:
+            print(dendrify.batch.result_summary(result), flush=True)
+    return 1 if n_failed else 0
+
+def _watch_socket_path(args):
+    import dendrify.watch
+    return args['--socket'] or dendrify.watch.default_socket_path(args['<job-file>'])
+
+def _run_watch(args, verification):
+    import dendrify.batch
+    import dendrify.watch
+    jobs = dendrify.batch.jobs_from_file(args['<job-file>'])
+    poll_interval = args['--poll']
+    if poll_interval is not None:
+        poll_interval = float(poll_interval)
+    daemon = dendrify.watch.WatchDaemon(jobs, _watch_socket_path(args), verification,
+                                        poll_interval)
+    daemon.serve_forever()
+    return 0
+
+def _run_watch_client(args):
+    import dendrify.watch
+    request = 'status' if args['status'] else 'trigger'
+    socket_path = _watch_socket_path(args)
+    try:
+        states = dendrify.watch.send_request(socket_path, request)
+    except OSError:
+        print('no watch daemon listening on {}'.format(socket_path))
+        return 2
+    if not args['--quiet']:
+        for state in states:
+            print(dendrify.watch.state_summary(state))
+    return 1 if any(state.get('error') for state in states) else 0
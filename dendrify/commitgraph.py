@@ -0,0 +1,211 @@
+# git-dendrify --- transform git histories (commit-graph reader)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Read git's commit-graph files, which hold the parents, root tree and
+generation number of each commit they cover, without parsing commit objects.
+
+Either a single file ``objects/info/commit-graph`` or a split chain of files
+listed in ``objects/info/commit-graphs/commit-graph-chain`` is read, as git
+itself does.  See git's 'gitformat-commit-graph' documentation for the format.
+"""
+
+import os
+import mmap
+import struct
+
+
+class _Layer:
+    """
+    One commit-graph file, memory-mapped.  Commits are numbered by their
+    'position' across the whole chain: the commits of this layer have
+    positions from ``n_commits_before`` upwards.
+    """
+    _no_parent = 0x70000000
+    _extra_edges = 0x80000000
+    _cdat_entry = struct.Struct('>20sIIII')
+
+    def __init__(self, path, n_commits_before):
+        with open(path, 'rb') as f_in:
+            self.mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, hash_version, n_chunks, n_bases = struct.unpack_from(
+            '>4sBBBB', self.mm, 0)
+        if signature != b'CGPH' or version != 1 or hash_version != 1:
+            self.mm.close()
+            raise ValueError('unsupported commit-graph file {}'.format(path))
+        chunk_offsets = {}
+        for idx in range(n_chunks):
+            chunk_id, offset = struct.unpack_from('>4sQ', self.mm, 8 + 12 * idx)
+            chunk_offsets[chunk_id] = offset
+        self.fanout_offset = chunk_offsets[b'OIDF']
+        self.oids_offset = chunk_offsets[b'OIDL']
+        self.data_offset = chunk_offsets[b'CDAT']
+        self.edges_offset = chunk_offsets.get(b'EDGE')
+        self.n_commits = struct.unpack_from('>I', self.mm, self.fanout_offset + 4 * 255)[0]
+        self.n_commits_before = n_commits_before
+        self.n_bases = n_bases
+
+    def close(self):
+        self.mm.close()
+
+    def local_index(self, raw_oid):
+        """
+        Index within this layer of the commit with the given raw oid, or None
+        if the layer does not have it.
+        """
+        first_byte = raw_oid[0]
+        lo = (struct.unpack_from('>I', self.mm, self.fanout_offset + 4 * (first_byte - 1))[0]
+              if first_byte > 0 else 0)
+        hi = struct.unpack_from('>I', self.mm, self.fanout_offset + 4 * first_byte)[0]
+        mm = self.mm
+        oids_offset = self.oids_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = oids_offset + 20 * mid
+            mid_oid = mm[start : start + 20]
+            if mid_oid < raw_oid:
+                lo = mid + 1
+            elif mid_oid > raw_oid:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def raw_oid(self, local_idx):
+        start = self.oids_offset + 20 * local_idx
+        return self.mm[start : start + 20]
+
+    def entry(self, local_idx):
+        """
+        The raw tree oid, the positions of the parents, and the generation
+        number (topological level), of the commit at ``local_idx``.
+        """
+        tree_raw, parent_1, parent_2, gen_hi, _ = self._cdat_entry.unpack_from(
+            self.mm, self.data_offset + self._cdat_entry.size * local_idx)
+        parents = []
+        if parent_1 != self._no_parent:
+            parents.append(parent_1)
+        if parent_2 & self._extra_edges:
+            edge_idx = parent_2 & ~self._extra_edges
+            while True:
+                edge = struct.unpack_from('>I', self.mm, self.edges_offset + 4 * edge_idx)[0]
+                parents.append(edge & ~self._extra_edges)
+                if edge & self._extra_edges:
+                    break
+                edge_idx += 1
+        elif parent_2 != self._no_parent:
+            parents.append(parent_2)
+        return tree_raw, parents, gen_hi >> 2
+
+
+class CommitGraph:
+    """
+    The commit-graph of a repository, as one or more memory-mapped layers.
+    Use ``CommitGraph.open()``, which gives None if there is no usable graph.
+    """
+    def __init__(self, layers):
+        self.layers = layers
+
+    @staticmethod
+    def _paths(repo_path):
+        info_dir = os.path.join(repo_path, 'objects', 'info')
+        single_path = os.path.join(info_dir, 'commit-graph')
+        if os.path.exists(single_path):
+            return [single_path]
+        graphs_dir = os.path.join(info_dir, 'commit-graphs')
+        chain_path = os.path.join(graphs_dir, 'commit-graph-chain')
+        if not os.path.exists(chain_path):
+            return []
+        with open(chain_path, 'rt') as f_in:
+            hashes = [line.strip() for line in f_in if line.strip()]
+        return [os.path.join(graphs_dir, 'graph-{}.graph'.format(h)) for h in hashes]
+
+    @classmethod
+    def open(cls, repo_path):
+        """
+        The commit-graph of the repository whose .git directory is at
+        ``repo_path``, or None if it has none (or it cannot be read).
+        """
+        layers = []
+        n_commits_before = 0
+        try:
+            for path in cls._paths(repo_path):
+                layer = _Layer(path, n_commits_before)
+                layers.append(layer)
+                if layer.n_bases != len(layers) - 1:
+                    raise ValueError('inconsistent commit-graph chain')
+                n_commits_before += layer.n_commits
+        except (OSError, ValueError, KeyError, struct.error):
+            for layer in layers:
+                layer.close()
+            return None
+        if not layers:
+            return None
+        return cls(layers)
+
+    def close(self):
+        for layer in self.layers:
+            layer.close()
+        self.layers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return sum(layer.n_commits for layer in self.layers)
+
+    def position(self, raw_oid):
+        """
+        Position of the commit with the given raw oid, or None if the graph
+        does not cover it.
+        """
+        for layer in reversed(self.layers):
+            local_idx = layer.local_index(raw_oid)
+            if local_idx is not None:
+                return layer.n_commits_before + local_idx
+        return None
+
+    def _layer_and_index(self, position):
+        for layer in reversed(self.layers):
+            if position >= layer.n_commits_before:
+                return layer, position - layer.n_commits_before
+        raise IndexError('commit-graph position {} out of range'.format(position))
+
+    def raw_oid(self, position):
+        layer, local_idx = self._layer_and_index(position)
+        return layer.raw_oid(local_idx)
+
+    def entry(self, position):
+        """
+        The triple (raw tree oid, parent positions, generation number) of the
+        commit at ``position``.
+        """
+        layer, local_idx = self._layer_and_index(position)
+        return layer.entry(local_idx)
+
+    def commit_entry(self, raw_oid):
+        """
+        The triple (raw parent oids, raw tree oid, generation number) of the
+        commit with the given raw oid, or None if the graph does not cover it.
+        """
+        position = self.position(raw_oid)
+        if position is None:
+            return None
+        tree_raw, parents, generation = self.entry(position)
+        return [self.raw_oid(p) for p in parents], tree_raw, generation
@@ -0,0 +1,283 @@
+# git-dendrify --- transform git histories (persistent commit maps)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from collections.abc import Mapping
+import pygit2 as git
+
+
+class CommitMap:
+    """
+    Record, for the commits of a linear history which have been dendrified
+    into a particular branch, the oid each one was rewritten to and whether
+    it started or ended a section.  Enough information is kept to resume
+    dendrifying after any recorded commit.
+
+    The map is stored in a file under the repository's git directory.  The
+    first line gives the base commit; each subsequent line is a fixed-width
+    record ``<source-oid> <dest-oid> <kind> <open>``, where the kind is one
+    of ``s`` (section start), ``e`` (section end) or ``n`` (normal), so that
+    the map can be cut back to any length without re-writing it.  The
+    ``<open>`` field is one plus the index of the record which started the
+    innermost section still open after this one, or zero.  Following these
+    links gives the sections open after any record, so a map can be resumed
+    from its last record without reading the others.
+
+    ``load_tail()`` reads only the last record, and ``load()`` reads them
+    all.  Records not held in memory are read from the file when needed.
+    """
+    SectionStart = 's'
+    SectionEnd = 'e'
+    Normal = 'n'
+
+    _header_len = len('base \n') + 40
+    _open_width = 10
+    _record_len = len('   \n') + 40 + 40 + 1 + _open_width
+
+    def __init__(self, path, base_oid):
+        self.path = path
+        self.base_oid = base_oid
+        # Records on disk before those held in memory:
+        self.n_records_skipped = 0
+        self.source_oids = []
+        self.dest_oids = []
+        self.kinds = []
+        self.opens = []
+        self.idx_from_source_oid = {}
+        self.n_records_on_disk = 0
+
+    @staticmethod
+    def path_for(repo, branch_name):
+        return os.path.join(repo.path, 'dendrify', 'maps', branch_name)
+
+    @classmethod
+    def _parse_record(cls, line):
+        source_hex, dest_hex, kind, open_text = line.split()
+        return git.Oid(hex=source_hex), git.Oid(hex=dest_hex), kind, int(open_text) - 1
+
+    @classmethod
+    def _open_file(cls, path):
+        """
+        The file at ``path``, open for reading, with its base oid and number
+        of records; or None if there is no file.
+        """
+        try:
+            f_in = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            base_oid = git.Oid(hex=f_in.read(cls._header_len).split()[1].decode())
+            n_records, remainder = divmod(os.fstat(f_in.fileno()).st_size - cls._header_len,
+                                          cls._record_len)
+            if remainder != 0:
+                raise ValueError('commit map {} is corrupt'.format(path))
+        except BaseException:
+            f_in.close()
+            raise
+        return f_in, base_oid, n_records
+
+    @classmethod
+    def _read_records(cls, f_in, start, stop):
+        f_in.seek(cls._header_len + start * cls._record_len)
+        text = f_in.read((stop - start) * cls._record_len).decode()
+        return [cls._parse_record(line) for line in text.splitlines()]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the CommitMap stored at ``path``, with all its records in
+        memory, or ``None`` if there is none.
+        """
+        return cls._load(path, tail_only=False)
+
+    @classmethod
+    def load_tail(cls, path):
+        """
+        Return the CommitMap stored at ``path``, with only its last record in
+        memory, or ``None`` if there is none.  This is enough to resume
+        dendrifying after that record.
+        """
+        return cls._load(path, tail_only=True)
+
+    @classmethod
+    def _load(cls, path, tail_only):
+        opened = cls._open_file(path)
+        if opened is None:
+            return None
+        f_in, base_oid, n_records = opened
+        with f_in:
+            commit_map = cls(path, base_oid)
+            start = max(0, n_records - 1) if tail_only else 0
+            commit_map.n_records_skipped = start
+            for record in cls._read_records(f_in, start, n_records):
+                commit_map._append_record(*record)
+        commit_map.n_records_on_disk = n_records
+        return commit_map
+
+    def __len__(self):
+        return self.n_records_skipped + len(self.source_oids)
+
+    def __contains__(self, source_oid):
+        return source_oid in self.idx_from_source_oid
+
+    def index(self, source_oid):
+        return self.idx_from_source_oid[source_oid]
+
+    @property
+    def tip(self):
+        return self.dest_oids[-1] if self.dest_oids else self.base_oid
+
+    def _record(self, idx):
+        if idx >= self.n_records_skipped:
+            idx -= self.n_records_skipped
+            return (self.source_oids[idx], self.dest_oids[idx],
+                    self.kinds[idx], self.opens[idx])
+        with open(self.path, 'rb') as f_in:
+            return self._read_records(f_in, idx, idx + 1)[0]
+
+    def _open_after(self, idx):
+        return -1 if idx == -1 else self._record(idx)[3]
+
+    def _tip_after(self, idx):
+        return self.base_oid if idx == -1 else self._record(idx)[1]
+
+    def _append_record(self, source_oid, dest_oid, kind, open_idx):
+        self.idx_from_source_oid[source_oid] = len(self)
+        self.source_oids.append(source_oid)
+        self.dest_oids.append(dest_oid)
+        self.kinds.append(kind)
+        self.opens.append(open_idx)
+
+    def append(self, source_oid, dest_oid, kind):
+        idx = len(self)
+        open_idx = self._open_after(idx - 1)
+        if kind == self.SectionStart:
+            open_idx = idx
+        elif kind == self.SectionEnd:
+            open_idx = self._open_after(open_idx - 1)
+        self._append_record(source_oid, dest_oid, kind, open_idx)
+
+    def truncate(self, n_records):
+        """
+        Forget all but the first ``n_records`` records, which must include all
+        those not held in memory.
+        """
+        n_kept_in_memory = n_records - self.n_records_skipped
+        if n_kept_in_memory < 0:
+            raise ValueError('cannot truncate commit map to records not in memory')
+        for source_oid in self.source_oids[n_kept_in_memory:]:
+            del self.idx_from_source_oid[source_oid]
+        del self.source_oids[n_kept_in_memory:]
+        del self.dest_oids[n_kept_in_memory:]
+        del self.kinds[n_kept_in_memory:]
+        del self.opens[n_kept_in_memory:]
+        self.n_records_on_disk = min(self.n_records_on_disk, n_records)
+
+    def state_after(self, n_records):
+        """
+        Return the pair (tip, section_start_ids) which dendrifying had reached
+        once the first ``n_records`` recorded commits had been rewritten.  This
+        reads one record per open section.
+        """
+        section_start_ids = []
+        open_idx = self._open_after(n_records - 1)
+        while open_idx != -1:
+            section_start_ids.append(self._tip_after(open_idx - 1))
+            open_idx = self._open_after(open_idx - 1)
+        section_start_ids.reverse()
+        return self._tip_after(n_records - 1), section_start_ids
+
+    def oid_map(self):
+        """
+        OidMap from the source oid of each recorded commit to its dest oid.
+        """
+        return OidMap(self.path, self.n_records_skipped,
+                      dict(zip(self.source_oids, self.dest_oids)))
+
+    def write(self):
+        """
+        Bring the file at ``self.path`` up to date, by cutting it back to the
+        records which are still valid and appending the new ones.  Only the
+        last record is then held in memory.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        mode = 'r+b' if self.n_records_on_disk else 'wb'
+        with open(self.path, mode) as f_out:
+            if self.n_records_on_disk:
+                f_out.truncate(self._header_len + self.n_records_on_disk * self._record_len)
+                f_out.seek(0, os.SEEK_END)
+            else:
+                f_out.write('base {}\n'.format(self.base_oid).encode())
+            n_written = self.n_records_on_disk - self.n_records_skipped
+            new_records = zip(self.source_oids[n_written:],
+                              self.dest_oids[n_written:],
+                              self.kinds[n_written:],
+                              self.opens[n_written:])
+            f_out.write(''.join('{} {} {} {:0{}d}\n'.format(source_oid, dest_oid, kind,
+                                                            open_idx + 1, self._open_width)
+                                for source_oid, dest_oid, kind, open_idx in new_records)
+                        .encode())
+        self.n_records_on_disk = len(self)
+        self._forget_all_but_last()
+
+    def _forget_all_but_last(self):
+        n_forgotten = max(0, len(self.source_oids) - 1)
+        for source_oid in self.source_oids[:n_forgotten]:
+            del self.idx_from_source_oid[source_oid]
+        for column in [self.source_oids, self.dest_oids, self.kinds, self.opens]:
+            del column[:n_forgotten]
+        self.n_records_skipped += n_forgotten
+
+
+class OidMap(Mapping):
+    """
+    Mapping from the source oid of each commit recorded in a CommitMap to its
+    dest oid.  The records which were in memory are copied at once; the
+    others are only read from the file, in full, if something is looked up
+    which is not among the former.
+    """
+    def __init__(self, path, n_records_on_disk_only, recent):
+        self.path = path
+        self.n_records_on_disk_only = n_records_on_disk_only
+        self.recent = recent
+        self.all = None
+
+    def _all(self):
+        if self.all is None:
+            self.all = {}
+            if self.n_records_on_disk_only:
+                f_in, _, _ = CommitMap._open_file(self.path)
+                with f_in:
+                    records = CommitMap._read_records(f_in, 0, self.n_records_on_disk_only)
+                self.all.update((source_oid, dest_oid)
+                                for source_oid, dest_oid, _, _ in records)
+            self.all.update(self.recent)
+        return self.all
+
+    def __getitem__(self, source_oid):
+        try:
+            return self.recent[source_oid]
+        except KeyError:
+            return self._all()[source_oid]
+
+    def __contains__(self, source_oid):
+        return source_oid in self.recent or source_oid in self._all()
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self):
+        return self.n_records_on_disk_only + len(self.recent)
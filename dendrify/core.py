@@ -0,0 +1,1427 @@
+# git-dendrify --- transform git histories (core)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import fnmatch
+import threading
+from array import array
+from collections import namedtuple
+import pygit2 as git
+from contextlib import contextmanager
+
+from dendrify import Verification
+from dendrify.output import (ObjectDatabaseOutput, BackgroundObjectDatabaseOutput,
+                             PackfileOutput, FastImportOutput, retargeted_tag_bytes)
+from dendrify.commitmap import CommitMap
+from dendrify.ancestry import CommitType, CommitStore, FlatAncestry
+from dendrify.commitgraph import CommitGraph
+from dendrify.sectionindex import Section, SectionTable, CommitPositions, SectionIndex
+from dendrify.plan import Plan
+from dendrify.stats import Stats
+from dendrify.report import (Reporter, DoNotReport, ReportToStdout, ReportProgress,
+                             ReportViaLoop, ReportToQueue, commit_summary)
+
+
+# The first place where a linear history and a dendrified history differ, as
+# found by ``Dendrifier.verify()``.  The ``index`` counts commits after the
+# base.  Either oid is None if that history has ended.
+Divergence = namedtuple('Divergence', 'index linear_oid dendrified_oid reason')
+
+
+class _Cancelled(Exception):
+    """
+    Raised within an operation run by ``Dendrifier.dendrify_async()`` or
+    ``linearize_async()`` once its task has been cancelled.
+    """
+
+
+def open_repository(path, ceiling_dirs=''):
+    """
+    Open the repository containing ``path``, searching upwards from it, but
+    not into any of ``ceiling_dirs`` (a list separated by ``os.pathsep``).
+    """
+    repo_path = git.discover_repository(path, False, ceiling_dirs)
+    if repo_path is None:
+        raise ValueError('could not find git repo starting from {}'.format(path))
+    return git.Repository(repo_path)
+
+
+def dendrifier_for_path(path, ceiling_dirs='', report_to_stdout=False, **kwargs):
+    """
+    A Dendrifier, constructed with ``kwargs``, for the repository containing
+    ``path``, found as for ``open_repository()``.  If ``report_to_stdout`` is
+    true, it reports its progress to stdout.
+    """
+    repo = open_repository(path, ceiling_dirs)
+    if report_to_stdout:
+        kwargs['report'] = ReportToStdout()
+    return Dendrifier(repo, **kwargs)
+
+
+def repo_has_branch(repo, branch_name):
+    m_existing_branch = repo.lookup_branch(branch_name)
+    return (m_existing_branch is not None)
+
+
+def is_partial_clone(repo):
+    """
+    Whether ``repo`` is a partial clone, which may lack trees or blobs that
+    a 'promisor' remote could supply.  (libgit2 cannot fetch them, so
+    reading a missing object fails.)
+    """
+    for entry in repo.config:
+        name = entry.name.lower()
+        if name == 'extensions.partialclone':
+            return True
+        if (name.startswith('remote.') and name.endswith('.promisor')
+                and repo.config.get_bool(entry.name)):
+            return True
+    return False
+
+
+def create_signature(repo):
+    return git.Signature(repo.config['user.name'],
+                         repo.config['user.email'],
+                         time=int(time.time()))
+
+
+def create_base(repo, branch_name):
+    """
+    Create a branch in the repo with the given name, referring to a
+    parentless commit with an empty tree.  Return the resulting Branch
+    object.
+    """
+    if repo_has_branch(repo, branch_name):
+        raise ValueError('branch "{}" already exists'.format(branch_name))
+
+    tb = repo.TreeBuilder()
+    empty_tree_oid = tb.write()
+
+    sig = create_signature(repo)
+    base_commit_oid = repo.create_commit(None,
+                                         sig, sig,
+                                         "Base commit for dendrify",
+                                         empty_tree_oid,
+                                         [])
+
+    base_commit = repo[base_commit_oid]
+    base_branch = repo.create_branch(branch_name, base_commit)
+
+    return base_branch
+
+
+# Per-process state for verifying merges in a pool of worker processes:
+_verification_repo = None
+
+
+def _open_repo_for_verification(repository_path):
+    global _verification_repo
+    _verification_repo = git.Repository(repository_path)
+
+
+def _is_pure_merge(raw_oid_pair):
+    merge = _verification_repo[git.Oid(raw=raw_oid_pair[0])]
+    merged = _verification_repo[git.Oid(raw=raw_oid_pair[1])]
+    return len(_verification_repo.diff(merge, merged)) == 0
+
+
+class Dendrifier:
+    def __init__(self, repository_path, report=DoNotReport(),
+                 verification=Verification.TreeId, output=ObjectDatabaseOutput,
+                 n_verification_workers=1, use_commit_graph=True, commits_only=None):
+        # The repository may already be open, as when the CLI has found it.
+        self.repo = (repository_path if isinstance(repository_path, git.Repository)
+                     else open_repository(repository_path))
+        self.report = report
+        self.verification = verification
+        self.output = output
+        self.n_verification_workers = n_verification_workers
+        self.use_commit_graph = use_commit_graph
+        # If true, read only commits (and their tree ids), never trees or
+        # blobs.  By default, do so in a partial clone.
+        self.commits_only = (is_partial_clone(self.repo) if commits_only is None
+                             else commits_only)
+        self.stats = Stats()
+        # If a dict, the CommitMap of each incremental dendrify is kept in it,
+        # by path, once written, and used by the next incremental dendrify to
+        # the same branch instead of reading the map's file, so long as the
+        # branch has not moved.
+        self.commit_maps = None
+        # Set, while an async operation is running, to the threading.Event
+        # which asks it to stop.
+        self._cancel_event = None
+
+    @property
+    def n_merges_verified(self):
+        return self.stats.merges_verified
+
+    def _check_not_cancelled(self):
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise _Cancelled()
+
+    @contextmanager
+    def _reported_phase(self, name):
+        self._check_not_cancelled()
+        t0 = time.perf_counter()
+        yield
+        self.report.phase_finished(name, time.perf_counter() - t0)
+
+    @staticmethod
+    def plain_message_from_tagged(msg):
+        if msg.startswith('<s>'):
+            return msg[3:]
+        if msg.startswith('</s>'):
+            return msg[4:]
+        return msg
+
+    @staticmethod
+    def raw_plain_message_from_tagged(raw_msg):
+        """
+        As for ``plain_message_from_tagged()``, but working on the raw (bytes)
+        form of a message, as given by a Commit's ``raw_message``.
+        """
+        if raw_msg.startswith(b'<s>'):
+            return raw_msg[3:]
+        if raw_msg.startswith(b'</s>'):
+            return raw_msg[4:]
+        return raw_msg
+
+    def linear_ancestry(self, base_revision, branch_name):
+        """
+        Return a list of commits leading from the one referred to by ``base_revision``
+        (but excluding it) up to and including the commit at the tip of ``branch_name``.
+        There must be a linear ancestry chain starting at ``branch_name`` leading back
+        to ``base_revision``.
+        """
+        oids, _ = self._linear_ancestry(base_revision, branch_name)
+        return oids
+
+    def _ancestry_walker(self, tip_oid, base_oid, sort):
+        walker = self.repo.walk(tip_oid, sort)
+        walker.hide(base_oid)
+        return walker
+
+    def _linear_ancestry(self, base_revision, branch_name, stop_oids=()):
+        """
+        As for ``linear_ancestry()``, but also stop on reaching any commit in
+        ``stop_oids``.  Return the pair (oids, stop_oid), where ``stop_oid`` is
+        the excluded commit at which the ancestry chain was cut.
+        """
+        tip_oid = self.repo.lookup_branch(branch_name).target
+        base_oid = self.repo.revparse_single(base_revision).oid
+
+        graph = self._open_commit_graph()
+        if graph is not None:
+            with graph:
+                result = self._linear_ancestry_from_graph(graph, tip_oid, base_oid,
+                                                          stop_oids)
+            if result is not None:
+                return result
+
+        if stop_oids:
+            # We might stop early, so walk back from the tip one commit at a
+            # time.  (A revwalk with the base hidden would look at the whole
+            # history before giving us the first commit.)
+            oids = []
+            oid = tip_oid
+            while oid != base_oid and oid not in stop_oids:
+                parent_ids = self.repo[oid].parent_ids
+                if len(parent_ids) > 1:
+                    raise ValueError('ancestry of "{}" is not linear'
+                                     .format(branch_name))
+                if not parent_ids:
+                    raise ValueError('"{}" is not an ancestor of "{}"'
+                                     .format(base_revision, branch_name))
+                oids.append(oid)
+                oid = parent_ids[0]
+            oids.reverse()
+            return oids, oid
+
+        walker = self._ancestry_walker(tip_oid, base_oid,
+                                       git.GIT_SORT_TOPOLOGICAL | git.GIT_SORT_REVERSE)
+        walker.simplify_first_parent()
+
+        oids = []
+        stop_oid = base_oid
+        oldest_commit = None
+        for commit in walker:
+            if len(commit.parent_ids) > 1:
+                raise ValueError('ancestry of "{}" is not linear'
+                                 .format(branch_name))
+            oids.append(commit.id)
+            if oldest_commit is None:
+                oldest_commit = commit
+
+        reached_base = (oldest_commit.parent_ids == [base_oid]
+                        if oldest_commit is not None
+                        else tip_oid == base_oid)
+        if not reached_base:
+            raise ValueError('"{}" is not an ancestor of "{}"'
+                             .format(base_revision, branch_name))
+
+        return oids, stop_oid
+
+    def _verify_branch_existence(self, tag, branch_name, must_exist):
+        exists = repo_has_branch(self.repo, branch_name)
+        if exists != must_exist:
+            raise ValueError('{} branch "{}" {}'
+                             .format(tag,
+                                     branch_name,
+                                     'exists' if exists else 'does not exist'))
+
+    def _commit_map_for_update(self, dendrified_branch_name, base_oid):
+        """
+        Return the CommitMap describing how ``dendrified_branch_name`` was made,
+        checking that it can be brought up to date incrementally.  If there is
+        no such branch yet, return a fresh, empty, CommitMap.  Only the map's
+        last record is read, and not even that if ``self.commit_maps`` holds
+        the map as it was when the branch was last moved to its current tip.
+        The map is taken out of ``self.commit_maps``, so is not re-used if the
+        update fails.
+        """
+        path = CommitMap.path_for(self.repo, dendrified_branch_name)
+        kept_map = (self.commit_maps.pop(path, None) if self.commit_maps is not None
+                    else None)
+        if not repo_has_branch(self.repo, dendrified_branch_name):
+            return CommitMap(path, base_oid)
+        tip_oid = self.repo.lookup_branch(dendrified_branch_name).target
+        if kept_map is not None and kept_map.tip == tip_oid:
+            commit_map = kept_map
+        else:
+            commit_map = CommitMap.load_tail(path)
+        if commit_map is None:
+            raise ValueError('destination branch "{}" exists but has no commit map'
+                             .format(dendrified_branch_name))
+        if commit_map.base_oid != base_oid:
+            raise ValueError('destination branch "{}" was made from a different base'
+                             .format(dendrified_branch_name))
+        if tip_oid != commit_map.tip:
+            raise ValueError('destination branch "{}" has moved since it was made'
+                             .format(dendrified_branch_name))
+        return commit_map
+
+    def dendrify(self, dendrified_branch_name, base_revision, linear_branch_name,
+                 incremental=False, dry_run=False, update_refs=()):
+        """
+        Create the branch ``dendrified_branch_name`` holding the hierarchical
+        form of the linear history from ``base_revision`` (exclusive) to
+        ``linear_branch_name`` (inclusive).
+
+        If ``incremental`` is true, record how each commit was rewritten, and
+        if the destination branch already exists, use that record to rewrite
+        only those commits added to the linear history since last time, then
+        move the destination branch to the new tip.
+
+        The new commits are planned in full before any is written, so that an
+        error in the history is found without anything being written.  If
+        ``dry_run`` is true, stop there, and return the Plan.
+
+        Otherwise, return a dict mapping the oid of each source commit to that
+        of its rewritten form (or, for a FastImportOutput, its mark).  For an
+        incremental dendrify, this covers the commits rewritten on earlier
+        runs too, although those are only read from the commit map if one of
+        them is looked up.
+
+        ``update_refs`` is a sequence of patterns, as for ``fnmatch``, of full
+        ref names, e.g., ``'refs/tags/*'``.  Each matching ref which points
+        to a source commit, directly or via an annotated tag, is moved to the
+        rewritten commit (via a new tag, if annotated), in the same atomic
+        transaction as creating the new branch.
+        """
+        try:
+            plan = self._plan_dendrify(dendrified_branch_name, base_revision,
+                                       linear_branch_name, incremental)
+            if dry_run:
+                return plan
+            output = self.output(self.repo, dendrified_branch_name)
+            if incremental and not output.writes_to_repository:
+                raise ValueError('incremental dendrify needs commits to be written'
+                                 ' to the repository')
+            return self._apply_plan(plan, output, update_refs)
+        finally:
+            self.report.finished()
+
+    def _plan_dendrify(self, dendrified_branch_name, base_revision, linear_branch_name,
+                       incremental):
+        base_oid = self.repo.revparse_single(base_revision).oid
+        if incremental:
+            commit_map = self._commit_map_for_update(dendrified_branch_name, base_oid)
+        else:
+            self._verify_branch_existence('destination', dendrified_branch_name, False)
+            commit_map = None
+        self._verify_branch_existence('source', linear_branch_name, True)
+
+        with self._reported_phase('walk'), self.stats.phase('walk'):
+            oids, stop_oid = self._linear_ancestry(base_revision, linear_branch_name,
+                                                   commit_map or ())
+            if (commit_map is not None and stop_oid == base_oid
+                    and commit_map.n_records_skipped):
+                # The linear history no longer includes the last recorded
+                # commit, so has been rewritten.  Read the whole map to find
+                # the last commit which it does still include.
+                commit_map = CommitMap.load(commit_map.path)
+                for idx in range(len(oids) - 1, -1, -1):
+                    if oids[idx] in commit_map:
+                        oids, stop_oid = oids[idx + 1:], oids[idx]
+                        break
+        self.stats.n_commits_read += len(oids)
+
+        plan = Plan('dendrify', dendrified_branch_name, base_oid)
+        plan.commit_map = commit_map
+        plan.moves_branch = incremental
+        if stop_oid == base_oid:
+            section_start_refs = []
+            n_kept = 0
+        else:
+            n_kept = commit_map.index(stop_oid) + 1
+            plan.source_chain_parents[0] = stop_oid
+            tip, section_start_ids = commit_map.state_after(n_kept)
+            plan.tip = plan.external_ref(tip)
+            section_start_refs = [plan.external_ref(id) for id in section_start_ids]
+        if commit_map is not None:
+            commit_map.truncate(n_kept)
+
+        with self._reported_phase('plan'):
+            self._add_dendrify_nodes(plan, oids, section_start_refs)
+
+        return plan
+
+    def dendrify_many(self, base_revision, branch_names, dry_run=False, update_refs=()):
+        """
+        Dendrify several linear branches from the same ``base_revision``.
+        ``branch_names`` is a sequence of pairs (dendrified branch name, linear
+        branch name).  Commits which the linear branches share are walked and
+        rewritten only once, so the cost is in proportion to the union of their
+        histories rather than the total.  All the new branches are created at
+        the end, together.  Otherwise, as for ``dendrify()``.
+        """
+        try:
+            plan = self._plan_dendrify_many(base_revision, branch_names)
+            if dry_run:
+                return plan
+            return self._apply_plan(plan, self.output(self.repo, plan.branch_name),
+                                    update_refs)
+        finally:
+            self.report.finished()
+
+    def _plan_dendrify_many(self, base_revision, branch_names):
+        if not branch_names:
+            raise ValueError('no branches to dendrify')
+        dendrified_branch_names = [dendrified for dendrified, _ in branch_names]
+        for dendrified_branch_name, linear_branch_name in branch_names:
+            if dendrified_branch_names.count(dendrified_branch_name) > 1:
+                raise ValueError('destination branch "{}" given more than once'
+                                 .format(dendrified_branch_name))
+            self._verify_branch_existence('destination', dendrified_branch_name, False)
+            self._verify_branch_existence('source', linear_branch_name, True)
+        base_oid = self.repo.revparse_single(base_revision).oid
+
+        # Walk each branch only as far as the commits of the ones before it.
+        walks = []
+        walked_oids = set()
+        with self._reported_phase('walk'), self.stats.phase('walk'):
+            for _, linear_branch_name in branch_names:
+                oids, stop_oid = self._linear_ancestry(base_revision, linear_branch_name,
+                                                       walked_oids)
+                walked_oids.update(oids)
+                walks.append((oids, stop_oid))
+        self.stats.n_commits_read += len(walked_oids)
+
+        plan = Plan('dendrify', dendrified_branch_names[0], base_oid)
+        # For each commit planned so far, the state of the plan after it:
+        states = {}
+        tips = []
+        with self._reported_phase('plan'):
+            for oids, stop_oid in walks:
+                if stop_oid == base_oid:
+                    plan.tip, section_start_refs = Plan.BaseRef, []
+                else:
+                    plan.tip, section_start_refs = states[stop_oid]
+                    section_start_refs = list(section_start_refs)
+                if oids:
+                    plan.source_chain_parents[len(plan)] = stop_oid
+                self._add_dendrify_nodes(plan, oids, section_start_refs, states)
+                tips.append(plan.tip)
+        plan.tip = tips[0]
+        plan.extra_branches = list(zip(dendrified_branch_names[1:], tips[1:]))
+        return plan
+
+    def _add_dendrify_nodes(self, plan, oids, section_start_refs, states=None):
+        """
+        Add to ``plan`` the nodes dendrifying the linear commits ``oids``,
+        starting from the plan's current tip, with the sections whose start
+        references are in ``section_start_refs`` open.  If ``states`` is
+        given, record in it, for each commit, the pair (tip, section start
+        references) once that commit is rewritten.
+        """
+        for id in oids:
+            with self.stats.phase('read'):
+                commit = self.repo[id]
+                plan.source_commits.append(commit)
+            raw_message = commit.raw_message
+            if raw_message.startswith(b'<s>'):
+                section_start_refs.append(plan.tip)
+                self.stats.note_section_depth(len(section_start_refs))
+                plan.add_node(id, [plan.tip], Plan.StripStart, len(section_start_refs))
+            elif raw_message.startswith(b'</s>'):
+                if not section_start_refs:
+                    raise ValueError('unexpected section-end at {}'
+                                     ' (no section in progress)'
+                                     .format(id))
+                start_ref = section_start_refs.pop(-1)
+                plan.add_node(id, [start_ref, plan.tip], Plan.StripEnd,
+                              len(section_start_refs))
+            else:
+                plan.add_node(id, [plan.tip], Plan.Keep, len(section_start_refs))
+            if states is not None:
+                states[id] = (plan.tip, tuple(section_start_refs))
+
+    def _apply_plan(self, plan, output, ref_patterns=()):
+        """
+        Write the new commits described by ``plan`` to ``output``, and create
+        the plan's branch, pointing to the last of them, moving any refs
+        matching ``ref_patterns`` along with it.  Return the map from source
+        oid to new oid.  The output is closed when done, whether or not this
+        succeeds.
+        """
+        try:
+            return self._write_plan(plan, output, ref_patterns)
+        finally:
+            output.close()
+
+    def _write_plan(self, plan, output, ref_patterns):
+        if ref_patterns and not output.writes_to_repository:
+            raise ValueError('updating refs needs commits to be written'
+                             ' to the repository')
+        new_oids = []
+        def oid_from_ref(ref):
+            return new_oids[ref] if ref >= 0 else plan.external_oids[-1 - ref]
+
+        # Only the dendrified form of a history has depth.
+        indent_commits = (plan.operation == 'dendrify')
+        commit_map = plan.commit_map
+        # A commit outside the repository cannot be a parent of one written to
+        # a stream, so only re-use source commits if writing to the repository.
+        reuses_commits = output.writes_to_repository
+        source_parent_oid = None
+        n_commits_reused = 0
+
+        self.report.started(plan.operation, len(plan))
+        with self._reported_phase('rewrite'):
+            for idx in range(len(plan)):
+                self._check_not_cancelled()
+                source_oid = plan.source_oid(idx)
+                transform = plan.transforms[idx]
+                depth = plan.depths[idx]
+                if transform in (Plan.StripStart, Plan.AddStart):
+                    self.report.section_opened(depth)
+                elif transform in (Plan.StripEnd, Plan.AddEnd):
+                    self.report.section_closed(depth + 1)
+                source = plan.source_commits.fields(idx)
+                raw_message = Plan.transformed_message(plan.source_commits.raw_message(idx),
+                                                       transform)
+                parent_ids = [oid_from_ref(ref) for ref in plan.parent_refs(idx)]
+                source_parent_oid = plan.source_chain_parents.get(idx, source_parent_oid)
+                if (reuses_commits and transform == Plan.Keep
+                        and parent_ids == [source_parent_oid]):
+                    new_oid = source_oid
+                    n_commits_reused += 1
+                else:
+                    with self.stats.phase('write'):
+                        new_oid = output.write_commit(source, raw_message, parent_ids)
+                source_parent_oid = source_oid
+                new_oids.append(new_oid)
+                self.report.commit_written(new_oid, raw_message,
+                                           depth if indent_commits else 0,
+                                           source.encoding)
+                if commit_map is not None:
+                    commit_map.append(source_oid, new_oid,
+                                      self._commit_map_kinds[transform])
+
+        if commit_map is not None:
+            oid_map = commit_map.oid_map()
+        else:
+            oid_map = {plan.source_oid(idx): new_oid for idx, new_oid in enumerate(new_oids)}
+
+        with self._reported_phase('create-branch'), self.stats.phase('create-branch'):
+            ref_updates = (self._ref_updates(oid_map, ref_patterns, plan.branch_name)
+                           if ref_patterns else [])
+            self.stats.n_refs_updated += len(ref_updates)
+            extra_branch_tips = [(branch_name, oid_from_ref(tip))
+                                 for branch_name, tip in plan.extra_branches]
+            if output.writes_to_repository:
+                # Create the extra branches in the same transaction:
+                ref_updates.extend(('refs/heads/' + branch_name, None, tip)
+                                   for branch_name, tip in extra_branch_tips)
+            else:
+                for branch_name, tip in extra_branch_tips:
+                    output.create_branch(branch_name, tip)
+            if ref_updates:
+                output.create_branch(plan.branch_name, oid_from_ref(plan.tip),
+                                     force=plan.moves_branch, ref_updates=ref_updates)
+            else:
+                output.create_branch(plan.branch_name, oid_from_ref(plan.tip),
+                                     force=plan.moves_branch)
+            if commit_map is not None:
+                commit_map.write()
+                if self.commit_maps is not None:
+                    self.commit_maps[commit_map.path] = commit_map
+        self.stats.n_bytes_written += output.n_bytes_written
+        self.stats.n_commits_written += (len(plan) - n_commits_reused
+                                         - output.n_writes_avoided)
+        self.stats.n_writes_avoided += n_commits_reused + output.n_writes_avoided
+        return oid_map
+
+    def _ref_updates(self, oid_map, ref_patterns, branch_name):
+        """
+        The (ref name, old oid, new oid) triples moving each ref, other than
+        ``branch_name``, which matches one of ``ref_patterns`` and points to a
+        commit in ``oid_map``, either directly or via an annotated tag.  Any
+        retargeted tags needed are written to the repository.
+        """
+        branch_ref_name = 'refs/heads/' + branch_name
+        updates = []
+        for ref_name in self.repo.references:
+            if (ref_name == branch_ref_name
+                    or not any(fnmatch.fnmatchcase(ref_name, pattern)
+                               for pattern in ref_patterns)):
+                continue
+            ref = self.repo.lookup_reference(ref_name)
+            if ref.type != git.GIT_REF_OID:
+                continue
+            old_oid = ref.target
+            new_oid = oid_map.get(old_oid)
+            if new_oid is None:
+                target = self.repo[old_oid]
+                if target.type != git.GIT_OBJ_TAG or target.target not in oid_map:
+                    continue
+                new_oid = self.repo.odb.write(
+                    git.GIT_OBJ_TAG, retargeted_tag_bytes(target, oid_map[target.target]))
+            updates.append((ref_name, old_oid, new_oid))
+        return updates
+
+    _commit_map_kinds = {Plan.Keep: CommitMap.Normal,
+                         Plan.StripStart: CommitMap.SectionStart,
+                         Plan.StripEnd: CommitMap.SectionEnd}
+
+    def _check_verification_reads_only_commits(self):
+        if self.commits_only and self.verification == Verification.FullDiff:
+            raise ValueError('full verification of merges reads trees, but only'
+                             ' commits may be read; use tree-id verification')
+
+    def _verify_pure_merge(self, commit, merged_oid):
+        """
+        Check, to the extent requested by ``self.verification``, that ``commit``
+        has no changes with respect to its parent ``merged_oid``.
+        """
+        # parent[0] should be the 'main' branch, into which
+        # parent[1] was merged; therefore we expect no diff
+        # w.r.t. parent[1]:
+        if self.verification == Verification.Off:
+            return
+        with self.stats.phase('verify'):
+            merged_commit = self.repo[merged_oid]
+            if self.verification == Verification.TreeId:
+                is_pure = (commit.tree_id == merged_commit.tree_id)
+            elif self.verification == Verification.FullDiff:
+                is_pure = (len(self.repo.diff(commit, merged_commit)) == 0)
+            else:
+                raise ValueError('unknown verification level')  # pragma nocover
+        self.stats.merges_verified[self.verification] += 1
+        if not is_pure:
+            raise ValueError('expected {} to be pure merge'.format(commit.id))
+
+    def _verify_pure_merges_in_pool(self, merges):
+        """
+        Check, using full diffs computed in a pool of worker processes, that
+        each (merge-oid, merged-oid) pair in ``merges`` is a pure merge.  If any
+        are not, report the earliest in the list.
+        """
+        impure_idx = self._first_impure_merge_in_pool(merges)
+        if impure_idx is not None:
+            raise ValueError('expected {} to be pure merge'.format(merges[impure_idx][0]))
+
+    def _first_impure_merge_in_pool(self, merges):
+        """
+        The index within ``merges`` of the first (merge-oid, merged-oid) pair
+        which is not a pure merge, or None if all are, using full diffs
+        computed in a pool of worker processes.
+        """
+        if not merges:
+            return None
+        n_workers = self.n_verification_workers
+        raw_oid_pairs = [(merge_oid.raw, merged_oid.raw) for merge_oid, merged_oid in merges]
+        chunksize = max(1, len(merges) // (4 * n_workers))
+        import multiprocessing
+        with self.stats.phase('verify'):
+            with multiprocessing.Pool(n_workers,
+                                      initializer=_open_repo_for_verification,
+                                      initargs=(self.repo.path,)) as pool:
+                results = pool.imap(_is_pure_merge, raw_oid_pairs, chunksize)
+                for idx, is_pure in enumerate(results):
+                    self.stats.merges_verified[Verification.FullDiff] += 1
+                    if not is_pure:
+                        return idx
+        return None
+
+    def _open_commit_graph(self):
+        """
+        The repository's commit-graph, or None if it has none, or if we, or
+        its config, say not to use it.
+        """
+        if not self.use_commit_graph:
+            return None
+        try:
+            if not self.repo.config.get_bool('core.commitGraph'):
+                return None
+        except KeyError:
+            pass
+        return CommitGraph.open(self.repo.path)
+
+    def _commit_entry(self, graph, raw_oid):
+        """
+        The triple (raw parent oids, raw tree oid, generation number) of the
+        commit with the given raw oid, from ``graph`` if it covers the commit,
+        and otherwise from the object database (with None as its generation).
+        """
+        entry = graph.commit_entry(raw_oid)
+        if entry is not None:
+            return entry
+        commit = self.repo[git.Oid(raw=raw_oid)]
+        return [oid.raw for oid in commit.parent_ids], commit.tree_id.raw, None
+
+    def _last_parent_chain(self, graph, tip_oid, base_oid, max_n_parents):
+        """
+        List of the (raw oid, raw parent oids, raw tree oid) of the commits
+        found by following last parents back from ``tip_oid`` to ``base_oid``,
+        newest first.  Return None if a commit has no parents or more than
+        ``max_n_parents``, or if its generation number shows that ``base_oid``
+        cannot be one of its ancestors.
+        """
+        base_raw = base_oid.raw
+        base_entry = graph.commit_entry(base_raw)
+        base_generation = base_entry[2] if base_entry is not None else None
+        chain = []
+        raw_oid = tip_oid.raw
+        while raw_oid != base_raw:
+            parents, tree_raw, generation = self._commit_entry(graph, raw_oid)
+            if not 1 <= len(parents) <= max_n_parents:
+                return None
+            if (base_generation is not None and generation is not None
+                    and generation <= base_generation):
+                return None
+            chain.append((raw_oid, parents, tree_raw))
+            raw_oid = parents[-1]
+        return chain
+
+    def _linear_ancestry_from_graph(self, graph, tip_oid, base_oid, stop_oids):
+        """
+        As for ``_linear_ancestry()``, but following parents as given by
+        ``graph``.  Return None if anything is amiss, in which case walking
+        the history in the usual way will find and report the problem.
+        """
+        if stop_oids:
+            # The incremental case: walk only as far as we need to.
+            oids = []
+            raw_oid = tip_oid.raw
+            while raw_oid != base_oid.raw:
+                oid = git.Oid(raw=raw_oid)
+                if oid in stop_oids:
+                    oids.reverse()
+                    return oids, oid
+                parents = self._commit_entry(graph, raw_oid)[0]
+                if len(parents) != 1:
+                    return None
+                oids.append(oid)
+                raw_oid = parents[0]
+            oids.reverse()
+            return oids, base_oid
+
+        chain = self._last_parent_chain(graph, tip_oid, base_oid, 1)
+        if chain is None:
+            return None
+        return [git.Oid(raw=raw_oid) for raw_oid, _, _ in reversed(chain)], base_oid
+
+    def _flat_ancestry_from_graph(self, graph, tip_oid, base_oid):
+        """
+        As for ``flat_ancestry()``, without the commit data, but following
+        parents as given by ``graph``.  Return None if anything is amiss, in
+        which case walking the history in the usual way will find and report
+        the problem.
+        """
+        # In a well-formed dendrified history, following the last parent of
+        # each commit (the only parent of a normal commit, or the second parent
+        # of a merge) visits every commit of the flattened ancestry.
+        chain = self._last_parent_chain(graph, tip_oid, base_oid, 2)
+        if chain is None:
+            return None
+
+        elts = FlatAncestry()
+        open_idxs = array('l', [-1])
+        def raw_oid_at(idx):
+            return base_oid.raw if idx == -1 else elts.raw_oid(idx)
+        merges = []
+        for raw_oid, parents, tree_raw in reversed(chain):
+            if len(parents) == 1:
+                elts.append(CommitType.Normal, raw_oid)
+            else:
+                section_start_idx = None
+                while open_idxs and raw_oid_at(open_idxs[-1]) != parents[0]:
+                    section_start_idx = open_idxs.pop(-1)
+                if not open_idxs or section_start_idx is None:
+                    return None
+                elts.set_commit_type(section_start_idx, CommitType.SectionStart)
+                elts.append(CommitType.SectionEnd, raw_oid)
+                merges.append((raw_oid, parents[1], tree_raw))
+            open_idxs.append(len(elts) - 1)
+
+        if self.verification == Verification.TreeId:
+            with self.stats.phase('verify'):
+                for raw_oid, merged_raw_oid, tree_raw in merges:
+                    self.stats.merges_verified[Verification.TreeId] += 1
+                    if self._commit_entry(graph, merged_raw_oid)[1] != tree_raw:
+                        raise ValueError('expected {} to be pure merge'
+                                         .format(git.Oid(raw=raw_oid)))
+        elif self.verification == Verification.FullDiff:
+            merges = [(git.Oid(raw=raw_oid), git.Oid(raw=merged_raw_oid))
+                      for raw_oid, merged_raw_oid, _ in merges]
+            if self.n_verification_workers > 1:
+                self._verify_pure_merges_in_pool(merges)
+            else:
+                for merge_oid, merged_oid in merges:
+                    self._verify_pure_merge(self.repo[merge_oid], merged_oid)
+
+        return elts
+
+    def flattened_ancestry(self, base_revision, branch_name):
+        """
+        Annotated flat list of commits leading up to the current target of
+        ``branch_name``, starting from but not including the commit referred to by
+        ``base_revision``.  Each element of the list is a pair (type, oid).  The 'type'
+        is an element of the ``CommitType`` enumeration.
+        """
+        return list(self.flat_ancestry(base_revision, branch_name, keep_commits=False))
+
+    def flat_ancestry(self, base_revision, branch_name, keep_commits=True):
+        """
+        As for ``flattened_ancestry()``, but returning a FlatAncestry, which
+        holds the commits compactly, along with (if ``keep_commits`` is true)
+        the data needed to rewrite them.
+        """
+        self._check_verification_reads_only_commits()
+        tip_oid = self.repo.lookup_branch(branch_name).target
+        base_oid = self.repo.revparse_single(base_revision).oid
+
+        graph = self._open_commit_graph()
+        if graph is not None:
+            with graph:
+                elts = self._flat_ancestry_from_graph(graph, tip_oid, base_oid)
+            if elts is not None:
+                if keep_commits:
+                    with self.stats.phase('read'):
+                        for idx in range(len(elts)):
+                            elts.commits.append(self.repo[elts.oid(idx)])
+                return elts
+
+        # In a well-formed dendrified history, each commit is an ancestor of the
+        # next, so there is only one topological order, and libgit2 gives us
+        # the commits in it oldest-first.  We can only tell that a commit starts
+        # a section once we reach the merge ending that section, so keep a
+        # stack of the indexes within elts of those commits not yet known to
+        # be within a closed section, with -1 standing for the base.  The
+        # merge's first parent is on this stack, and the section's first
+        # commit is the one just above it.
+        #
+        # If the structure turns out to be wrong, keep going, checking for the
+        # more specific problems of unexpected parent counts and impure merges;
+        # only if there are none of those do we report the structure error.
+        #
+        # Full diffs are costly, so if we have several worker processes, we
+        # just collect the merges to verify, and check them all at the end.
+        walker = self._ancestry_walker(tip_oid, base_oid,
+                                       git.GIT_SORT_TOPOLOGICAL | git.GIT_SORT_REVERSE)
+        defer_verification = (self.verification == Verification.FullDiff
+                              and self.n_verification_workers > 1)
+        merges_to_verify = []
+        elts = FlatAncestry()
+        open_idxs = array('l', [-1])
+        def raw_oid_at(idx):
+            return base_oid.raw if idx == -1 else elts.raw_oid(idx)
+        prev_oid = base_oid
+        walk_error = None
+        structure_error = None
+        for commit in walker:
+            oid = commit.id
+            parents = commit.parent_ids
+            n_parents = len(parents)
+            if n_parents == 0:
+                walk_error = ValueError('"{}" is not an ancestor of "{}"'
+                                        .format(base_revision, branch_name))
+                break
+            if n_parents > 2:
+                walk_error = ValueError('unexpected number of parents')
+                break
+            if n_parents == 2:
+                if defer_verification:
+                    merges_to_verify.append((oid, parents[1]))
+                else:
+                    self._verify_pure_merge(commit, parents[1])
+            if structure_error is not None:
+                continue
+            # The 'main' parent, i.e., the only parent of a normal commit or the
+            # second parent of a merge, must be the immediately previous commit:
+            if parents[-1] != prev_oid:
+                if prev_oid == base_oid:
+                    structure_error = ValueError('"{}" is not an ancestor of "{}"'
+                                                 .format(base_revision, branch_name))
+                else:
+                    structure_error = ValueError('unexpected parents of {}'.format(oid))
+                continue
+            if keep_commits:
+                elts.commits.append(commit)
+            if n_parents == 1:
+                elts.append(CommitType.Normal, oid.raw)
+            else:
+                section_start_idx = None
+                section_base_raw_oid = parents[0].raw
+                while open_idxs and raw_oid_at(open_idxs[-1]) != section_base_raw_oid:
+                    section_start_idx = open_idxs.pop(-1)
+                if not open_idxs or section_start_idx is None:
+                    structure_error = ValueError('unexpected parents of {}'.format(oid))
+                    continue
+                elts.set_commit_type(section_start_idx, CommitType.SectionStart)
+                elts.append(CommitType.SectionEnd, oid.raw)
+            open_idxs.append(len(elts) - 1)
+            prev_oid = oid
+
+        self._verify_pure_merges_in_pool(merges_to_verify)
+        if walk_error is not None:
+            raise walk_error
+        if structure_error is not None:
+            raise structure_error
+        if not elts and tip_oid != base_oid:
+            raise ValueError('"{}" is not an ancestor of "{}"'
+                             .format(base_revision, branch_name))
+
+        return elts
+
+    def linearize(self, linear_branch_name, base_revision, dendrified_branch_name,
+                  dry_run=False, replace=False, update_refs=()):
+        """
+        Create the branch ``linear_branch_name`` holding the linear form of the
+        hierarchical history from ``base_revision`` (exclusive) to
+        ``dendrified_branch_name`` (inclusive).  If ``replace`` is true, the
+        branch may already exist, and is moved to the new history.  As for
+        ``dendrify()``, the new commits are planned in full first, and if
+        ``dry_run`` is true, nothing is written and the Plan is returned.
+        Otherwise, the map from source oid to new oid is returned, and refs
+        matching ``update_refs`` are moved, both as for ``dendrify()``.
+        """
+        try:
+            plan = self._plan_linearize(linear_branch_name, base_revision,
+                                        dendrified_branch_name, replace)
+            if dry_run:
+                return plan
+            return self._apply_plan(plan, self.output(self.repo, linear_branch_name),
+                                    update_refs)
+        finally:
+            self.report.finished()
+
+    async def dendrify_async(self, *args, executor=None, **kwargs):
+        """
+        Coroutine doing the same as ``dendrify()``, with the same arguments,
+        in a thread of ``executor`` (by default, that of the event loop), so
+        that the loop is not blocked meanwhile.  See ``_run_async()``.
+        """
+        return await self._run_async(self.dendrify, args, kwargs, executor)
+
+    async def linearize_async(self, *args, executor=None, **kwargs):
+        """
+        Coroutine doing the same as ``linearize()``; see ``dendrify_async()``.
+        """
+        return await self._run_async(self.linearize, args, kwargs, executor)
+
+    async def _run_async(self, method, args, kwargs, executor):
+        """
+        Run ``method(*args, **kwargs)`` in a thread of ``executor``, passing
+        progress events to ``self.report`` within the event loop.  All events
+        have reached the reporter by the time this returns.
+
+        To limit how many operations run at once, give each the same
+        ``concurrent.futures.ThreadPoolExecutor``, with that many workers.
+        Operations on different repositories, with different Dendrifiers, can
+        then run concurrently.  A Dendrifier must run only one at a time.
+
+        If the task is cancelled, the operation stops before its next commit
+        or phase, and the cancellation is only passed on once it has stopped.
+        The new branch is then not created, although any commits already
+        written remain in the repository until garbage-collected.  If the
+        branch was already being created, that is finished first.
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        cancel_event = threading.Event()
+        report = self.report
+
+        def run():
+            self._cancel_event = cancel_event
+            self.report = ReportViaLoop(loop, report)
+            try:
+                # The task might have been cancelled while this waited to
+                # start.
+                self._check_not_cancelled()
+                return method(*args, **kwargs)
+            finally:
+                self.report = report
+                self._cancel_event = None
+
+        future = loop.run_in_executor(executor, run)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            await asyncio.wait([future])
+            raise
+
+    def verify(self, base_revision, linear_branch_name, dendrified_branch_name):
+        """
+        Check that the linear history ``linear_branch_name`` and the
+        hierarchical history ``dendrified_branch_name``, both from
+        ``base_revision`` (exclusive), describe the same commits: the same
+        trees, authors and messages (once the magic strings are stripped),
+        with sections where the magic strings say.  Only commits are read, and
+        nothing is written.  Return None if the histories match, or else a
+        Divergence describing the first place where they differ.
+
+        The two histories are walked together, oldest first, stopping at the
+        first difference.  Whether a commit starts a section is only known
+        once the section's end is reached, so a section is compared as it
+        ends.  A dendrified history which is not of the expected shape, for
+        example because it has an impure merge, diverges where that is found.
+        """
+        self._check_verification_reads_only_commits()
+        self._verify_branch_existence('linear', linear_branch_name, True)
+        self._verify_branch_existence('dendrified', dendrified_branch_name, True)
+        base_oid = self.repo.revparse_single(base_revision).oid
+        sort = git.GIT_SORT_TOPOLOGICAL | git.GIT_SORT_REVERSE
+        linear_walker = self._ancestry_walker(
+            self.repo.lookup_branch(linear_branch_name).target, base_oid, sort)
+        linear_walker.simplify_first_parent()
+        dendrified_walker = self._ancestry_walker(
+            self.repo.lookup_branch(dendrified_branch_name).target, base_oid, sort)
+
+        # As in flat_ancestry(), with several worker processes, collect the
+        # merges to verify, as (index, merge-oid, merged-oid, linear-oid), and
+        # check those before the first other difference at the end.
+        merges_to_verify = []
+        with self.stats.phase('walk'):
+            divergence = self._first_divergence(base_revision, base_oid,
+                                                linear_branch_name, linear_walker,
+                                                dendrified_branch_name, dendrified_walker,
+                                                merges_to_verify)
+        impure_idx = self._first_impure_merge_in_pool(
+            [(merge_oid, merged_oid) for _, merge_oid, merged_oid, _ in merges_to_verify])
+        if impure_idx is not None:
+            idx, merge_oid, _, linear_oid = merges_to_verify[impure_idx]
+            return Divergence(idx, linear_oid, merge_oid,
+                              'expected {} to be pure merge'.format(merge_oid))
+        return divergence
+
+    def _first_divergence(self, base_revision, base_oid,
+                          linear_branch_name, linear_walker,
+                          dendrified_branch_name, dendrified_walker,
+                          merges_to_verify):
+        """
+        The first Divergence between the commits given by the oldest-first
+        walkers ``linear_walker`` and ``dendrified_walker``, or None; see
+        ``verify()``.  If merges are to be verified in a pool of workers, they
+        are appended to ``merges_to_verify`` rather than checked here.
+        """
+        defer_verification = (self.verification == Verification.FullDiff
+                              and self.n_verification_workers > 1)
+        # Types and oids of the commits so far, with the dendrified types
+        # provisional until the ends of their sections are reached, and as in
+        # flat_ancestry(), the indexes of the dendrified commits not yet known
+        # to be within a closed section.  The indexes of the linear commits
+        # starting each open section are kept too.
+        linear_elts = FlatAncestry()
+        dendrified_elts = FlatAncestry()
+        open_idxs = array('l', [-1])
+        linear_start_idxs = []
+        def dendrified_raw_oid_at(idx):
+            return base_oid.raw if idx == -1 else dendrified_elts.raw_oid(idx)
+        idx = 0
+        while True:
+            linear = next(linear_walker, None)
+            dendrified = next(dendrified_walker, None)
+            if linear is None and dendrified is None:
+                break
+            if linear is None:
+                return Divergence(idx, None, dendrified.id, 'linear history ends first')
+            if dendrified is None:
+                return Divergence(idx, linear.id, None, 'dendrified history ends first')
+            self.stats.n_commits_read += 2
+            def divergence(reason):
+                return Divergence(idx, linear.id, dendrified.id, reason)
+
+            prev_linear_oid = linear_elts.oid(idx - 1) if idx else base_oid
+            prev_dendrified_oid = dendrified_elts.oid(idx - 1) if idx else base_oid
+            linear_parents = linear.parent_ids
+            if len(linear_parents) > 1:
+                return divergence('ancestry of "{}" is not linear'.format(linear_branch_name))
+            if linear_parents != [prev_linear_oid]:
+                return divergence('"{}" is not an ancestor of "{}"'
+                                  .format(base_revision, linear_branch_name))
+            parents = dendrified.parent_ids
+            n_parents = len(parents)
+            if n_parents == 0 or (idx == 0 and parents[-1] != base_oid):
+                return divergence('"{}" is not an ancestor of "{}"'
+                                  .format(base_revision, dendrified_branch_name))
+            if n_parents > 2:
+                return divergence('unexpected number of parents')
+            if parents[-1] != prev_dendrified_oid:
+                return divergence('unexpected parents of {}'.format(dendrified.id))
+
+            linear_type = self._tagged_commit_type(linear.raw_message)
+            if n_parents == 1:
+                # Agree for now with a linear section start; it is checked once
+                # the linear section ends.
+                dendrified_type = (CommitType.Normal if linear_type == CommitType.SectionEnd
+                                   else linear_type)
+            else:
+                if defer_verification:
+                    merges_to_verify.append((idx, dendrified.id, parents[1], linear.id))
+                else:
+                    try:
+                        self._verify_pure_merge(dendrified, parents[1])
+                    except ValueError as err:
+                        return divergence(str(err))
+                section_start_idx = None
+                section_base_raw_oid = parents[0].raw
+                while open_idxs and dendrified_raw_oid_at(open_idxs[-1]) != section_base_raw_oid:
+                    section_start_idx = open_idxs.pop(-1)
+                if not open_idxs or section_start_idx is None:
+                    return divergence('unexpected parents of {}'.format(dendrified.id))
+                dendrified_type = CommitType.SectionEnd
+                if linear_type == CommitType.SectionEnd:
+                    linear_start_idx = linear_start_idxs.pop(-1) if linear_start_idxs else None
+                    if linear_start_idx != section_start_idx:
+                        return self._section_start_divergence(
+                            idx, linear, dendrified, section_start_idx,
+                            linear_elts, dendrified_elts)
+                dendrified_elts.set_commit_type(section_start_idx, CommitType.SectionStart)
+
+            reason = self._commit_difference(linear, dendrified, dendrified_type)
+            if reason is not None:
+                return divergence(reason)
+            if linear_type == CommitType.SectionStart:
+                linear_start_idxs.append(idx)
+            linear_elts.append(linear_type, linear.id.raw)
+            dendrified_elts.append(
+                CommitType.SectionEnd if n_parents == 2 else CommitType.Normal,
+                dendrified.id.raw)
+            open_idxs.append(idx)
+            idx += 1
+
+        if linear_start_idxs:
+            # No dendrified section started here, or its end would have been
+            # compared with this section's.
+            start_idx = linear_start_idxs[0]
+            return Divergence(start_idx, linear_elts.oid(start_idx),
+                              dendrified_elts.oid(start_idx),
+                              'linear commit is a section start'
+                              ' but dendrified commit is a normal commit')
+        return None
+
+    def _section_start_divergence(self, idx, linear, dendrified, dendrified_start_idx,
+                                  linear_elts, dendrified_elts):
+        """
+        The Divergence when the ``linear`` and ``dendrified`` commits at
+        ``idx`` both end a section, but the dendrified section starts at
+        ``dendrified_start_idx`` and the linear one does not.  If the linear
+        commit at the dendrified section's start does not start a section, it
+        is there; otherwise it is at ``idx``.  (Whether the dendrified commit
+        at the linear section's start begins a section which has not yet ended
+        is not known.)
+        """
+        linear_type = linear_elts.commit_type(dendrified_start_idx)
+        if linear_type != CommitType.SectionStart:
+            return Divergence(dendrified_start_idx,
+                              linear_elts.oid(dendrified_start_idx),
+                              dendrified_elts.oid(dendrified_start_idx),
+                              'linear commit is {} but dendrified commit is {}'
+                              .format(self._commit_type_descriptions[linear_type],
+                                      self._commit_type_descriptions[CommitType.SectionStart]))
+        return Divergence(idx, linear.id, dendrified.id,
+                          'linear and dendrified sections start at different commits')
+
+    def outline(self, base_revision, branch_name, max_depth=None):
+        """
+        Generate lines outlining the history from ``base_revision`` (exclusive)
+        to ``branch_name`` (inclusive), newest first, with each commit indented
+        by its depth as when dendrifying.  The branch may be in dendrified form,
+        with sections as merges, or in linear form, with sections marked by the
+        magic strings.  Lines are generated while walking back from the tip, so
+        the first come at once, however long the history.
+
+        If ``max_depth`` is given, the contents of deeper sections are folded
+        away, leaving the line of the commit ending each folded section, marked
+        with ``[...]``.  In dendrified form, folded commits are not even read.
+        """
+        self._verify_branch_existence('source', branch_name, True)
+        base_oid = self.repo.revparse_single(base_revision).oid
+        oid = self.repo.lookup_branch(branch_name).target
+        # One entry per section open (going backwards), innermost last: the
+        # commit the section starts from, or None for a linear-form section.
+        open_sections = []
+        while oid != base_oid:
+            commit = self.repo[oid]
+            self.stats.n_commits_read += 1
+            parent_ids = commit.parent_ids
+            raw_message = commit.raw_message
+            depth = len(open_sections)
+            folds = (max_depth is not None and depth >= max_depth)
+            if len(parent_ids) == 2:
+                next_oid = parent_ids[0] if folds else parent_ids[1]
+                if not folds:
+                    open_sections.append(parent_ids[0])
+            elif len(parent_ids) == 1:
+                next_oid = parent_ids[0]
+                if raw_message.startswith(b'</s>'):
+                    open_sections.append(None)
+                else:
+                    folds = False
+                    if open_sections and open_sections[-1] == next_oid:
+                        open_sections.pop(-1)
+                    elif raw_message.startswith(b'<s>'):
+                        if not open_sections or open_sections[-1] is not None:
+                            raise ValueError('unexpected section-start at {}'
+                                             ' (no section in progress)'
+                                             .format(oid))
+                        open_sections.pop(-1)
+            elif not parent_ids:
+                raise ValueError('"{}" is not an ancestor of "{}"'
+                                 .format(base_revision, branch_name))
+            else:
+                raise ValueError('unexpected number of parents of {}'.format(oid))
+            if max_depth is None or depth <= max_depth:
+                line = commit_summary(oid, raw_message, depth, commit.message_encoding)
+                yield line + ' [...]' if folds else line
+            oid = next_oid
+        if open_sections:
+            raise ValueError('section-end with no section-start in "{}"'
+                             .format(branch_name))
+
+    def section_index(self, base_revision, branch_name):
+        """
+        Return the SectionIndex of the dendrified history from
+        ``base_revision`` (exclusive) to ``branch_name`` (inclusive), which the
+        caller must close.  The index is kept in a file under the repository's
+        git directory, and first brought up to date.  If the branch has only
+        grown since the index was last written, only the new commits are
+        walked; if it has been rewritten, or the base differs, the index is
+        made afresh.
+        """
+        self._verify_branch_existence('source', branch_name, True)
+        tip_oid = self.repo.lookup_branch(branch_name).target
+        base_oid = self.repo.revparse_single(base_revision).oid
+        path = SectionIndex.path_for(self.repo, branch_name)
+        old_index = SectionIndex.open(path)
+        if old_index is not None:
+            if old_index.base_oid == base_oid and old_index.tip_oid == tip_oid:
+                return old_index
+            if (old_index.base_oid != base_oid
+                    or not self.repo.descendant_of(tip_oid, old_index.tip_oid)):
+                old_index.close()
+                old_index = None
+
+        try:
+            if old_index is None:
+                commits, sections = self._section_index_from_scratch(base_revision,
+                                                                     branch_name)
+            else:
+                commits, sections = self._section_index_extended(
+                    base_revision, branch_name, base_oid, tip_oid, old_index)
+            SectionIndex.write(path, base_oid, tip_oid, commits, sections)
+        finally:
+            if old_index is not None:
+                old_index.close()
+        return SectionIndex.open(path)
+
+    def _section_index_from_scratch(self, base_revision, branch_name):
+        """
+        The CommitPositions and SectionTable of the whole of the dendrified
+        history ``branch_name``, from its flattened ancestry.
+        """
+        with self.stats.phase('walk'):
+            elts = self.flat_ancestry(base_revision, branch_name, keep_commits=False)
+        self.stats.n_commits_read += len(elts)
+        commits = CommitPositions().extended(elts.raw_oids, 0)
+        sections = SectionTable()
+        section_start = CommitType.SectionStart.value
+        section_end = CommitType.SectionEnd.value
+        open_section_starts = []
+        for position, type_code in enumerate(elts.type_codes):
+            if type_code == section_start:
+                open_section_starts.append(position)
+            elif type_code == section_end:
+                sections.add_section(open_section_starts.pop(-1), position,
+                                     elts.raw_oid(position))
+        return commits, sections
+
+    def _section_index_extended(self, base_revision, branch_name, base_oid, tip_oid,
+                                old_index):
+        """
+        The CommitPositions and SectionTable of ``old_index``, extended by the
+        commits of the dendrified history to ``tip_oid`` which it lacks.
+        """
+        with self.stats.phase('walk'):
+            new_raw_oids, merges = self._section_index_walk(
+                base_revision, branch_name, base_oid, tip_oid, old_index)
+        commits = old_index.commits.extended(new_raw_oids, len(old_index.commits))
+        sections = old_index.sections.copy()
+
+        # The section a merge ends starts just after its first parent.  Every
+        # section so far has already ended, so each one containing that parent
+        # must end with it, or the sections would not nest.
+        for position, raw_oid, section_base_raw_oid in merges:
+            section_base_position = (-1 if section_base_raw_oid == base_oid.raw
+                                     else commits.position(section_base_raw_oid))
+            if (section_base_position is None
+                    or section_base_position == position - 1
+                    or not self._sections_end_at(sections, section_base_position)):
+                raise ValueError('unexpected parents of {}'.format(git.Oid(raw=raw_oid)))
+            sections.add_section(section_base_position + 1, position, raw_oid)
+        return commits, sections
+
+    @staticmethod
+    def _sections_end_at(sections, position):
+        """
+        Whether every section of ``sections`` containing the commit at
+        ``position`` ends there.
+        """
+        idx = sections.innermost_containing(position)
+        while idx is not None:
+            if sections.ends[idx] != position:
+                return False
+            idx = sections.parents[idx]
+            if idx == sections.NoParent:
+                idx = None
+        return True
+
+    def _section_index_walk(self, base_revision, branch_name, base_oid, tip_oid,
+                            old_index):
+        """
+        The raw oids, concatenated, of the commits of the dendrified history
+        to ``tip_oid`` which are not in ``old_index``, in order, and
+        a list of (position, raw oid, raw oid of first parent) for each merge
+        among them.  As for ``flat_ancestry()``, each commit's last parent must
+        be the previous commit.
+        """
+        prev_oid = old_index.tip_oid
+        first_position = len(old_index.commits)
+        walker = self._ancestry_walker(tip_oid, prev_oid,
+                                       git.GIT_SORT_TOPOLOGICAL | git.GIT_SORT_REVERSE)
+        new_raw_oids = bytearray()
+        merges = []
+        for commit in walker:
+            oid = commit.id
+            parents = commit.parent_ids
+            if not parents or parents[-1] != prev_oid:
+                if prev_oid == base_oid:
+                    raise ValueError('"{}" is not an ancestor of "{}"'
+                                     .format(base_revision, branch_name))
+                raise ValueError('unexpected parents of {}'.format(oid))
+            if len(parents) > 2:
+                raise ValueError('unexpected number of parents of {}'.format(oid))
+            if len(parents) == 2:
+                self._verify_pure_merge(commit, parents[1])
+                merges.append((first_position + len(new_raw_oids) // 20,
+                               oid.raw, parents[0].raw))
+            new_raw_oids += oid.raw
+            prev_oid = oid
+        self.stats.n_commits_read += len(new_raw_oids) // 20
+        if prev_oid != tip_oid:
+            raise ValueError('"{}" is not an ancestor of "{}"'
+                             .format(base_revision, branch_name))
+        return new_raw_oids, merges
+
+    _commit_type_descriptions = {CommitType.SectionStart: 'a section start',
+                                 CommitType.SectionEnd: 'a section end',
+                                 CommitType.Normal: 'a normal commit'}
+
+    @staticmethod
+    def _tagged_commit_type(raw_message):
+        """
+        The CommitType which the magic string, if any, at the start of
+        ``raw_message`` gives its linear commit.
+        """
+        if raw_message.startswith(b'<s>'):
+            return CommitType.SectionStart
+        if raw_message.startswith(b'</s>'):
+            return CommitType.SectionEnd
+        return CommitType.Normal
+
+    @classmethod
+    def _commit_difference(cls, linear, dendrified, dendrified_type):
+        """
+        How the ``linear`` commit differs from the ``dendrified`` commit of type
+        ``dendrified_type``, or None if they describe the same change.
+        """
+        raw_message = linear.raw_message
+        linear_type = cls._tagged_commit_type(raw_message)
+        if linear_type != dendrified_type:
+            return ('linear commit is {} but dendrified commit is {}'
+                    .format(cls._commit_type_descriptions[linear_type],
+                            cls._commit_type_descriptions[dendrified_type]))
+        if linear.tree_id != dendrified.tree_id:
+            return 'trees differ'
+        if linear.author != dendrified.author:
+            return 'authors differ'
+        if linear.message_encoding != dendrified.message_encoding:
+            return 'message encodings differ'
+        if cls.raw_plain_message_from_tagged(raw_message) != dendrified.raw_message:
+            return 'messages differ'
+        return None
+
+    def _plan_linearize(self, linear_branch_name, base_revision, dendrified_branch_name,
+                        replace):
+        if not replace:
+            self._verify_branch_existence('destination', linear_branch_name, False)
+        self._verify_branch_existence('source', dendrified_branch_name, True)
+
+        base_oid = self.repo.revparse_single(base_revision).oid
+        with self._reported_phase('walk'), self.stats.phase('walk'):
+            elts = self.flat_ancestry(base_revision, dendrified_branch_name)
+        self.stats.n_commits_read += len(elts)
+
+        plan = Plan('linearize', linear_branch_name, base_oid)
+        plan.moves_branch = replace
+        plan.source_commits = elts.commits
+        depth = 0
+        with self._reported_phase('plan'):
+            for tp, id in elts:
+                if tp == CommitType.SectionStart:
+                    depth += 1
+                    self.stats.note_section_depth(depth)
+                    plan.add_node(id, [plan.tip], Plan.AddStart, depth)
+                elif tp == CommitType.SectionEnd:
+                    depth -= 1
+                    plan.add_node(id, [plan.tip], Plan.AddEnd, depth)
+                elif tp == CommitType.Normal:
+                    plan.add_node(id, [plan.tip], Plan.Keep, depth)
+
+        return plan
@@ -0,0 +1,492 @@
+# git-dendrify --- transform git histories (output of rewritten commits)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import queue
+import struct
+import subprocess
+import hashlib
+import tempfile
+import threading
+import zlib
+from collections import namedtuple
+import pygit2 as git
+
+
+def signature_bytes(sig):
+    """
+    Serialized form of the given Signature, as it appears in the 'author' or
+    'committer' line of a commit object.
+    """
+    sign = '-' if sig.offset < 0 else '+'
+    hours, minutes = divmod(abs(sig.offset), 60)
+    return (b'%s <%s> %d %s%02d%02d'
+            % (sig.raw_name, sig.raw_email, sig.time, sign.encode(), hours, minutes))
+
+
+# The fields of a source commit which its rewritten form keeps: its tree id,
+# its author and committer, serialized by signature_bytes(), and the encoding
+# of its message (None if it has no 'encoding' header).
+CommitFields = namedtuple('CommitFields', 'tree_id author committer encoding')
+
+
+def commit_fields(commit):
+    return CommitFields(commit.tree_id,
+                        signature_bytes(commit.author),
+                        signature_bytes(commit.committer),
+                        commit.message_encoding)
+
+
+def commit_bytes(tree_id, parent_ids, author, committer, message, encoding=None):
+    """
+    Serialized commit object with the given properties, laid out as libgit2
+    lays out the commits it creates.  The ``author`` and ``committer`` are
+    already serialized, and the ``message`` is bytes, in the given encoding.
+    """
+    lines = [b'tree ' + str(tree_id).encode()]
+    lines.extend(b'parent ' + str(oid).encode() for oid in parent_ids)
+    lines.append(b'author ' + author)
+    lines.append(b'committer ' + committer)
+    if encoding is not None:
+        lines.append(b'encoding ' + encoding.encode())
+    return b'\n'.join(lines) + b'\n\n' + message
+
+
+_tag_signature_re = re.compile(rb'^-----BEGIN (PGP|SSH) SIGNATURE-----$', re.MULTILINE)
+
+
+def retargeted_tag_bytes(tag, target_id):
+    """
+    Serialized form of the annotated ``tag``, but pointing to the commit
+    ``target_id``.  Any signature is dropped, since it would no longer hold.
+    """
+    lines = [b'object ' + str(target_id).encode(),
+             b'type commit',
+             b'tag ' + tag.raw_name]
+    if tag.tagger is not None:
+        lines.append(b'tagger ' + signature_bytes(tag.tagger))
+    message = tag.raw_message
+    m_signature = _tag_signature_re.search(message)
+    if m_signature is not None:
+        message = message[:m_signature.start()]
+    return b'\n'.join(lines) + b'\n\n' + message
+
+
+def update_refs(repo, updates):
+    """
+    Make the given ref updates, each a triple (ref name, old oid, new oid), in
+    one atomic transaction: either every ref is updated, or none is.  An old
+    oid of None means that the ref must not yet exist.  Each other ref must
+    still point to its old oid.
+    """
+    lines = []
+    for ref_name, old_oid, new_oid in updates:
+        if old_oid is None:
+            lines.append('create {} {}\n'.format(ref_name, new_oid))
+        else:
+            lines.append('update {} {} {}\n'.format(ref_name, new_oid, old_oid))
+    result = subprocess.run(['git', '--git-dir', repo.path, 'update-ref', '--stdin'],
+                            input=''.join(lines).encode(),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise ValueError('could not update refs: {}'
+                         .format(result.stderr.decode(errors='replace').strip()))
+
+
+def _create_branch(repo, branch_name, tip, force, ref_updates):
+    if not ref_updates:
+        repo.create_branch(branch_name, repo[tip], force)
+        return
+    branch = repo.lookup_branch(branch_name)
+    if branch is not None and not force:
+        raise ValueError('branch "{}" exists'.format(branch_name))
+    old_tip = None if branch is None else branch.target
+    update_refs(repo, [('refs/heads/' + branch_name, old_tip, tip)] + list(ref_updates))
+
+
+def _object_header(type_name, data):
+    return b'%s %d\0' % (type_name, len(data))
+
+
+def object_id(type_name, data):
+    """
+    Oid which the given object would have, computed without touching the ODB.
+    """
+    return git.Oid(raw=hashlib.sha1(_object_header(type_name, data) + data).digest())
+
+
+def write_loose_object(objects_dir, oid, type_name, data):
+    """
+    Write the object with the given oid, type and content into the
+    ``objects_dir`` of a repository as a loose object, as git would.  This
+    uses zlib and plain file I/O rather than libgit2, so releases the GIL
+    while it works.  The object is written to a temporary file, which is
+    then moved into place, so readers never see part of it.
+    """
+    hex_oid = str(oid)
+    fanout_dir = os.path.join(objects_dir, hex_oid[:2])
+    # Level 1 is git's default 'core.looseCompression'.
+    compressed = zlib.compress(_object_header(type_name, data) + data, 1)
+    os.makedirs(fanout_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=fanout_dir, prefix='tmp_obj_')
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            f_out.write(compressed)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, os.path.join(fanout_dir, hex_oid[2:]))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class BackgroundWriter:
+    """
+    Call ``write(item)`` for each item given to ``put()``, in order, in a
+    thread of its own, so that the caller can go on to make the next items
+    meanwhile.  Items are handed over in batches of ``batch_size``, through a
+    queue of at most ``max_batches`` batches, so the caller waits if it gets
+    too far ahead.
+
+    If a write fails, no more items are written, and the exception is raised
+    in the caller, by its next ``put()`` or by ``finish()``.  ``close()``
+    stops the thread, abandoning any items not yet written.
+    """
+    def __init__(self, write, batch_size=64, max_batches=16):
+        self.write = write
+        self.batch_size = batch_size
+        self.batch = []
+        self.queue = queue.Queue(max_batches)
+        self.error = None
+        self.abandoned = False
+        self.thread = threading.Thread(target=self._run, name='dendrify-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None or self.abandoned:
+                continue
+            try:
+                for item in batch:
+                    self.write(item)
+            except BaseException as e:
+                self.error = e
+
+    def _raise_any_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item):
+        self._raise_any_error()
+        self.batch.append(item)
+        if len(self.batch) == self.batch_size:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def finish(self):
+        """
+        Wait until all items so far have been written, and stop the thread.
+        """
+        if self.thread.is_alive():
+            if self.batch:
+                self.queue.put(self.batch)
+                self.batch = []
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_any_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.abandoned = True
+            self.batch = []
+            self.queue.put(None)
+            self.thread.join()
+
+
+class ObjectDatabaseOutput:
+    """
+    Write each new commit as soon as it is made, directly into the
+    repository's object database.
+
+    Each output's ``write_commit()`` takes the CommitFields of the source
+    commit, the new raw (bytes) message, and the new parents.
+
+    Each output counts, in ``n_bytes_written``, the size of what it has
+    written: the uncompressed size of each new object, or, for the
+    FastImportOutput, the length of the stream.  The outputs which write to
+    the repository first compute each new commit's oid, and skip writing any
+    commit which the repository already has, counting these in
+    ``n_writes_avoided``.  A commit with a parent which the output has just
+    created cannot already exist, so once one commit is written, its
+    descendants are written without looking for them first.
+
+    The outputs which write to the repository can also, when creating the
+    branch, move other refs, given as (ref name, old oid, new oid) triples.
+    The branch and those refs are then all updated in one transaction.
+
+    Each output's ``close()`` is called once the operation is over, whether
+    or not it succeeded.
+    """
+    writes_to_repository = True
+
+    def __init__(self, repo, branch_name):
+        self.repo = repo
+        self.n_bytes_written = 0
+        self.n_writes_avoided = 0
+        self.last_new_oid = None
+
+    def write_commit(self, source, message, parent_ids):
+        data = commit_bytes(source.tree_id, parent_ids,
+                            source.author, source.committer,
+                            message, source.encoding)
+        oid = None
+        if self.last_new_oid not in parent_ids:
+            oid = object_id(b'commit', data)
+            if oid in self.repo.odb:
+                self.n_writes_avoided += 1
+                return oid
+        self.n_bytes_written += len(data)
+        self.last_new_oid = self._write(data, oid)
+        return self.last_new_oid
+
+    def _write(self, data, oid):
+        """
+        Write the commit with the given serialized form, and oid if already
+        known (else None); return its oid.
+        """
+        return self.repo.odb.write(git.GIT_OBJ_COMMIT, data)
+
+    def create_branch(self, branch_name, tip, force=False, ref_updates=()):
+        _create_branch(self.repo, branch_name, tip, force, ref_updates)
+
+    def close(self):
+        pass
+
+
+class BackgroundObjectDatabaseOutput(ObjectDatabaseOutput):
+    """
+    As ObjectDatabaseOutput, but compress and write each commit, as a loose
+    object, in a BackgroundWriter's thread, while the next commits are made.
+    The writes use ``write_loose_object()``, which releases the GIL, rather
+    than libgit2, which holds it throughout.  Each new oid is computed
+    beforehand, so is the same, and known at once.  All
+    writes are finished before the branch is created.  If one fails, its
+    error is raised by a later ``write_commit()`` or by ``create_branch()``,
+    and the branch is not created, as if the write had failed at once.
+    """
+    def __init__(self, repo, branch_name):
+        super().__init__(repo, branch_name)
+        self.objects_dir = os.path.join(repo.path, 'objects')
+        self.writer = None
+
+    def _write(self, data, oid):
+        if oid is None:
+            oid = object_id(b'commit', data)
+        if self.writer is None:
+            self.writer = BackgroundWriter(lambda item: self._write_object(*item))
+        self.writer.put((self.objects_dir, oid, data))
+        return oid
+
+    @staticmethod
+    def _write_object(objects_dir, oid, data):
+        write_loose_object(objects_dir, oid, b'commit', data)
+
+    def create_branch(self, branch_name, tip, force=False, ref_updates=()):
+        if self.writer is not None:
+            self.writer.finish()
+        super().create_branch(branch_name, tip, force, ref_updates)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class PackfileOutput:
+    """
+    Hold each new commit in memory, and only write them to the repository,
+    as a single packfile and its index, when the branch is created.  If the
+    operation is abandoned before then, nothing is written.
+    """
+    writes_to_repository = True
+    _pack_type_commit = 1
+
+    def __init__(self, repo, branch_name):
+        self.repo = repo
+        self.objects = {}
+        self.n_bytes_written = 0
+        self.n_writes_avoided = 0
+
+    def write_commit(self, source, message, parent_ids):
+        data = commit_bytes(source.tree_id, parent_ids,
+                            source.author, source.committer,
+                            message, source.encoding)
+        oid = object_id(b'commit', data)
+        if not any(p in self.objects for p in parent_ids) and oid in self.repo.odb:
+            self.n_writes_avoided += 1
+            return oid
+        self.objects[oid] = data
+        self.n_bytes_written += len(data)
+        return oid
+
+    def create_branch(self, branch_name, tip, force=False, ref_updates=()):
+        self.write_pack()
+        _create_branch(self.repo, branch_name, tip, force, ref_updates)
+
+    def close(self):
+        self.objects = {}
+
+    @staticmethod
+    def _entry_header(type_code, size):
+        byte = (type_code << 4) | (size & 0x0f)
+        size >>= 4
+        header = bytearray()
+        while size:
+            header.append(byte | 0x80)
+            byte = size & 0x7f
+            size >>= 7
+        header.append(byte)
+        return bytes(header)
+
+    def _pack_and_index_bytes(self):
+        oids = sorted(self.objects, key=lambda oid: oid.raw)
+
+        pack = bytearray(b'PACK' + struct.pack('>II', 2, len(oids)))
+        offsets = []
+        crcs = []
+        for oid in oids:
+            data = self.objects[oid]
+            entry = (self._entry_header(self._pack_type_commit, len(data))
+                     + zlib.compress(data))
+            offsets.append(len(pack))
+            crcs.append(zlib.crc32(entry))
+            pack += entry
+        pack_sha = hashlib.sha1(pack).digest()
+        pack += pack_sha
+
+        fanout = [0] * 256
+        for oid in oids:
+            fanout[oid.raw[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        small_offsets = []
+        large_offsets = []
+        for offset in offsets:
+            if offset < 0x80000000:
+                small_offsets.append(offset)
+            else:
+                small_offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+
+        index = bytearray(b'\377tOc' + struct.pack('>I', 2))
+        index += struct.pack('>256I', *fanout)
+        index += b''.join(oid.raw for oid in oids)
+        index += struct.pack('>{}I'.format(len(oids)), *crcs)
+        index += struct.pack('>{}I'.format(len(oids)), *small_offsets)
+        index += struct.pack('>{}Q'.format(len(large_offsets)), *large_offsets)
+        index += pack_sha
+        index += hashlib.sha1(index).digest()
+
+        return bytes(pack), bytes(index), pack_sha.hex()
+
+    def write_pack(self):
+        """
+        Write all held commits to the repository as one packfile plus index.
+        The index is moved into place last, so that a partially-written pack
+        is never visible to readers.
+        """
+        if not self.objects:
+            return
+        pack, index, name = self._pack_and_index_bytes()
+        pack_dir = os.path.join(self.repo.path, 'objects', 'pack')
+        os.makedirs(pack_dir, exist_ok=True)
+        final_stem = os.path.join(pack_dir, 'pack-{}'.format(name))
+        tmp_paths = []
+        try:
+            for suffix, content in [('.pack', pack), ('.idx', index)]:
+                fd, tmp_path = tempfile.mkstemp(dir=pack_dir, prefix='tmp_dendrify_')
+                tmp_paths.append(tmp_path)
+                with os.fdopen(fd, 'wb') as f_out:
+                    f_out.write(content)
+                    f_out.flush()
+                    os.fsync(f_out.fileno())
+            for suffix, tmp_path in zip(['.pack', '.idx'], tmp_paths):
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, final_stem + suffix)
+        finally:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        self.objects = {}
+
+
+class FastImportOutput:
+    """
+    Instead of writing new commits to the repository, describe them as a
+    ``git fast-import`` stream written to the binary file ``stream``.  Each
+    new commit re-uses its source commit's tree, so the stream needs to be
+    imported into a repository which has those trees.  Commits are referred
+    to by fast-import 'marks', which are returned in place of oids.
+    """
+    writes_to_repository = False
+
+    def __init__(self, repo, branch_name, stream):
+        self.repo = repo
+        self.ref_name = 'refs/heads/{}'.format(branch_name)
+        self.stream = stream
+        self.n_marks = 0
+        self.n_bytes_written = 0
+        self.n_writes_avoided = 0
+
+    @staticmethod
+    def _commit_ish(oid_or_mark):
+        return str(oid_or_mark).encode()
+
+    def write_commit(self, source, message, parent_ids):
+        self.n_marks += 1
+        mark = ':{}'.format(self.n_marks)
+        lines = [b'commit ' + self.ref_name.encode(),
+                 b'mark ' + mark.encode(),
+                 b'author ' + source.author,
+                 b'committer ' + source.committer]
+        if source.encoding is not None:
+            lines.append(b'encoding ' + source.encoding.encode())
+        lines.append(b'data %d' % len(message))
+        chunks = [b'\n'.join(lines), b'\n', message, b'\n']
+        lines = []
+        if parent_ids:
+            lines.append(b'from ' + self._commit_ish(parent_ids[0]))
+        lines.extend(b'merge ' + self._commit_ish(oid) for oid in parent_ids[1:])
+        lines.append(b'M 040000 ' + str(source.tree_id).encode() + b' ""')
+        chunks.append(b'\n'.join(lines) + b'\n\n')
+        self._write(b''.join(chunks))
+        return mark
+
+    def create_branch(self, branch_name, tip, force=False):
+        self._write(b'reset refs/heads/' + branch_name.encode() + b'\n'
+                    + b'from ' + self._commit_ish(tip) + b'\n\n')
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.n_bytes_written += len(data)
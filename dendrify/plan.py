@@ -0,0 +1,165 @@
+# git-dendrify --- transform git histories (plans of new commits)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+import pygit2 as git
+
+from dendrify.ancestry import CommitStore
+
+
+class Plan:
+    """
+    Compact description of the new commits which a dendrify or linearize
+    operation will write, worked out in full before anything is written.
+
+    Node ``i`` of the plan is a new commit made from the source commit
+    ``source_oid(i)``.  Its parents are given as references: a reference
+    ``r >= 0`` is to the new commit of node ``r``; a reference ``r < 0`` is to
+    the existing commit ``external_oids[-1 - r]``, the first of which is always
+    the base commit.  The node's message is the raw (bytes) message of its
+    source commit altered as given by its 'transform'.  Its 'depth' is how
+    deeply nested within sections it is in the dendrified form of the history;
+    for the commit starting a section, this includes that section, and for the
+    commit ending one, it does not.
+
+    Unless it is a section merge, each node's source commit has one parent:
+    the source commit of the previous node, or, for each node ``i`` in
+    ``source_chain_parents`` (always including node 0), the existing commit
+    ``source_chain_parents[i]``.  So a node whose transform is Keep, and whose
+    new parent is that same commit, can re-use its source commit unchanged.
+
+    The data needed to rewrite each node's source commit is held in the
+    CommitStore ``source_commits``, whose entry ``i`` is for node ``i``.
+
+    An incremental dendrify plan also has the ``commit_map`` to update as the
+    plan is applied.  If ``moves_branch`` is true, the plan's branch may
+    already exist, and applying the plan moves it.  A plan for several
+    branches at once lists, in ``extra_branches``, the (name, tip reference)
+    of each branch to create besides ``branch_name``.
+    """
+    Keep, StripStart, StripEnd, AddStart, AddEnd = range(5)
+    transform_names = ['', 'strip <s>', 'strip </s>', 'add <s>', 'add </s>']
+
+    NoParent = -(2 ** 31)
+    BaseRef = -1
+
+    def __init__(self, operation, branch_name, base_oid):
+        self.operation = operation
+        self.branch_name = branch_name
+        self.external_oids = [base_oid]
+        self.source_chain_parents = {0: base_oid}
+        self.raw_source_oids = bytearray()
+        self.first_parents = array('i')
+        self.second_parents = array('i')
+        self.transforms = array('b')
+        self.depths = array('H')
+        self.tip = self.BaseRef
+        self.source_commits = CommitStore()
+        self.commit_map = None
+        self.moves_branch = False
+        self.extra_branches = []
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def external_ref(self, oid):
+        """
+        Reference, for use as a parent, to the existing commit ``oid``.
+        """
+        if oid == self.external_oids[0]:
+            return self.BaseRef
+        self.external_oids.append(oid)
+        return -len(self.external_oids)
+
+    def add_node(self, source_oid, parents, transform, depth):
+        """
+        Add a node, returning a reference to it.  ``parents`` is a sequence of
+        one or two references.
+        """
+        self.raw_source_oids += source_oid.raw
+        self.first_parents.append(parents[0])
+        self.second_parents.append(parents[1] if len(parents) > 1 else self.NoParent)
+        self.transforms.append(transform)
+        self.depths.append(depth)
+        self.tip = len(self) - 1
+        return self.tip
+
+    def source_oid(self, idx):
+        return git.Oid(raw=bytes(self.raw_source_oids[20 * idx : 20 * (idx + 1)]))
+
+    def parent_refs(self, idx):
+        second_parent = self.second_parents[idx]
+        if second_parent == self.NoParent:
+            return [self.first_parents[idx]]
+        return [self.first_parents[idx], second_parent]
+
+    @classmethod
+    def transformed_message(cls, raw_message, transform):
+        if transform == cls.StripStart:
+            return raw_message[3:]
+        if transform == cls.StripEnd:
+            return raw_message[4:]
+        if transform == cls.AddStart:
+            return b'<s>' + raw_message
+        if transform == cls.AddEnd:
+            return b'</s>' + raw_message
+        return raw_message
+
+    @property
+    def max_depth(self):
+        return max(self.depths, default=0)
+
+    @property
+    def n_merges(self):
+        return sum(1 for p in self.second_parents if p != self.NoParent)
+
+    @property
+    def n_bytes(self):
+        """
+        Approximate memory used by the per-node arrays and source commit data.
+        """
+        return (len(self.raw_source_oids) + self.source_commits.n_bytes
+                + sum(a.itemsize * len(a) for a in [self.first_parents,
+                                                   self.second_parents,
+                                                   self.transforms,
+                                                   self.depths]))
+
+    def _ref_text(self, ref):
+        if ref >= 0:
+            return str(ref)
+        if ref == self.BaseRef:
+            return 'base'
+        return str(self.external_oids[-1 - ref])[:12]
+
+    def description_lines(self):
+        """
+        Yield a line of text describing each node, followed by summary lines.
+        """
+        for idx in range(len(self)):
+            parents = ', '.join(self._ref_text(r) for r in self.parent_refs(idx))
+            yield ('{:>6} {}{} <- {:<22} {}'
+                   .format(idx,
+                           '  ' * self.depths[idx],
+                           str(self.source_oid(idx))[:12],
+                           parents,
+                           self.transform_names[self.transforms[idx]]).rstrip())
+        yield ('{} plan for "{}": {} commits, {} merges, max depth {}, tip {}'
+               .format(self.operation, self.branch_name, len(self), self.n_merges,
+                       self.max_depth, self._ref_text(self.tip)))
+        for branch_name, tip in self.extra_branches:
+            yield '  and for "{}": tip {}'.format(branch_name, self._ref_text(tip))
+        yield 'plan size: {} bytes ({:.1f} per commit)'.format(
+            self.n_bytes, self.n_bytes / len(self) if len(self) else 0.0)
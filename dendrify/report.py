@@ -0,0 +1,243 @@
+# git-dendrify --- transform git histories (progress reporting)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import threading
+
+
+def message_subject(raw_message, encoding=None):
+    """
+    First line of the given raw (bytes) commit message, decoded according to
+    ``encoding`` (by default, UTF-8).  Only that line is decoded.
+    """
+    subject = raw_message.split(b'\n', 1)[0]
+    try:
+        return subject.decode(encoding or 'utf-8', errors='replace')
+    except LookupError:
+        return subject.decode('utf-8', errors='replace')
+
+
+def commit_summary(oid, raw_message, depth, encoding=None):
+    """
+    One-line description of a newly-written commit, indented according to its
+    depth within the new history.
+    """
+    return ('{sha1}{indent} * {subject}'
+            .format(indent='  ' * depth,
+                    sha1=str(oid)[:12],
+                    subject=message_subject(raw_message, encoding)[:80]))
+
+
+class Reporter:
+    """
+    Receiver of progress events from a Dendrifier.  This base class ignores
+    all events; subclasses override the methods for those they want.  Events
+    carry raw values, and any text is only made by the reporters which need it.
+
+    The events, in order, for one operation are:
+
+    ``phase_finished('walk', seconds)`` once the source history has been walked;
+
+    ``phase_finished('plan', seconds)`` once the new commits have been planned;
+
+    ``started(operation, n_commits)`` before rewriting ``n_commits`` commits;
+
+    ``section_opened(depth)``, ``commit_written(oid, raw_message, depth,
+    encoding)`` and ``section_closed(depth)`` as the rewrite proceeds, where
+    ``depth`` is the nesting depth within the new history (always zero for a
+    linear one).  The message is given as bytes, in the given encoding (None
+    meaning UTF-8); ``message_subject()`` decodes its first line;
+
+    ``phase_finished('rewrite', seconds)`` and then
+    ``phase_finished('create-branch', seconds)``;
+
+    ``finished()``, which is sent even if the operation fails.
+    """
+    def started(self, operation, n_commits):
+        pass
+
+    def commit_written(self, oid, raw_message, depth, encoding):
+        pass
+
+    def section_opened(self, depth):
+        pass
+
+    def section_closed(self, depth):
+        pass
+
+    def phase_finished(self, name, seconds):
+        pass
+
+    def finished(self):
+        pass
+
+
+class DoNotReport(Reporter):
+    pass
+
+
+class ReportToStdout(Reporter):
+    """
+    Print a line for each commit written.  Lines are collected and written to
+    the stream (by default, standard output) in batches.
+    """
+    def __init__(self, stream=None, n_lines_per_write=256):
+        self.stream = stream
+        self.n_lines_per_write = n_lines_per_write
+        self.lines = []
+
+    def _stream(self):
+        return self.stream if self.stream is not None else sys.stdout
+
+    def __call__(self, msg):
+        self._stream().write(msg + '\n')
+
+    def commit_written(self, oid, raw_message, depth, encoding):
+        self.lines.append(commit_summary(oid, raw_message, depth, encoding))
+        if len(self.lines) >= self.n_lines_per_write:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self._stream().write('\n'.join(self.lines))
+            self.lines = []
+
+    def finished(self):
+        self.flush()
+
+
+class ReportProgress(Reporter):
+    """
+    Show a single progress line, with an estimate of the time remaining, on
+    the stream (by default, standard error).  The line is re-drawn at most
+    once every ``interval`` seconds.
+    """
+    def __init__(self, stream=None, interval=0.5, clock=time.monotonic):
+        self.stream = stream
+        self.interval = interval
+        self.clock = clock
+        self.operation = None
+        self.n_commits = 0
+        self.n_done = 0
+
+    def _stream(self):
+        return self.stream if self.stream is not None else sys.stderr
+
+    def started(self, operation, n_commits):
+        self.operation = operation
+        self.n_commits = n_commits
+        self.n_done = 0
+        self.start_time = self.clock()
+        self.last_draw_time = self.start_time
+
+    def commit_written(self, oid, raw_message, depth, encoding):
+        self.n_done += 1
+        now = self.clock()
+        if now - self.last_draw_time >= self.interval:
+            self.last_draw_time = now
+            self._draw(now)
+
+    def progress_text(self, now):
+        elapsed = now - self.start_time
+        rate = self.n_done / elapsed if elapsed > 0 else 0.0
+        n_remaining = self.n_commits - self.n_done
+        eta = '{:.0f}s'.format(n_remaining / rate) if rate > 0 else '?'
+        return ('{}: {}/{} commits, {:.0f} commits/s, ETA {}'
+                .format(self.operation, self.n_done, self.n_commits, rate, eta))
+
+    def _draw(self, now):
+        self._stream().write('\r' + self.progress_text(now))
+
+    def finished(self):
+        if self.operation is not None:
+            self._draw(self.clock())
+            self._stream().write('\n')
+            self.operation = None
+
+
+class ReportViaLoop(Reporter):
+    """
+    Pass each event on to ``reporter``, but within the asyncio event loop
+    ``loop`` rather than the thread the event came from.  Events reach the
+    reporter in the order they were sent.  Rather than waking the loop for
+    every event, those sent while a delivery is pending join it.
+    """
+    def __init__(self, loop, reporter):
+        self.loop = loop
+        self.reporter = reporter
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def _forward(self, method_name, *args):
+        with self.lock:
+            self.pending.append((method_name, args))
+            if len(self.pending) > 1:
+                return
+        self.loop.call_soon_threadsafe(self._deliver)
+
+    def _deliver(self):
+        with self.lock:
+            events, self.pending = self.pending, []
+        for method_name, args in events:
+            getattr(self.reporter, method_name)(*args)
+
+    def started(self, operation, n_commits):
+        self._forward('started', operation, n_commits)
+
+    def commit_written(self, oid, raw_message, depth, encoding):
+        self._forward('commit_written', oid, raw_message, depth, encoding)
+
+    def section_opened(self, depth):
+        self._forward('section_opened', depth)
+
+    def section_closed(self, depth):
+        self._forward('section_closed', depth)
+
+    def phase_finished(self, name, seconds):
+        self._forward('phase_finished', name, seconds)
+
+    def finished(self):
+        self._forward('finished')
+
+
+class ReportToQueue(Reporter):
+    """
+    Put each event, as a pair (event name, tuple of arguments), on the given
+    queue, such as an ``asyncio.Queue``, for another task to consume.  The
+    last event is always ``('finished', ())``.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def started(self, operation, n_commits):
+        self.queue.put_nowait(('started', (operation, n_commits)))
+
+    def commit_written(self, oid, raw_message, depth, encoding):
+        self.queue.put_nowait(('commit_written', (oid, raw_message, depth, encoding)))
+
+    def section_opened(self, depth):
+        self.queue.put_nowait(('section_opened', (depth,)))
+
+    def section_closed(self, depth):
+        self.queue.put_nowait(('section_closed', (depth,)))
+
+    def phase_finished(self, name, seconds):
+        self.queue.put_nowait(('phase_finished', (name, seconds)))
+
+    def finished(self):
+        self.queue.put_nowait(('finished', ()))
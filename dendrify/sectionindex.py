@@ -0,0 +1,356 @@
+# git-dendrify --- transform git histories (persistent section indexes)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Record the sections of a dendrified branch in a file which can be
+memory-mapped and searched in place, to find which sections contain a
+given commit without walking the history.
+"""
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import pygit2 as git
+
+
+# One section of a history.  Positions count commits after the base, in
+# the history's linear order, from zero.  The section runs from its first
+# commit, at ``start``, to the merge ending it, at ``end``; top-level
+# sections have depth 1.  ``parent`` is the index, within the SectionIndex,
+# of the section directly containing this one, or None.
+Section = namedtuple('Section', 'start end depth merge_oid parent')
+
+
+def _u32_column(buf):
+    """
+    Sequence of the little-endian 32-bit unsigned integers in ``buf``, as a
+    view onto it where possible.
+    """
+    if sys.byteorder == 'little':
+        return memoryview(buf).cast('I')
+    column = array('I', bytes(buf))
+    column.byteswap()
+    return column
+
+
+def _u32_bytes(column):
+    column = array('I', column)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+
+class CommitPositions:
+    """
+    The position of each of a set of commits, held as sorted raw oids, with
+    a fanout table of their counts by first byte as in git's pack indexes and
+    commit-graphs, and a column of positions in the same order.  The oids are
+    in ``raw_oids`` (e.g., a memory-mapped file) from ``raw_oids_start`` on.
+    """
+    def __init__(self, fanout=None, raw_oids=b'', positions=None, raw_oids_start=0):
+        self.fanout = fanout if fanout is not None else array('I', [0] * 256)
+        self.raw_oids = raw_oids
+        self.raw_oids_start = raw_oids_start
+        self.positions = positions if positions is not None else array('I')
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _raw_oid(self, idx):
+        start = self.raw_oids_start + 20 * idx
+        return self.raw_oids[start : start + 20]
+
+    def raw_oids_between(self, start_idx, end_idx):
+        """
+        The raw oids of the commits from ``start_idx`` up to (but excluding)
+        ``end_idx``, concatenated.
+        """
+        return self.raw_oids[self.raw_oids_start + 20 * start_idx
+                             : self.raw_oids_start + 20 * end_idx]
+
+    def position(self, raw_oid):
+        """
+        Position of the commit with the given raw oid, or None if it is not
+        one of these commits.
+        """
+        first_byte = raw_oid[0]
+        lo = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        hi = self.fanout[first_byte]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_oid = self._raw_oid(mid)
+            if mid_oid < raw_oid:
+                lo = mid + 1
+            elif mid_oid > raw_oid:
+                hi = mid
+            else:
+                return self.positions[mid]
+        return None
+
+    def extended(self, new_raw_oids, first_position):
+        """
+        New CommitPositions, with the commits whose raw oids are concatenated
+        in ``new_raw_oids`` added, at positions from ``first_position`` on.
+        The existing commits are copied across in runs, between the places
+        where new ones sort.
+        """
+        n_old = len(self)
+        n_new = len(new_raw_oids) // 20
+
+        def new_raw_oid(idx):
+            return bytes(new_raw_oids[20 * idx : 20 * (idx + 1)])
+
+        oid_pieces = []
+        positions = array('I')
+        n_copied = 0
+        for idx in sorted(range(n_new), key=new_raw_oid):
+            raw_oid = new_raw_oid(idx)
+            lo, hi = n_copied, n_old
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._raw_oid(mid) < raw_oid:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo > n_copied:
+                oid_pieces.append(self.raw_oids_between(n_copied, lo))
+                positions.extend(self.positions[n_copied:lo])
+            oid_pieces.append(raw_oid)
+            positions.append(first_position + idx)
+            n_copied = lo
+        oid_pieces.append(self.raw_oids_between(n_copied, n_old))
+        positions.extend(self.positions[n_copied:n_old])
+
+        fanout = array('I', self.fanout)
+        n_new_by_first_byte = [0] * 256
+        for idx in range(n_new):
+            n_new_by_first_byte[new_raw_oids[20 * idx]] += 1
+        n_new_so_far = 0
+        for byte in range(256):
+            n_new_so_far += n_new_by_first_byte[byte]
+            fanout[byte] += n_new_so_far
+
+        return CommitPositions(fanout, b''.join(oid_pieces), positions)
+
+
+class SectionTable:
+    """
+    The sections of a history, in order of their start positions, as columns
+    of starts, ends, depths, parents, and merge oids.  The columns are either
+    arrays, which ``add_section()`` changes, or read-only views onto a
+    SectionIndex file.
+    """
+    NoParent = 0xffffffff
+
+    def __init__(self, starts=None, ends=None, depths=None, parents=None,
+                 merge_raw_oids=None):
+        self.starts = starts if starts is not None else array('I')
+        self.ends = ends if ends is not None else array('I')
+        self.depths = depths if depths is not None else array('I')
+        self.parents = parents if parents is not None else array('I')
+        self.merge_raw_oids = merge_raw_oids if merge_raw_oids is not None else bytearray()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def copy(self):
+        return SectionTable(array('I', self.starts), array('I', self.ends),
+                            array('I', self.depths), array('I', self.parents),
+                            bytearray(self.merge_raw_oids))
+
+    def section(self, idx):
+        parent = self.parents[idx]
+        return Section(self.starts[idx], self.ends[idx], self.depths[idx],
+                       git.Oid(raw=bytes(self.merge_raw_oids[20 * idx : 20 * (idx + 1)])),
+                       None if parent == self.NoParent else parent)
+
+    def innermost_containing(self, position):
+        """
+        Index of the innermost section containing the commit at
+        ``position``, or None.  Since sections nest, that section is the last
+        to start at or before ``position``, or one of its ancestors.
+        """
+        idx = bisect_right(self.starts, position) - 1
+        while idx >= 0 and self.ends[idx] < position:
+            idx = self.parents[idx]
+            if idx == self.NoParent:
+                return None
+        return idx if idx >= 0 else None
+
+    def add_section(self, start, end, merge_raw_oid):
+        """
+        Add the section from ``start`` to ``end``, which must end after all
+        sections so far.  Those starting within it are nested within it.
+        """
+        idx = bisect_left(self.starts, start)
+        for nested_idx in range(idx, len(self)):
+            self.depths[nested_idx] += 1
+            parent = self.parents[nested_idx]
+            self.parents[nested_idx] = idx if parent == self.NoParent else parent + 1
+        self.starts.insert(idx, start)
+        self.ends.insert(idx, end)
+        self.depths.insert(idx, 1)
+        self.parents.insert(idx, self.NoParent)
+        self.merge_raw_oids[20 * idx : 20 * idx] = merge_raw_oid
+
+
+class SectionIndex:
+    """
+    The sections of the dendrified history from a base commit to a tip, in a
+    memory-mapped file.  Use ``SectionIndex.open()``, which gives None if
+    there is no usable index, and ``Dendrifier.section_index()``, which
+    brings the index of a branch up to date first.
+
+    The file (little-endian throughout) holds a header giving the numbers of
+    commits and sections and the base and tip oids; then the oids of all
+    commits, sorted, with a fanout table of their counts by first byte, and
+    the position of each; then the columns of a SectionTable.  Finding the
+    sections containing a commit takes two binary searches and a walk up
+    the nesting.
+    """
+    _header = struct.Struct('<4sIII20s20s')
+    _signature = b'DSIX'
+    _version = 1
+
+    def __init__(self, path):
+        with open(path, 'rb') as f_in:
+            self.mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (signature, version, n_commits, n_sections,
+             base_raw, tip_raw) = self._header.unpack_from(self.mm, 0)
+            if signature != self._signature or version != self._version:
+                raise ValueError('unsupported section index {}'.format(path))
+            extents = self._extents(n_commits, n_sections)
+            if extents[-1] != len(self.mm):
+                raise ValueError('truncated section index {}'.format(path))
+        except (ValueError, struct.error):
+            self.mm.close()
+            raise
+        self.base_oid = git.Oid(raw=base_raw)
+        self.tip_oid = git.Oid(raw=tip_raw)
+        view = memoryview(self.mm)
+        (fanout_start, oids_start, positions_start, starts_start, ends_start,
+         depths_start, parents_start, merges_start, end) = extents
+        self.commits = CommitPositions(_u32_column(view[fanout_start:oids_start]),
+                                       self.mm,
+                                       _u32_column(view[positions_start:starts_start]),
+                                       oids_start)
+        self.sections = SectionTable(_u32_column(view[starts_start:ends_start]),
+                                     _u32_column(view[ends_start:depths_start]),
+                                     _u32_column(view[depths_start:parents_start]),
+                                     _u32_column(view[parents_start:merges_start]),
+                                     view[merges_start:end])
+        self.views = [view, self.commits.fanout, self.commits.positions,
+                      self.sections.starts, self.sections.ends, self.sections.depths,
+                      self.sections.parents, self.sections.merge_raw_oids]
+
+    @classmethod
+    def _extents(cls, n_commits, n_sections):
+        """
+        Offsets of the parts of a file with the given numbers of commits and
+        sections, followed by its length.
+        """
+        sizes = [256 * 4, 20 * n_commits, 4 * n_commits,
+                 4 * n_sections, 4 * n_sections, 4 * n_sections, 4 * n_sections,
+                 20 * n_sections]
+        extents = [cls._header.size]
+        for size in sizes:
+            extents.append(extents[-1] + size)
+        return extents
+
+    @staticmethod
+    def path_for(repo, branch_name):
+        return os.path.join(repo.path, 'dendrify', 'sections', branch_name)
+
+    @classmethod
+    def open(cls, path):
+        """
+        The SectionIndex stored at ``path``, or None if there is none (or it
+        cannot be read).
+        """
+        try:
+            return cls(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def close(self):
+        for view in self.views:
+            if isinstance(view, memoryview):
+                view.release()
+        self.views = []
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.sections)
+
+    def position(self, oid):
+        """
+        Position of the commit ``oid`` within the history, or None if the
+        history does not include it.
+        """
+        return self.commits.position(oid.raw)
+
+    def section(self, idx):
+        return self.sections.section(idx)
+
+    def sections_containing(self, oid):
+        """
+        List of the Sections containing the commit ``oid``, outermost first,
+        or None if the history does not include it.  A section contains its
+        own first commit and the merge ending it.
+        """
+        position = self.position(oid)
+        if position is None:
+            return None
+        containing = []
+        idx = self.sections.innermost_containing(position)
+        while idx is not None:
+            section = self.section(idx)
+            containing.append(section)
+            idx = section.parent
+        return containing[::-1]
+
+    @classmethod
+    def write(cls, path, base_oid, tip_oid, commits, sections):
+        """
+        Write, to ``path``, the index of the history from ``base_oid`` to
+        ``tip_oid``, with the given CommitPositions and SectionTable.  The file
+        is replaced in one step, so readers see either the old index or the
+        new one.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f_out:
+            f_out.write(cls._header.pack(cls._signature, cls._version,
+                                         len(commits), len(sections),
+                                         base_oid.raw, tip_oid.raw))
+            f_out.write(_u32_bytes(commits.fanout))
+            f_out.write(commits.raw_oids_between(0, len(commits)))
+            for column in [commits.positions, sections.starts, sections.ends,
+                           sections.depths, sections.parents]:
+                f_out.write(_u32_bytes(column))
+            f_out.write(sections.merge_raw_oids)
+        os.replace(tmp_path, path)
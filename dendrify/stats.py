@@ -0,0 +1,89 @@
+# git-dendrify --- transform git histories (timings and counters)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Stats:
+    """
+    Timings and counters accumulated by a Dendrifier over its lifetime.
+
+    Time is attributed to named phases.  Phases may be nested, in which case
+    time spent in the inner phase is not also counted against the outer one.
+    """
+    phase_names = ['walk', 'verify', 'read', 'write', 'create-branch']
+
+    def __init__(self):
+        self.phase_seconds = Counter()
+        self.n_commits_read = 0
+        self.n_commits_written = 0
+        self.n_writes_avoided = 0
+        self.n_bytes_written = 0
+        self.n_refs_updated = 0
+        self.max_section_depth = 0
+        self.merges_verified = Counter()
+        self._phase_stack = []
+        self._phase_start_time = None
+
+    @contextmanager
+    def phase(self, name):
+        now = time.perf_counter()
+        if self._phase_stack:
+            self.phase_seconds[self._phase_stack[-1]] += now - self._phase_start_time
+        self._phase_stack.append(name)
+        self._phase_start_time = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phase_seconds[self._phase_stack.pop(-1)] += now - self._phase_start_time
+            self._phase_start_time = now
+
+    def note_section_depth(self, depth):
+        if depth > self.max_section_depth:
+            self.max_section_depth = depth
+
+    @property
+    def n_trees_compared(self):
+        return sum(self.merges_verified.values())
+
+    def as_dict(self):
+        return {'phase_seconds': {name: self.phase_seconds[name]
+                                  for name in self.phase_names},
+                'commits_read': self.n_commits_read,
+                'commits_written': self.n_commits_written,
+                'writes_avoided': self.n_writes_avoided,
+                'trees_compared': self.n_trees_compared,
+                'merges_verified': {level.name: n
+                                    for level, n in self.merges_verified.items()},
+                'bytes_written': self.n_bytes_written,
+                'refs_updated': self.n_refs_updated,
+                'max_section_depth': self.max_section_depth}
+
+    def as_text(self):
+        lines = ['{:>14}: {:.3f}s'.format(name, self.phase_seconds[name])
+                 for name in self.phase_names]
+        lines.extend('{:>14}: {}'.format(label, value)
+                     for label, value in [('commits read', self.n_commits_read),
+                                          ('commits written', self.n_commits_written),
+                                          ('writes avoided', self.n_writes_avoided),
+                                          ('trees compared', self.n_trees_compared),
+                                          ('bytes written', self.n_bytes_written),
+                                          ('refs updated', self.n_refs_updated),
+                                          ('max depth', self.max_section_depth)])
+        return '\n'.join(lines)
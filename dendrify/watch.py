@@ -0,0 +1,329 @@
+# git-dendrify --- transform git histories (watch daemon)
+# Copyright (C) 2016 Ben North
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keep the results of a set of jobs up to date as their source branches move.
+
+The jobs are given as for a batch run (see ``dendrify.batch``).  The daemon
+runs every job once on starting, and then again whenever its source branch
+changes.  Dendrify jobs are run incrementally, and linearize jobs replace
+their destination branch.  One Dendrifier is kept per repository for the
+life of the daemon, so its repository handle and caches stay warm, and so
+does each dendrify job's commit map, which is only read again if its
+destination branch is moved by something else.
+
+The daemon notices ref updates by watching the repositories' ref files with
+inotify where available, and otherwise by polling.  The watches are added on
+starting, and for each new directory under refs/heads as it appears.
+
+Clients talk to the daemon over a Unix-domain socket.  A client sends one
+line holding a request, and receives one line of JSON in reply.  The requests
+are ``status`` (reply: the state of each job), ``trigger`` (re-run every job
+now; reply: the state of each job afterwards), and ``stop``.  The protocol is
+simple enough that a hook can use any tool which can write to a Unix socket.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import selectors
+
+import dendrify
+from dendrify.core import dendrifier_for_path
+from dendrify.batch import Job, JobResult, result_summary
+
+
+class _InotifyWatcher:
+    """
+    Wake-up source which becomes readable when anything changes in the watched
+    directories.  Uses the Linux inotify interface, via ctypes.
+    """
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _mask = 0x002 | 0x004 | 0x008 | 0x080 | 0x100 | 0x200
+    _IN_CREATE = 0x100
+    _IN_IGNORED = 0x8000
+    _IN_ISDIR = 0x40000000
+    # struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+    _event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        # The directory watched by each watch descriptor, and those watch
+        # descriptors whose new subdirectories are to be watched too.
+        self._directories = {}
+        self._tree_wds = set()
+
+    def fileno(self):
+        return self._fd
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self._mask)
+        if wd >= 0:
+            self._directories[wd] = directory
+        return wd
+
+    def watch(self, directory):
+        self._add_watch(directory)
+
+    def watch_tree(self, root):
+        """
+        Watch ``root`` and every directory below it, including those created
+        later.
+        """
+        for dirpath, _, _ in os.walk(root):
+            wd = self._add_watch(dirpath)
+            if wd >= 0:
+                self._tree_wds.add(wd)
+
+    def drain(self):
+        """
+        Read the pending events, watching any new directory within a tree.
+        """
+        data = b''
+        try:
+            while True:
+                chunk = os.read(self._fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            pass
+        new_directories = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self._event_header.unpack_from(data, offset)
+            offset += self._event_header.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & self._IN_IGNORED:
+                self._directories.pop(wd, None)
+                self._tree_wds.discard(wd)
+            elif (mask & self._IN_CREATE and mask & self._IN_ISDIR
+                  and wd in self._tree_wds):
+                new_directories.append(os.path.join(self._directories[wd],
+                                                    os.fsdecode(name)))
+        for directory in new_directories:
+            self.watch_tree(directory)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _make_watcher():
+    if not sys.platform.startswith('linux'):
+        return None  # pragma nocover
+    try:
+        return _InotifyWatcher()
+    except (OSError, AttributeError):  # pragma nocover
+        return None
+
+
+def default_socket_path(job_file_path):
+    return job_file_path + '.sock'
+
+
+class _JobState:
+    def __init__(self, job):
+        self.job = job
+        self.source_oid = None
+        self.n_runs = 0
+        self.result = None
+
+    def as_dict(self):
+        state = dict(self.job._asdict())
+        state['source_oid'] = self.source_oid
+        state['n_runs'] = self.n_runs
+        if self.result is not None:
+            state['error'] = self.result.error
+            state['n_commits_written'] = self.result.n_commits_written
+            state['seconds'] = self.result.seconds
+        return state
+
+
+class WatchDaemon:
+    """
+    Daemon keeping the results of ``jobs`` up to date, listening for clients
+    on the Unix-domain socket at ``socket_path``.  If ``poll_interval`` is
+    given, or inotify is not available, poll for ref changes that often (in
+    seconds) instead of relying on inotify.
+    """
+    default_poll_interval = 2.0
+
+    def __init__(self, jobs, socket_path, verification=dendrify.Verification.TreeId,
+                 poll_interval=None):
+        self.states = [_JobState(job) for job in jobs]
+        self.socket_path = socket_path
+        self.verification = verification
+        self.dendrifiers = {}
+        self.watcher = None if poll_interval is not None else _make_watcher()
+        self.poll_interval = (poll_interval if poll_interval is not None
+                              else self.default_poll_interval)
+        self.stopping = False
+
+    def _dendrifier(self, repo_path):
+        if repo_path not in self.dendrifiers:
+            dendrifier = dendrifier_for_path(repo_path, verification=self.verification)
+            # Keep each dendrify job's commit map in memory between runs:
+            dendrifier.commit_maps = {}
+            self.dendrifiers[repo_path] = dendrifier
+        return self.dendrifiers[repo_path]
+
+    def _source_oid(self, state):
+        job = state.job
+        try:
+            repo = self._dendrifier(job.repo_path).repo
+            return str(repo.revparse_single(job.source).oid)
+        except (KeyError, ValueError):
+            return None
+
+    def _run(self, state, source_oid):
+        job = state.job
+        t0 = time.perf_counter()
+        try:
+            dendrifier = self._dendrifier(job.repo_path)
+            n_written_before = dendrifier.stats.n_commits_written
+            if job.operation == 'dendrify':
+                dendrifier.dendrify(job.new_branch, job.base, job.source, incremental=True)
+            else:
+                dendrifier.linearize(job.new_branch, job.base, job.source, replace=True)
+            error = None
+            n_commits_written = dendrifier.stats.n_commits_written - n_written_before
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            n_commits_written = 0
+        state.source_oid = source_oid
+        state.n_runs += 1
+        state.result = JobResult(job, error, n_commits_written, time.perf_counter() - t0)
+
+    def run_jobs(self, force=False):
+        """
+        Run each job whose source branch has moved since it was last run, or
+        every job if ``force`` is true.
+        """
+        for state in self.states:
+            source_oid = self._source_oid(state)
+            if force or state.n_runs == 0 or source_oid != state.source_oid:
+                self._run(state, source_oid)
+
+    def status(self):
+        return [state.as_dict() for state in self.states]
+
+    def _watch_refs(self):
+        """
+        Watch the directories whose contents change when a branch of one of
+        the jobs' repositories moves: the git directory, for packed-refs, and
+        everything under refs/heads, including new directories, e.g., for
+        'feature/*' branches.
+        """
+        for repo_path in sorted({state.job.repo_path for state in self.states}):
+            try:
+                git_dir = self._dendrifier(repo_path).repo.path
+            except ValueError:
+                continue
+            self.watcher.watch(git_dir)
+            self.watcher.watch_tree(os.path.join(git_dir, 'refs', 'heads'))
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            try:
+                send_request(self.socket_path, 'status')
+            except OSError:
+                os.unlink(self.socket_path)
+            else:
+                raise ValueError('a watch daemon is already listening on {}'
+                                 .format(self.socket_path))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        return server
+
+    def _handle_client(self, server):
+        conn, _ = server.accept()
+        with conn, conn.makefile('rwb') as f:
+            request = f.readline().decode().strip()
+            if request == 'status':
+                reply = self.status()
+            elif request == 'trigger':
+                self.run_jobs(force=True)
+                reply = self.status()
+            elif request == 'stop':
+                self.stopping = True
+                reply = 'stopping'
+            else:
+                reply = {'error': 'unknown request "{}"'.format(request)}
+            f.write(json.dumps(reply).encode() + b'\n')
+
+    def serve_forever(self):
+        """
+        Run until a client asks the daemon to stop.
+        """
+        server = self._listen()
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(server, selectors.EVENT_READ, self._handle_client)
+            if self.watcher is not None:
+                self._watch_refs()
+                selector.register(self.watcher, selectors.EVENT_READ,
+                                  lambda watcher: watcher.drain())
+            self.run_jobs()
+            while not self.stopping:
+                timeout = None if self.watcher is not None else self.poll_interval
+                for key, _ in selector.select(timeout):
+                    key.data(key.fileobj)
+                if not self.stopping:
+                    self.run_jobs()
+        finally:
+            selector.close()
+            server.close()
+            os.unlink(self.socket_path)
+            if self.watcher is not None:
+                self.watcher.close()
+
+
+def send_request(socket_path, request, timeout=None):
+    """
+    Send ``request`` to the daemon listening on ``socket_path``, and return
+    its decoded reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(socket_path)
+        with conn.makefile('rwb') as f:
+            f.write(request.encode() + b'\n')
+            f.flush()
+            return json.loads(f.readline().decode())
+
+
+def state_summary(state):
+    """
+    One-line description of a job's state, as returned by ``status``.
+    """
+    job = Job(*(state[f] for f in Job._fields))
+    if state['n_runs'] == 0:
+        return 'pending {} {}: {} {}'.format(job.repo_path, job.operation,
+                                             job.new_branch, job.source)
+    result = JobResult(job, state['error'], state['n_commits_written'], state['seconds'])
+    return '{} [source {}, {} runs]'.format(result_summary(result),
+                                           (state['source_oid'] or 'missing')[:12],
+                                           state['n_runs'])
@@ -28,7 +28,7 @@ setup(
     url='https://github.com/bennorth/git-dendrify',
     install_requires=['pygit2>=0.27.1', 'docopt'],
     tests_require=['pytest', 'pytest-raisesregexp'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     entry_points={
         'console_scripts': ['git-dendrify = dendrify.cli:main']},
 )
@@ -14,17 +14,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
 import pytest
 import pygit2 as git
 import time
 import os
-from io import StringIO
+import shutil
+import subprocess
+from io import StringIO, BytesIO
 import sys
+import json
+import asyncio
+import threading
+import socket
+import functools
 import docopt
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import dendrify
 import dendrify.cli
+import dendrify.batch
+import dendrify.watch
 
 @contextmanager
 def temporary_cwd_within_repo(repo):
@@ -57,14 +68,17 @@ def test_empty_repo(empty_repo):
 
 
 def populate_repo(repo, commit_descriptors, branch_name='linear'):
-    sig = dendrify.create_signature(repo)
-
     assert not dendrify.repo_has_branch(repo, 'test-base')
     base_commit = repo[dendrify.create_base(repo, 'test-base').target]
     repo.create_branch(branch_name, base_commit)
+    extend_repo(repo, commit_descriptors, branch_name)
+
+
+def extend_repo(repo, commit_descriptors, branch_name='linear', first_idx=0):
+    sig = dendrify.create_signature(repo)
     ref_name = 'refs/heads/{}'.format(branch_name)
 
-    for idx, cd in enumerate(commit_descriptors):
+    for idx, cd in enumerate(commit_descriptors, start=first_idx):
         parent = repo[repo.lookup_branch(branch_name).target]
         def commit(msg, tree_oid):
             repo.create_commit(ref_name, sig, sig,
@@ -86,6 +100,33 @@ def populate_repo(repo, commit_descriptors, branch_name='linear'):
             tip = repo[repo.lookup_branch(branch_name).target]
             repo.create_branch(cd[1:], tip)
 
+class CollectingReporter(dendrify.Reporter):
+    def __init__(self):
+        self.events = []
+        self.commits_written = []
+
+    def started(self, operation, n_commits):
+        self.events.append(('started', operation, n_commits))
+
+    def commit_written(self, oid, raw_message, depth, encoding):
+        self.commits_written.append(oid)
+        self.events.append(('commit',
+                            raw_message.decode(encoding or 'utf-8', errors='replace'),
+                            depth))
+
+    def section_opened(self, depth):
+        self.events.append(('open', depth))
+
+    def section_closed(self, depth):
+        self.events.append(('close', depth))
+
+    def phase_finished(self, name, seconds):
+        self.events.append(('phase', name))
+
+    def finished(self):
+        self.events.append(('finished',))
+
+
 class TestTransformations:
     def test_base_recreation_caught(self, empty_repo):
         dendrify.create_base(empty_repo, 'test-base')
@@ -145,6 +186,12 @@ class TestTransformations:
         assert plain('<s>hello world') == 'hello world'
         assert plain('</s>hello world') == 'hello world'
 
+    def test_raw_plain_message(self):
+        plain = dendrify.Dendrifier.raw_plain_message_from_tagged
+        assert plain(b'caf\xe9') == b'caf\xe9'
+        assert plain(b'<s>caf\xe9') == b'caf\xe9'
+        assert plain(b'</s>caf\xe9') == b'caf\xe9'
+
     @pytest.mark.parametrize(
         'descrs',
         ['[[..][..]][....]', '[..]..[..][...][..]'],
@@ -157,6 +204,64 @@ class TestTransformations:
                                                 ancestry,
                                                 descrs)
 
+    @pytest.mark.parametrize(
+        'descrs',
+        ['[[..][..]][....]', '[..]..[..][...][..]', '[[[.]]]', '[][[]]'],
+        ids=['nested', 'with-singles', 'deeply-nested', 'empty-sections'])
+    #
+    def test_flattened_ancestry(self, empty_dendrifier, descrs):
+        populate_repo(empty_dendrifier.repo, '.' + descrs)
+        empty_dendrifier.dendrify('dendrified', 'test-base', 'linear')
+        ancestry = empty_dendrifier.flattened_ancestry('test-base', 'dendrified')
+        descr_from_type = {dendrify.CommitType.SectionStart: '[',
+                           dendrify.CommitType.SectionEnd: ']',
+                           dendrify.CommitType.Normal: '.'}
+        assert ''.join(descr_from_type[tp] for tp, _ in ancestry) == '.' + descrs
+
+    def test_flat_ancestry(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '[', '.', ']', ']'])
+        # Commit with a non-ASCII message:
+        extend_repo(repo, ['.'], first_idx=7)
+        linear_tip = repo[repo.lookup_branch('linear').target]
+        sig = dendrify.create_signature(repo)
+        oid = repo.create_commit(None, linear_tip.author, sig, 'Déjà vu 8\n',
+                                 linear_tip.tree_id, [linear_tip.id])
+        repo.lookup_branch('linear').set_target(oid)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+
+        flat = empty_dendrifier.flat_ancestry('develop', 'dendrified')
+        pairs = empty_dendrifier.flattened_ancestry('develop', 'dendrified')
+        assert list(flat) == pairs
+        assert len(flat) == 8
+        assert flat.n_bytes > 21 * 8
+        for idx, (_, oid) in enumerate(pairs):
+            commit = repo[oid]
+            assert flat.commits.fields(idx) == dendrify.output.commit_fields(commit)
+            assert flat.commits.raw_message(idx) == commit.raw_message
+        assert flat.commits.raw_message(7) == 'Déjà vu 8\n'.encode('utf-8')
+
+    def test_linear_ancestry_from_sibling(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.', '.develop', '.'])
+        extend_repo(repo, ['.', '.'], branch_name='develop', first_idx=3)
+        with pytest.raises(ValueError, match='"develop" is not an ancestor of "linear"'):
+            empty_dendrifier.linear_ancestry('develop', 'linear')
+
+    def test_flattened_ancestry_with_fork(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.', '.'])
+        extend_repo(repo, ['.'], branch_name='develop', first_idx=3)
+        # Merge whose parents are not ancestors of each other:
+        sig = dendrify.create_signature(repo)
+        develop_tip = repo.revparse_single('develop')
+        linear_tip = repo.revparse_single('linear')
+        merge_oid = repo.create_commit(None, sig, sig, 'merge', linear_tip.tree_id,
+                                       [develop_tip.id, linear_tip.id])
+        repo.create_branch('forked', repo[merge_oid])
+        with pytest.raises(ValueError, match='unexpected parents of'):
+            empty_dendrifier.flattened_ancestry('test-base', 'forked')
+
     @pytest.mark.parametrize(
         'repo_descr, exp_msgs',
         [(['.', '.', '.develop', '[', '[', '.', ']', ']'],
@@ -261,8 +366,71 @@ class TestTransformations:
         rtrp_msgs = [repo[oid].message for oid in lin_commit_oids_1]
         assert orig_msgs == rtrp_msgs
 
-    def test_linearize_swapped_parents(self, empty_dendrifier):
+    @pytest.mark.parametrize(
+        'verification',
+        [dendrify.Verification.TreeId, dendrify.Verification.FullDiff])
+    #
+    def test_linearize_verification_counts(self, empty_dendrifier, verification):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        empty_dendrifier.verification = verification
+        empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+        assert empty_dendrifier.n_merges_verified == {verification: 2}
+
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    def test_linearize_verification_workers(self, empty_dendrifier, n_workers):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '.', ']', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        empty_dendrifier.verification = dendrify.Verification.FullDiff
+        empty_dendrifier.n_verification_workers = n_workers
+        empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+        assert empty_dendrifier.n_merges_verified == {dendrify.Verification.FullDiff: 3}
+
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    def test_earliest_impure_merge_reported(self, empty_dendrifier, n_workers):
         repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.', '.'])
+        sig = dendrify.create_signature(repo)
+        develop = repo.revparse_single('develop')
+        def commit(msg, tree_id, parents):
+            return repo.create_commit(None, sig, sig, msg, tree_id, parents)
+        # Each merge has its first parent's tree rather than its second's:
+        work_1 = repo.revparse_single('linear~1')
+        merge_1 = commit('merge 1', develop.tree_id, [develop.id, work_1.id])
+        work_2 = repo.revparse_single('linear')
+        work_2 = commit('work 2', work_2.tree_id, [merge_1])
+        merge_2 = commit('merge 2', repo[merge_1].tree_id, [merge_1, work_2])
+        repo.create_branch('dendrified', repo[merge_2])
+        empty_dendrifier.verification = dendrify.Verification.FullDiff
+        empty_dendrifier.n_verification_workers = n_workers
+        with pytest.raises(ValueError, match='expected {} to be pure merge'.format(merge_1)):
+            empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+
+    def test_linearize_swapped_parents_unverified(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.dev', '.', '.', '.'], branch_name='dendrified-0')
+        feature_start_parent = repo.revparse_single('dev')
+        tip = repo.revparse_single('dendrified-0')
+        sig = dendrify.create_signature(repo)
+        merge_oid = repo.create_commit(None, sig, sig, 'swapped merge test',
+                                       tip.tree_id, [tip.oid, feature_start_parent.oid])
+        repo.create_branch('dendrified', repo[merge_oid])
+        empty_dendrifier.verification = dendrify.Verification.Off
+        # Without verification, the wrong structure is still caught:
+        with pytest.raises(ValueError, match='unexpected parents of {}'.format(merge_oid)):
+            empty_dendrifier.linearize('linear', 'dev', 'dendrified')
+        assert not empty_dendrifier.n_merges_verified
+
+    @pytest.mark.parametrize(
+        'verification',
+        [dendrify.Verification.TreeId, dendrify.Verification.FullDiff])
+    #
+    def test_linearize_swapped_parents(self, empty_dendrifier, verification):
+        repo = empty_dendrifier.repo
+        empty_dendrifier.verification = verification
+        empty_dendrifier.n_verification_workers = 2
         # Get repo started then manually create 'swapped' merge; we have to
         # try quite hard to arrange this as git tries quite hard to stop you
         # making that mistake.
@@ -276,6 +444,819 @@ class TestTransformations:
         with pytest.raises(ValueError, match='expected .* to be pure merge'):
             empty_dendrifier.linearize('linear', 'dev', 'dendrified')
 
+    @staticmethod
+    def _object_files(repo):
+        objects_dir = os.path.join(repo.path, 'objects')
+        return {os.path.relpath(os.path.join(dirpath, f), objects_dir)
+                for dirpath, _, filenames in os.walk(objects_dir)
+                for f in filenames}
+
+    def _dendrified_oids(self, repo):
+        develop_oid = repo.lookup_branch('develop').target
+        dendrified_tip_oid = repo.lookup_branch('dendrified').target
+        oids = []
+        for c in repo.walk(dendrified_tip_oid, git.GIT_SORT_TOPOLOGICAL):
+            if c.id == develop_oid: break
+            oids.append(c.id)
+        return oids
+
+    def test_bulk_write(self, empty_dendrifier, tmpdir):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '[', '.', '.', ']', ']', '.'])
+        # Identical copy of the repo, to dendrify via a packfile:
+        repo_2_path = tmpdir.join('repo-2').strpath
+        shutil.copytree(repo.path, repo_2_path)
+
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        exp_oids = self._dendrified_oids(repo)
+
+        dendrifier_2 = dendrify.Dendrifier(repo_2_path, output=dendrify.PackfileOutput)
+        files_before = self._object_files(dendrifier_2.repo)
+        dendrifier_2.dendrify('dendrified', 'develop', 'linear')
+        new_files = self._object_files(dendrifier_2.repo) - files_before
+
+        assert sorted(os.path.splitext(f)[1] for f in new_files) == ['.idx', '.pack']
+        assert self._dendrified_oids(dendrifier_2.repo) == exp_oids
+        assert all(dendrifier_2.repo[oid].read_raw() == repo[oid].read_raw()
+                   for oid in exp_oids)
+
+    @pytest.mark.parametrize('how', ['directly', 'via-cli'])
+    def test_background_write(self, empty_dendrifier, tmpdir, how):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '[', '.', '.', ']', ']', '.'])
+        # Identical copy of the repo, to rewrite writing commits as they are made:
+        repo_2_path = tmpdir.join('repo-2').strpath
+        shutil.copytree(repo.path, repo_2_path)
+        dendrifier_2 = dendrify.Dendrifier(repo_2_path)
+        dendrifier_2.dendrify('dendrified', 'develop', 'linear')
+        dendrifier_2.linearize('linearized', 'develop', 'dendrified')
+
+        if how == 'directly':
+            empty_dendrifier.output = dendrify.BackgroundObjectDatabaseOutput
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+            empty_dendrifier.linearize('linearized', 'develop', 'dendrified')
+        elif how == 'via-cli':
+            with temporary_cwd_within_repo(repo):
+                dendrify.cli.main(_argv=['dendrify', '-q', '--background-write',
+                                         'dendrified', 'develop', 'linear'])
+                dendrify.cli.main(_argv=['linearize', '-q', '--background-write',
+                                         'linearized', 'develop', 'dendrified'])
+        assert self._dendrified_oids(repo) == self._dendrified_oids(dendrifier_2.repo)
+        assert (repo.lookup_branch('linearized').target
+                == dendrifier_2.repo.lookup_branch('linearized').target)
+        assert not any(thread.name == 'dendrify-writer' for thread in threading.enumerate())
+        # The loose objects were written as git would:
+        subprocess.run(['git', 'fsck', '--strict'], cwd=repo.path, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_background_write_error(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '.', ']', '.', '.'])
+
+        class FailingOutput(dendrify.BackgroundObjectDatabaseOutput):
+            n_writes = 0
+
+            @classmethod
+            def _write_object(cls, objects_dir, oid, data):
+                cls.n_writes += 1
+                if cls.n_writes == 3:
+                    raise OSError('disk full')
+                dendrify.BackgroundObjectDatabaseOutput._write_object(objects_dir, oid, data)
+
+        empty_dendrifier.output = FailingOutput
+        with pytest.raises(OSError, match='disk full'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert empty_dendrifier.repo.lookup_branch('dendrified') is None
+        assert not any(thread.name == 'dendrify-writer' for thread in threading.enumerate())
+
+    def test_background_writer_close(self):
+        gate = threading.Event()
+        written = []
+
+        def write(item):
+            gate.wait()
+            written.append(item)
+
+        writer = dendrify.output.BackgroundWriter(write, batch_size=2)
+        for item in range(5):
+            writer.put(item)
+        threading.Timer(0.1, gate.set).start()
+        writer.close()
+        assert not writer.thread.is_alive()
+        # Only the first batch, already being written, was written:
+        assert written == [0, 1]
+
+    @pytest.mark.parametrize('how', ['directly', 'via-cli'])
+    def test_fast_import(self, empty_dendrifier, tmpdir, how):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '[', '.', '.', ']', ']', '.'])
+        repo_2_path = tmpdir.join('repo-2').strpath
+        shutil.copytree(repo.path, repo_2_path)
+
+        stream_path = tmpdir.join('stream.fi').strpath
+        files_before = self._object_files(repo)
+        if how == 'directly':
+            with open(stream_path, 'wb') as stream:
+                empty_dendrifier.output = functools.partial(dendrify.FastImportOutput,
+                                                            stream=stream)
+                empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        elif how == 'via-cli':
+            with temporary_cwd_within_repo(repo):
+                dendrify.cli.main(_argv=['dendrify', '--fast-import={}'.format(stream_path),
+                                         'dendrified', 'develop', 'linear'])
+        assert self._object_files(repo) == files_before
+        assert not dendrify.repo_has_branch(repo, 'dendrified')
+
+        with open(stream_path, 'rb') as stream:
+            subprocess.run(['git', 'fast-import', '--quiet'], stdin=stream,
+                           cwd=repo_2_path, check=True)
+
+        empty_dendrifier.output = dendrify.ObjectDatabaseOutput
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        repo_2 = git.Repository(repo_2_path)
+        assert self._dendrified_oids(repo_2) == self._dendrified_oids(repo)
+
+    @staticmethod
+    def _extend_with_raw_messages(repo, raw_messages_and_encodings):
+        branch = repo.lookup_branch('linear')
+        for raw_message, encoding in raw_messages_and_encodings:
+            tip = repo[branch.target]
+            encoding_args = [encoding] if encoding is not None else []
+            oid = repo.create_commit(None, tip.author, tip.committer, raw_message,
+                                     tip.tree_id, [tip.id], *encoding_args)
+            branch.set_target(oid)
+
+    def test_raw_messages(self, empty_dendrifier, tmpdir):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.'])
+        self._extend_with_raw_messages(repo, [(b'<s>Caf\xe9\n', 'ISO-8859-1'),
+                                              (b'Not UTF-8: \xff\xfe\n', None),
+                                              (b'</s>Fin \xe0 la fin\n', 'ISO-8859-1')])
+        repo_2_path = tmpdir.join('repo-2').strpath
+        shutil.copytree(repo.path, repo_2_path)
+        reporter = CollectingReporter()
+        empty_dendrifier.report = reporter
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+
+        tip = repo[repo.lookup_branch('dendrified').target]
+        assert tip.raw_message == b'Fin \xe0 la fin\n'
+        assert tip.message_encoding == 'ISO-8859-1'
+        section_start = repo[repo[tip.parent_ids[1]].parent_ids[0]]
+        assert section_start.raw_message == b'Caf\xe9\n'
+        assert section_start.message_encoding == 'ISO-8859-1'
+        assert ('commit', 'Fin \xe0 la fin\n', 0) in reporter.events
+
+        empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+        assert (repo.lookup_branch('linear-1').target
+                == repo.lookup_branch('linear').target)
+
+        stream_path = tmpdir.join('stream.fi').strpath
+        with open(stream_path, 'wb') as stream:
+            dendrifier_2 = dendrify.Dendrifier(
+                repo_2_path, output=functools.partial(dendrify.FastImportOutput,
+                                                      stream=stream))
+            dendrifier_2.dendrify('dendrified', 'develop', 'linear')
+        with open(stream_path, 'rb') as stream:
+            subprocess.run(['git', 'fast-import', '--quiet'], stdin=stream,
+                           cwd=repo_2_path, check=True)
+        repo_2 = git.Repository(repo_2_path)
+        assert self._dendrified_oids(repo_2) == self._dendrified_oids(repo)
+
+    def test_bulk_write_nothing_written_on_error(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']', ']'])
+        empty_dendrifier.output = dendrify.PackfileOutput
+        files_before = self._object_files(repo)
+        with pytest.raises(ValueError, match='unexpected section-end'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert self._object_files(repo) == files_before
+
+    @pytest.mark.parametrize('output', [dendrify.ObjectDatabaseOutput,
+                                        dendrify.BackgroundObjectDatabaseOutput,
+                                        dendrify.PackfileOutput])
+    #
+    def test_nothing_written_on_late_error(self, empty_dendrifier, output):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']', '.', '.', ']'])
+        empty_dendrifier.output = output
+        files_before = self._object_files(repo)
+        with pytest.raises(ValueError, match='unexpected section-end'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert self._object_files(repo) == files_before
+
+    def test_dry_run(self, empty_dendrifier):
+        Plan = dendrify.Plan
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.', '[', '.', '[', '.', ']', ']'])
+        files_before = self._object_files(repo)
+        reports = self._collecting_report(empty_dendrifier)
+        plan = empty_dendrifier.dendrify('dendrified', 'develop', 'linear', dry_run=True)
+        assert self._object_files(repo) == files_before
+        assert reports == []
+        assert empty_dendrifier.repo.lookup_branch('dendrified') is None
+
+        assert len(plan) == 7
+        assert plan.source_oid(6) == repo.lookup_branch('linear').target
+        assert [plan.parent_refs(i) for i in range(7)] == [[Plan.BaseRef], [0], [1], [2],
+                                                           [3], [2, 4], [0, 5]]
+        assert list(plan.transforms) == [Plan.Keep, Plan.StripStart, Plan.Keep,
+                                         Plan.StripStart, Plan.Keep, Plan.StripEnd,
+                                         Plan.StripEnd]
+        assert list(plan.depths) == [0, 1, 1, 2, 2, 1, 0]
+        assert plan.tip == 6
+        assert plan.n_merges == 2
+        assert plan.max_depth == 2
+
+        lines = list(plan.description_lines())
+        assert len(lines) == 9
+        assert lines[6].split()[2:] == ['<-', '0,', '5', 'strip', '</s>']
+        assert lines[7] == ('dendrify plan for "dendrified": 7 commits, 2 merges,'
+                            ' max depth 2, tip 6')
+
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        plan = empty_dendrifier.linearize('linear-1', 'develop', 'dendrified',
+                                          dry_run=True)
+        assert self._object_files(repo) != files_before
+        assert empty_dendrifier.repo.lookup_branch('linear-1') is None
+        assert [plan.parent_refs(i) for i in range(7)] == [[Plan.BaseRef], [0], [1], [2],
+                                                           [3], [4], [5]]
+        assert list(plan.transforms) == [Plan.Keep, Plan.AddStart, Plan.Keep,
+                                         Plan.AddStart, Plan.Keep, Plan.AddEnd,
+                                         Plan.AddEnd]
+        assert list(plan.depths) == [0, 1, 1, 2, 2, 1, 0]
+
+    def test_incremental_dry_run(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        map_path = dendrify.CommitMap.path_for(repo, 'dendrified')
+        with open(map_path, 'rb') as f_in:
+            map_before = f_in.read()
+
+        extend_repo(repo, ['.', ']'], first_idx=3)
+        plan = empty_dendrifier.dendrify('dendrified', 'develop', 'linear',
+                                         incremental=True, dry_run=True)
+        dendrified_tip = repo.lookup_branch('dendrified').target
+        assert [plan.parent_refs(i) for i in range(2)] == [[-2], [dendrify.Plan.BaseRef, 0]]
+        assert plan.external_oids[1] == dendrified_tip
+        with open(map_path, 'rb') as f_in:
+            assert f_in.read() == map_before
+
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        empty_dendrifier.dendrify('dendrified-in-one-go', 'develop', 'linear')
+        assert (repo.lookup_branch('dendrified').target
+                == repo.lookup_branch('dendrified-in-one-go').target)
+
+    @staticmethod
+    def _collecting_report(dendrifier):
+        reporter = CollectingReporter()
+        dendrifier.report = reporter
+        return reporter.commits_written
+
+    @pytest.mark.parametrize(
+        'descrs_0, descrs_1',
+        [(['.', '[', '.', ']'], ['.', '[', '.', ']']),
+         (['[', '[', '.'], ['.', ']', '.', ']']),
+         ([], ['[', '.', ']'])],
+        ids=['closed-sections', 'open-sections', 'initially-empty'])
+    #
+    def test_incremental_dendrify(self, empty_dendrifier, descrs_0, descrs_1):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop'] + descrs_0)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+
+        extend_repo(repo, descrs_1, first_idx=len(descrs_0) + 1)
+        reports = self._collecting_report(empty_dendrifier)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        assert len(reports) == len(descrs_1)
+
+        empty_dendrifier.dendrify('dendrified-in-one-go', 'develop', 'linear')
+        assert (repo.lookup_branch('dendrified').target
+                == repo.lookup_branch('dendrified-in-one-go').target)
+
+    def test_incremental_dendrify_after_rewrite(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '.keep', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+
+        # Discard the last two commits and replace them:
+        repo.lookup_branch('linear').set_target(repo.lookup_branch('keep').target)
+        extend_repo(repo, ['.', '.', ']'], first_idx=10)
+        reports = self._collecting_report(empty_dendrifier)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        assert len(reports) == 3
+
+        empty_dendrifier.dendrify('dendrified-in-one-go', 'develop', 'linear')
+        assert (repo.lookup_branch('dendrified').target
+                == repo.lookup_branch('dendrified-in-one-go').target)
+
+        # And nothing to do if nothing has changed:
+        del reports[:]
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        assert reports == []
+        assert (repo.lookup_branch('dendrified').target
+                == repo.lookup_branch('dendrified-in-one-go').target)
+
+    def test_incremental_dendrify_no_map(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        with pytest.raises(ValueError, match='"dendrified" exists but has no commit map'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+
+    def test_incremental_dendrify_moved_branch(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        repo.lookup_branch('dendrified').set_target(repo.lookup_branch('develop').target)
+        with pytest.raises(ValueError, match='"dendrified" has moved since it was made'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+
+    def test_incremental_dendrify_different_base(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.develop-1', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        with pytest.raises(ValueError, match='"dendrified" was made from a different base'):
+            empty_dendrifier.dendrify('dendrified', 'develop-1', 'linear', incremental=True)
+
+    def test_incremental_dendrify_needs_repository(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.output = functools.partial(dendrify.FastImportOutput,
+                                                    stream=None)
+        with pytest.raises(ValueError, match='needs commits to be written'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+
+    def test_oid_map(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        oid_map = empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        linear_oids = empty_dendrifier.linear_ancestry('develop', 'linear')
+        dendrified_oids = [oid for _, oid
+                           in empty_dendrifier.flattened_ancestry('develop', 'dendrified')]
+        assert oid_map == dict(zip(linear_oids, dendrified_oids))
+
+        oid_map = empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+        assert oid_map == dict(zip(dendrified_oids, linear_oids))
+
+    def test_incremental_oid_map(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        extend_repo(repo, ['.'], first_idx=4)
+        oid_map = empty_dendrifier.dendrify('dendrified', 'develop', 'linear',
+                                            incremental=True)
+        assert len(oid_map) == 4
+        tip_oid = repo.lookup_branch('linear').target
+        assert oid_map[tip_oid] == repo.lookup_branch('dendrified').target
+        # The earlier records have not been read:
+        assert oid_map.all is None
+        linear_oids = empty_dendrifier.linear_ancestry('develop', 'linear')
+        assert set(oid_map) == set(linear_oids)
+
+    def test_commit_map_open_sections(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '[', '.', '[', '.', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        map_path = dendrify.CommitMap.path_for(repo, 'dendrified')
+        full_map = dendrify.CommitMap.load(map_path)
+        tail_map = dendrify.CommitMap.load_tail(map_path)
+        assert len(tail_map) == len(full_map) == 10
+        assert tail_map.source_oids == full_map.source_oids[-1:]
+
+        # Replay the records to find the state after each:
+        tip = full_map.base_oid
+        section_start_ids = []
+        for n_records in range(len(full_map) + 1):
+            assert full_map.state_after(n_records) == (tip, section_start_ids)
+            if n_records == len(full_map):
+                break
+            kind = full_map.kinds[n_records]
+            if kind == dendrify.CommitMap.SectionStart:
+                section_start_ids = section_start_ids + [tip]
+            elif kind == dendrify.CommitMap.SectionEnd:
+                section_start_ids = section_start_ids[:-1]
+            tip = full_map.dest_oids[n_records]
+        assert len(section_start_ids) == 2
+        assert tail_map.state_after(len(tail_map)) == (tip, section_start_ids)
+
+    def test_incremental_dendrify_kept_commit_map(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.commit_maps = {}
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        map_path = dendrify.CommitMap.path_for(repo, 'dendrified')
+        kept_map = empty_dendrifier.commit_maps[map_path]
+
+        extend_repo(repo, ['[', '.'], first_idx=4)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        assert empty_dendrifier.commit_maps[map_path] is kept_map
+        assert len(kept_map) == 5
+
+        # Once something else moves the branch, the map is read again:
+        extend_repo(repo, [']'], first_idx=6)
+        dendrify.Dendrifier(repo.path).dendrify('dendrified', 'develop', 'linear',
+                                                incremental=True)
+        extend_repo(repo, ['.'], first_idx=7)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        assert empty_dendrifier.commit_maps[map_path] is not kept_map
+        assert empty_dendrifier.verify('develop', 'linear', 'dendrified') is None
+
+        # A failed update does not keep the map:
+        repo.lookup_branch('dendrified').set_target(repo.lookup_branch('develop').target)
+        with pytest.raises(ValueError, match='"dendrified" has moved since it was made'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        assert map_path not in empty_dendrifier.commit_maps
+
+    @staticmethod
+    def _create_tags(repo):
+        sig = dendrify.create_signature(repo)
+        tagged = repo[repo.lookup_branch('linear').target].parents[0]
+        repo.create_reference('refs/tags/light', tagged.id)
+        repo.create_reference('refs/heads/feature', tagged.id)
+        repo.create_reference('refs/notes/untouched', tagged.id)
+        repo.create_reference('refs/tags/at-base', repo.lookup_branch('develop').target)
+        message = ('Release\n-----BEGIN PGP SIGNATURE-----\n\nxyzzy\n'
+                   '-----END PGP SIGNATURE-----\n')
+        repo.create_tag('annotated', tagged.id, git.GIT_OBJ_COMMIT, sig, message)
+        return tagged.id
+
+    @pytest.mark.parametrize('output', [dendrify.ObjectDatabaseOutput,
+                                        dendrify.BackgroundObjectDatabaseOutput,
+                                        dendrify.PackfileOutput])
+    def test_update_refs(self, empty_dendrifier, output):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '.', ']'])
+        tagged_oid = self._create_tags(repo)
+        empty_dendrifier.output = output
+        oid_map = empty_dendrifier.dendrify('dendrified', 'develop', 'linear',
+                                            update_refs=['refs/tags/*', 'refs/heads/f*'])
+        new_oid = oid_map[tagged_oid]
+        assert repo.lookup_reference('refs/tags/light').target == new_oid
+        assert repo.lookup_reference('refs/heads/feature').target == new_oid
+        assert repo.lookup_reference('refs/notes/untouched').target == tagged_oid
+        assert (repo.lookup_reference('refs/tags/at-base').target
+                == repo.lookup_branch('develop').target)
+        tag = repo[repo.lookup_reference('refs/tags/annotated').target]
+        assert tag.name == 'annotated'
+        assert tag.target == new_oid
+        assert tag.message == 'Release\n'
+        assert tag.tagger.name == 'J.R. Hacker'
+        assert empty_dendrifier.stats.n_refs_updated == 3
+
+    def test_update_refs_atomic(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '.', ']'])
+        tagged_oid = self._create_tags(repo)
+        # Another process holds the lock on this ref:
+        with open(os.path.join(repo.path, 'refs', 'tags', 'light.lock'), 'wb'):
+            pass
+        with pytest.raises(ValueError, match='could not update refs'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear',
+                                      update_refs=['refs/*'])
+        assert repo.lookup_branch('dendrified') is None
+        assert repo.lookup_reference('refs/heads/feature').target == tagged_oid
+
+    def test_update_refs_needs_repository(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.output = functools.partial(dendrify.FastImportOutput,
+                                                    stream=None)
+        with pytest.raises(ValueError, match='needs commits to be written'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear',
+                                      update_refs=['refs/tags/*'])
+
+    def test_verify(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '[', '.', ']', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert empty_dendrifier.verify('develop', 'linear', 'dendrified') is None
+
+    @staticmethod
+    def _amend_tip(repo, branch_name, **kwargs):
+        tip = repo[repo.lookup_branch(branch_name).target]
+        fields = {'author': tip.author, 'message': tip.message, 'tree': tip.tree_id}
+        fields.update(kwargs)
+        sig = dendrify.create_signature(repo)
+        new_oid = repo.create_commit(None, fields['author'], sig, fields['message'],
+                                     fields['tree'], tip.parent_ids)
+        repo.lookup_branch(branch_name).set_target(new_oid)
+
+    @pytest.mark.parametrize(
+        'amendment, exp_index, exp_reason',
+        [({'message': 'Work item 6 (edited)'}, 6, 'messages differ'),
+         ({'tree': 'develop'}, 6, 'trees differ'),
+         ({'author': git.Signature('A.N. Other', 'other@example.com', 0)},
+          6, 'authors differ'),
+         ({'message': '</s>Work item 6'}, 6,
+          'linear commit is a section end but dendrified commit is a normal commit'),
+         ('extend', 7, 'dendrified history ends first'),
+         ('truncate', 6, 'linear history ends first')])
+    def test_verify_divergence(self, empty_dendrifier, amendment, exp_index, exp_reason):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '[', '.', ']', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        if amendment == 'extend':
+            extend_repo(repo, ['.'], first_idx=7)
+        elif amendment == 'truncate':
+            tip = repo[repo.lookup_branch('linear').target]
+            repo.lookup_branch('linear').set_target(tip.parent_ids[0])
+        else:
+            if amendment.get('tree') == 'develop':
+                amendment['tree'] = repo.revparse_single('develop').tree_id
+            self._amend_tip(repo, 'linear', **amendment)
+        divergence = empty_dendrifier.verify('develop', 'linear', 'dendrified')
+        assert divergence.index == exp_index
+        assert divergence.reason == exp_reason
+        if amendment != 'truncate':
+            assert divergence.linear_oid == repo.lookup_branch('linear').target
+        if amendment != 'extend':
+            assert divergence.dendrified_oid == repo.lookup_branch('dendrified').target
+
+    @staticmethod
+    def _retag_branch(repo, branch_name, new_branch_name, tags):
+        # Copy the history of branch_name since develop, setting the magic
+        # string of the commit at each index in tags (an empty string
+        # removing it):
+        parent = repo.revparse_single('develop')
+        oids = dendrify.Dendrifier(repo.path).linear_ancestry('develop', branch_name)
+        for idx, oid in enumerate(oids):
+            commit = repo[oid]
+            message = commit.message
+            if idx in tags:
+                message = tags[idx] + re.sub('^</?s>', '', message)
+            parent = repo[repo.create_commit(None, commit.author, commit.committer, message,
+                                             commit.tree_id, [parent.id])]
+        repo.create_branch(new_branch_name, parent)
+
+    @pytest.mark.parametrize(
+        'linear_descriptors, tags, exp_index, exp_reason',
+        [(['.', '.', '.'], {0: '<s>', 2: '</s>'}, 2,
+          'linear commit is a section end but dendrified commit is a normal commit'),
+         (['.', '.', '.'], {0: '<s>'}, 0,
+          'linear commit is a section start but dendrified commit is a normal commit'),
+         (['[', '.', ']', '.'], {0: '', 2: ''}, 2,
+          'linear commit is a normal commit but dendrified commit is a section end'),
+         (['[', '.', '[', '.', ']', '.', ']'], {0: '', 1: '<s>'}, 0,
+          'linear commit is a normal commit but dendrified commit is a section start'),
+         (['[', '.', '[', '.', ']', '.', ']'], {2: ''}, 2,
+          'linear commit is a normal commit but dendrified commit is a section start'),
+         (['[', '.', '[', '.', ']', '.', ']'], {3: '<s>'}, 4,
+          'linear and dendrified sections start at different commits')])
+    def test_verify_section_mismatch(self, empty_dendrifier, linear_descriptors, tags,
+                                     exp_index, exp_reason):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop'] + linear_descriptors)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        self._retag_branch(repo, 'linear', 'linear-2', tags)
+        divergence = empty_dendrifier.verify('develop', 'linear-2', 'dendrified')
+        assert divergence.index == exp_index
+        assert divergence.reason == exp_reason
+
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    def test_verify_impure_merge(self, empty_dendrifier, n_workers):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']', '.', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        # Replace the second merge by one with a different tree:
+        merge = repo.revparse_single('dendrified')
+        impure_oid = repo.create_commit(None, merge.author, merge.committer, merge.message,
+                                        repo.revparse_single('develop').tree_id,
+                                        merge.parent_ids)
+        repo.lookup_branch('dendrified').set_target(impure_oid)
+        dendrifier = dendrify.Dendrifier(repo.path,
+                                         verification=dendrify.Verification.FullDiff,
+                                         n_verification_workers=n_workers)
+        divergence = dendrifier.verify('develop', 'linear', 'dendrified')
+        assert divergence == (6, repo.lookup_branch('linear').target, impure_oid,
+                              'expected {} to be pure merge'.format(impure_oid))
+
+    def test_verify_unexpected_parents(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        # Make the final commit a merge of the section's last commit:
+        tip = repo.revparse_single('dendrified')
+        section_end = repo[tip.parent_ids[0]]
+        bad_oid = repo.create_commit(None, tip.author, tip.committer, tip.message,
+                                     tip.tree_id, section_end.parent_ids[::-1])
+        repo.lookup_branch('dendrified').set_target(bad_oid)
+        divergence = empty_dendrifier.verify('develop', 'linear', 'dendrified')
+        assert divergence.index == 2
+        assert divergence.reason == 'unexpected parents of {}'.format(bad_oid)
+
+    @staticmethod
+    def _outline_shape(lines):
+        # Drop the sha1 and any magic string, keeping indentation and subject:
+        return [re.sub(r'^[0-9a-f]{12}', '', line).replace('<s>', '').replace('</s>', '')
+                for line in lines]
+
+    def test_outline(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '[', '.', ']', '.', ']', '.'])
+        report_stream = StringIO()
+        empty_dendrifier.report = dendrify.ReportToStdout(report_stream)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        written_lines = report_stream.getvalue().splitlines()
+
+        outline = list(empty_dendrifier.outline('develop', 'dendrified'))
+        assert outline == written_lines[::-1]
+        linear_outline = list(empty_dendrifier.outline('develop', 'linear'))
+        assert self._outline_shape(linear_outline) == self._outline_shape(outline)
+
+    @pytest.mark.parametrize(
+        'max_depth, exp_shape',
+        [(0, [' * Work item 8', ' * Finish work 7 [...]']),
+         (1, [' * Work item 8', ' * Finish work 7', '   * Work item 6',
+              '   * Finish work 5 [...]', '   * Work item 2', '   * Start work 1'])])
+    def test_outline_folding(self, empty_dendrifier, max_depth, exp_shape):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', '[', '.', ']', '.', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        for branch_name in ['dendrified', 'linear']:
+            dendrifier = dendrify.Dendrifier(repo.path)
+            outline = list(dendrifier.outline('develop', branch_name, max_depth))
+            assert self._outline_shape(outline) == exp_shape
+            if branch_name == 'dendrified':
+                # Folded commits are not read:
+                assert dendrifier.stats.n_commits_read == len(exp_shape)
+
+    def test_outline_streams(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.', '.develop', '.'], branch_name='linear')
+        extend_repo(repo, ['.'], branch_name='develop', first_idx=3)
+        lines = empty_dendrifier.outline('develop', 'linear')
+        assert next(lines).endswith('* Work item 2')
+        with pytest.raises(ValueError, match='"develop" is not an ancestor of "linear"'):
+            list(lines)
+
+    @pytest.mark.parametrize(
+        'descrs, exp_msg',
+        [(['[', ']', '[', '.'], 'unexpected section-start'),
+         (['.', ']'], 'section-end with no section-start')])
+    def test_outline_bad_markers(self, empty_dendrifier, descrs, exp_msg):
+        populate_repo(empty_dendrifier.repo, ['.develop'] + descrs)
+        with pytest.raises(ValueError, match=exp_msg):
+            list(empty_dendrifier.outline('develop', 'linear'))
+
+    @staticmethod
+    def _make_topic_branches(repo):
+        populate_repo(repo, ['.develop', '[', '.', '.fork-a', '.', ']', '.fork-b'],
+                      branch_name='linear/main')
+        repo.create_branch('linear/a', repo.revparse_single('fork-a'))
+        extend_repo(repo, ['.', ']', '.'], branch_name='linear/a', first_idx=10)
+        repo.create_branch('linear/b', repo.revparse_single('fork-b'))
+        extend_repo(repo, ['[', '.', ']'], branch_name='linear/b', first_idx=20)
+        repo.create_branch('linear/c', repo.revparse_single('fork-a'))
+        return [('tree/' + name, 'linear/' + name) for name in ['a', 'b', 'c', 'main']]
+
+    def test_dendrify_many(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        branch_names = self._make_topic_branches(repo)
+        reports = self._collecting_report(empty_dendrifier)
+        oid_map = empty_dendrifier.dendrify_many('develop', branch_names)
+        # Each commit of the union of the histories is walked and rewritten once:
+        assert len(oid_map) == 12
+        assert len(reports) == 12
+        assert empty_dendrifier.stats.n_commits_read == 12
+        assert empty_dendrifier.stats.n_commits_written == 12
+
+        for dendrified, linear in branch_names:
+            single = 'single-' + dendrified
+            dendrify.Dendrifier(repo.path).dendrify(single, 'develop', linear)
+            assert (repo.lookup_branch(dendrified).target
+                    == repo.lookup_branch(single).target)
+
+    def test_dendrify_many_dry_run(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        branch_names = self._make_topic_branches(repo)
+        plan = empty_dendrifier.dendrify_many('develop', branch_names, dry_run=True)
+        lines = list(plan.description_lines())
+        assert lines[-5].startswith('dendrify plan for "tree/a": 12 commits,')
+        assert lines[-4:-1] == ['  and for "tree/b": tip 11',
+                                '  and for "tree/c": tip 2',
+                                '  and for "tree/main": tip 8']
+        assert repo.lookup_branch('tree/a') is None
+
+    def test_dendrify_many_errors(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        branch_names = self._make_topic_branches(repo)
+        extend_repo(repo, [']'], branch_name='linear/main', first_idx=30)
+        n_objects_before = len(list(repo.odb))
+        with pytest.raises(ValueError, match='unexpected section-end'):
+            empty_dendrifier.dendrify_many('develop', branch_names)
+        assert len(list(repo.odb)) == n_objects_before
+        assert repo.lookup_branch('tree/a') is None
+        with pytest.raises(ValueError, match='"tree/a" given more than once'):
+            empty_dendrifier.dendrify_many('develop', branch_names[:1] * 2)
+        with pytest.raises(ValueError, match='no branches to dendrify'):
+            empty_dendrifier.dendrify_many('develop', [])
+
+    def test_report_events(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        reporter = CollectingReporter()
+        empty_dendrifier.report = reporter
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert reporter.events == [('phase', 'walk'),
+                                   ('phase', 'plan'),
+                                   ('started', 'dendrify', 3),
+                                   ('open', 1),
+                                   ('commit', 'Start work 1', 1),
+                                   ('commit', 'Work item 2', 1),
+                                   ('close', 1),
+                                   ('commit', 'Finish work 3', 0),
+                                   ('phase', 'rewrite'),
+                                   ('phase', 'create-branch'),
+                                   ('finished',)]
+
+        del reporter.events[:]
+        empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+        assert reporter.events == [('phase', 'walk'),
+                                   ('phase', 'plan'),
+                                   ('started', 'linearize', 3),
+                                   ('open', 1),
+                                   ('commit', '<s>Start work 1', 0),
+                                   ('commit', 'Work item 2', 0),
+                                   ('close', 1),
+                                   ('commit', '</s>Finish work 3', 0),
+                                   ('phase', 'rewrite'),
+                                   ('phase', 'create-branch'),
+                                   ('finished',)]
+
+    def test_report_finished_on_error(self, empty_dendrifier):
+        populate_repo(empty_dendrifier.repo, ['.develop', ']'])
+        reporter = CollectingReporter()
+        empty_dendrifier.report = reporter
+        with pytest.raises(ValueError, match='unexpected section-end'):
+            empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert reporter.events[-1] == ('finished',)
+
+    def test_stats(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '.', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        empty_dendrifier.linearize('linear-1', 'develop', 'dendrified')
+        stats = empty_dendrifier.stats
+        assert stats.n_commits_read == 14
+        # The round trip re-creates the original linear commits, which exist:
+        assert stats.n_commits_written == 7
+        assert stats.n_writes_avoided == 7
+        assert stats.n_trees_compared == 2
+        assert stats.max_section_depth == 2
+        new_oids = self._dendrified_oids(repo)
+        exp_n_bytes = sum(len(repo[oid].read_raw()) for oid in new_oids)
+        assert stats.n_bytes_written == exp_n_bytes
+        assert all(stats.phase_seconds[name] > 0.0
+                   for name in ['walk', 'verify', 'read', 'write', 'create-branch'])
+
+    @pytest.mark.parametrize('output', [dendrify.ObjectDatabaseOutput,
+                                        dendrify.BackgroundObjectDatabaseOutput,
+                                        dendrify.PackfileOutput])
+    def test_existing_commits_not_rewritten(self, empty_dendrifier, output):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.', '.', '[', '.', ']', '.'])
+        empty_dendrifier.output = output
+        oid_map = empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        stats = empty_dendrifier.stats
+        # The commits before the first section are re-used as they are:
+        linear_oids = empty_dendrifier.linear_ancestry('develop', 'linear')
+        assert [oid_map[oid] == oid for oid in linear_oids] == [True, True] + [False] * 4
+        assert stats.n_commits_written == 4
+        assert stats.n_writes_avoided == 2
+
+        n_objects_before = len(list(repo.odb))
+        empty_dendrifier.dendrify('dendrified-2', 'develop', 'linear')
+        assert stats.n_commits_written == 4
+        assert stats.n_writes_avoided == 8
+        assert (repo.lookup_branch('dendrified-2').target
+                == repo.lookup_branch('dendrified').target)
+        empty_dendrifier.linearize('linear-2', 'develop', 'dendrified')
+        assert stats.n_commits_written == 4
+        assert stats.n_writes_avoided == 14
+        assert (repo.lookup_branch('linear-2').target
+                == repo.lookup_branch('linear').target)
+        assert len(list(repo.odb)) == n_objects_before
+
+    def test_fast_import_does_not_reuse_commits(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '.', '[', '.', ']'])
+        stream = BytesIO()
+        empty_dendrifier.output = functools.partial(dendrify.FastImportOutput,
+                                                    stream=stream)
+        oid_map = empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        assert sorted(oid_map.values()) == [':1', ':2', ':3', ':4']
+        assert empty_dendrifier.stats.n_writes_avoided == 0
+
+    def test_stats_nested_phases(self):
+        stats = dendrify.Stats()
+        with stats.phase('walk'):
+            time.sleep(0.02)
+            with stats.phase('verify'):
+                time.sleep(0.05)
+        assert stats.phase_seconds['verify'] >= 0.05
+        assert 0.02 <= stats.phase_seconds['walk'] < stats.phase_seconds['verify']
+
     def test_wrong_nesting(self, empty_dendrifier):
         repo = empty_dendrifier.repo
         populate_repo(repo, ['.develop', '.', '.', ']'])
@@ -318,20 +1299,899 @@ class TestCommandLine:
         finally:
             sys.stdout = saved_stdout
 
+    def test_buffered_reporting(self):
+        stream = StringIO()
+        reporter = dendrify.ReportToStdout(stream, n_lines_per_write=2)
+        reporter.commit_written('0123456789abcdef', b'hello\nworld', 0, None)
+        assert stream.getvalue() == ''
+        reporter.commit_written('fedcba9876543210', b'goodbye', 1, None)
+        assert stream.getvalue() == ('0123456789ab * hello\n'
+                                     'fedcba987654   * goodbye\n')
+        reporter.commit_written('0000000000000000', b'caf\xe9\n\xff', 0, 'ISO-8859-1')
+        reporter.finished()
+        assert stream.getvalue().endswith('000000000000 * caf\xe9\n')
+
+    def test_progress_reporting(self):
+        stream = StringIO()
+        now = [100.0]
+        reporter = dendrify.ReportProgress(stream, interval=1.0, clock=lambda: now[0])
+        reporter.started('dendrify', 10)
+        now[0] = 100.5
+        reporter.commit_written('0123456789abcdef', b'hello', 0, None)
+        assert stream.getvalue() == ''
+        now[0] = 102.0
+        reporter.commit_written('0123456789abcdef', b'hello', 0, None)
+        assert stream.getvalue() == '\rdendrify: 2/10 commits, 1 commits/s, ETA 8s'
+        reporter.finished()
+        assert stream.getvalue().endswith('\n')
+
     def test_no_repo_found(self, tmpdir):
         subdir = os.path.join(tmpdir.strpath, 'not-a-git-repo')
         os.mkdir(subdir)
         exp_msg = 'could not find git repo starting from {}'.format(subdir)
         with pytest.raises(ValueError, match=exp_msg):
-            dendrify.cli.dendrifier_for_path(subdir, tmpdir.strpath)
+            dendrify.dendrifier_for_path(subdir, tmpdir.strpath)
 
     def test_construct_dendrifier(self, empty_repo):
         repo_top = os.path.realpath(os.path.join(empty_repo.path, '..'))
         subdir = os.path.join(repo_top, 'foo', 'bar', 'baz')
         os.makedirs(subdir)
-        dendrifier = dendrify.cli.dendrifier_for_path(subdir)
+        dendrifier = dendrify.dendrifier_for_path(subdir)
+        assert dendrifier.repo.path == empty_repo.path
+        dendrifier = dendrify.Dendrifier(subdir)
         assert dendrifier.repo.path == empty_repo.path
 
+    @pytest.mark.parametrize('argv, exp_output_start',
+                             [(['--version'], 'git-dendrify '),
+                              (['--help'], 'git-dendrify\n\nUsage:')])
+    def test_fast_start(self, argv, exp_output_start):
+        # In a fresh interpreter, these must not import pygit2 or docopt:
+        code = ('import sys, dendrify.cli; dendrify.cli.main();'
+                ' assert "pygit2" not in sys.modules, "pygit2";'
+                ' assert "docopt" not in sys.modules, "docopt"')
+        source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, '-c', code] + argv, cwd=source_dir,
+                                check=True, stdout=subprocess.PIPE).stdout.decode()
+        assert output.startswith(exp_output_start)
+
+    @pytest.mark.parametrize(
+        'name, exp_verification',
+        [('none', dendrify.Verification.Off),
+         ('tree-id', dendrify.Verification.TreeId),
+         ('full', dendrify.Verification.FullDiff)])
+    #
+    def test_verification_option(self, empty_repo, name, exp_verification):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['dendrify', '-q', 'dendrified', 'develop', 'linear'])
+            dendrify.cli.main(_argv=['linearize', '-q', '--verify={}'.format(name),
+                                     'linear-1', 'develop', 'dendrified'])
+        assert empty_repo.lookup_branch('linear-1') is not None
+        assert dendrify.cli.verification_from_name[name] == exp_verification
+
+    def test_incremental_option(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        argv = ['dendrify', '-q', '--incremental', 'dendrified', 'develop', 'linear']
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=argv)
+            extend_repo(empty_repo, ['.'], first_idx=4)
+            dendrify.cli.main(_argv=argv)
+        tip = empty_repo[empty_repo.lookup_branch('dendrified').target]
+        assert tip.message == 'Work item 4'
+
+    def test_update_refs_option(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.tagged', ']'])
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['dendrify', '-q', '--update-refs=refs/heads/tag*',
+                                     'dendrified', 'develop', 'linear'])
+        tagged = empty_repo[empty_repo.lookup_branch('tagged').target]
+        assert tagged.message == 'Work item 2'
+        assert len(tagged.parents) == 1
+        assert tagged.parents[0].message == 'Start work 1'
+        assert (empty_repo[empty_repo.lookup_branch('dendrified').target].parents[1]
+                == tagged)
+
+    def test_verify_command(self, empty_repo, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        dendrify.Dendrifier(empty_repo.path).dendrify('dendrified', 'develop', 'linear')
+        argv = ['verify', 'develop', 'linear', 'dendrified']
+        with temporary_cwd_within_repo(empty_repo):
+            assert dendrify.cli.main(_argv=argv) == 0
+            assert capsys.readouterr().out == 'histories match\n'
+            extend_repo(empty_repo, ['.'], first_idx=4)
+            assert dendrify.cli.main(_argv=argv) == 1
+        out_lines = capsys.readouterr().out.splitlines()
+        assert out_lines[0] == 'histories differ at commit 4: dendrified history ends first'
+        assert out_lines[1].split() == [
+            'linear:', str(empty_repo.lookup_branch('linear').target)]
+        assert len(out_lines) == 2
+
+    def test_verify_command_malformed(self, empty_repo, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        dendrify.Dendrifier(empty_repo.path).dendrify('dendrified', 'develop', 'linear')
+        merge = empty_repo.revparse_single('dendrified')
+        impure_oid = empty_repo.create_commit(None, merge.author, merge.committer,
+                                              merge.message,
+                                              empty_repo.revparse_single('develop').tree_id,
+                                              merge.parent_ids)
+        empty_repo.lookup_branch('dendrified').set_target(impure_oid)
+        with temporary_cwd_within_repo(empty_repo):
+            assert dendrify.cli.main(_argv=['verify', 'develop', 'linear', 'dendrified']) == 1
+        out_lines = capsys.readouterr().out.splitlines()
+        assert out_lines[0] == ('histories differ at commit 3: expected {} to be pure merge'
+                                .format(impure_oid))
+
+    def test_show_command(self, empty_repo, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']', '.'])
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['show', '--max-depth=0', 'develop', 'linear'])
+        out_lines = capsys.readouterr().out.splitlines()
+        assert [line[12:] for line in out_lines] == [' * Work item 4',
+                                                     ' * </s>Finish work 3 [...]']
+
+    def test_sections_command(self, empty_repo, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', '[', '.inner', ']', ']', '.last'])
+        dendrify.Dendrifier(empty_repo.path).dendrify('dendrified', 'develop', 'linear')
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['sections', 'develop', 'dendrified', 'dendrified^^2^2'])
+            dendrify.cli.main(_argv=['sections', 'develop', 'dendrified', 'dendrified'])
+            with pytest.raises(ValueError, match='"inner" is not in the history'):
+                dendrify.cli.main(_argv=['sections', 'develop', 'dendrified', 'inner'])
+        out_lines = capsys.readouterr().out.splitlines()
+        assert [line[:-12] for line in out_lines[:2]] == [
+            'section at depth 1: commits 1 to 6, ended by ',
+            'section at depth 2: commits 3 to 5, ended by ']
+        assert out_lines[2:] == ['not within any section']
+
+    def test_dendrify_all_command(self, empty_repo):
+        TestTransformations._make_topic_branches(empty_repo)
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['dendrify-all', '-q', '--glob=linear/[ab]*',
+                                     '--dest-prefix=tree/', 'develop'])
+            with pytest.raises(ValueError, match='no branches match "topic/\\*"'):
+                dendrify.cli.main(_argv=['dendrify-all', '--glob=topic/*',
+                                         '--dest-prefix=tree/', 'develop'])
+        assert sorted(b for b in empty_repo.branches.local
+                      if b.startswith('tree/')) == ['tree/a', 'tree/b']
+
+    def test_dry_run_option(self, empty_repo, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['dendrify', '--dry-run', '--stats',
+                                     'dendrified', 'develop', 'linear'])
+        captured = capsys.readouterr()
+        out_lines = captured.out.splitlines()
+        assert len(out_lines) == 5
+        assert out_lines[3] == ('dendrify plan for "dendrified": 3 commits, 1 merges,'
+                                ' max depth 1, tip 2')
+        assert 'commits written: 0' in captured.err
+        assert empty_repo.lookup_branch('dendrified') is None
+
+    def test_stats_options(self, empty_repo, tmpdir, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        stats_path = tmpdir.join('stats.json').strpath
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['dendrify', '-q', '--stats',
+                                     '--stats-json={}'.format(stats_path),
+                                     'dendrified', 'develop', 'linear'])
+        assert 'commits written: 3' in capsys.readouterr().err
+        with open(stats_path, 'rt') as f_in:
+            stats = json.load(f_in)
+        assert stats['commits_written'] == 3
+        assert stats['max_section_depth'] == 1
+        assert set(stats['phase_seconds']) == set(dendrify.Stats.phase_names)
+
+    def test_progress_option(self, empty_repo, capsys):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        with temporary_cwd_within_repo(empty_repo):
+            dendrify.cli.main(_argv=['dendrify', '--progress',
+                                     'dendrified', 'develop', 'linear'])
+        captured = capsys.readouterr()
+        assert captured.out == ''
+        assert 'dendrify: 3/3 commits' in captured.err
+
+    @staticmethod
+    def _make_repo(path, descrs):
+        repo = git.init_repository(path)
+        repo.config['user.name'] = 'J.R. Hacker'
+        repo.config['user.email'] = 'j.r.hacker@example.com'
+        populate_repo(repo, descrs)
+        return repo
+
+    def test_batch(self, tmpdir, capsys):
+        repo_1 = self._make_repo(tmpdir.join('repo-1').strpath, ['.develop', '[', '.', ']'])
+        repo_2 = self._make_repo(tmpdir.join('repo 2').strpath, ['.develop', '[', '[', '.', ']', ']'])
+        dendrify.Dendrifier(repo_2.path).dendrify('dendrified', 'develop', 'linear')
+        job_file = tmpdir.join('jobs.txt')
+        job_file.write('# Comment line\n'
+                       'repo-1 dendrify dendrified develop linear\n'
+                       '\n'
+                       '"repo 2" linearize linear-1 develop dendrified\n'
+                       'repo-1 dendrify dendrified-2 develop no-such-branch\n')
+        exit_code = dendrify.cli.main(_argv=['batch', '--processes=2', job_file.strpath])
+        assert exit_code == 1
+        out_lines = capsys.readouterr().out.splitlines()
+        assert len(out_lines) == 3
+        assert sum(line.startswith('ok ') for line in out_lines) == 2
+        [failure] = [line for line in out_lines if line.startswith('FAILED ')]
+        assert 'source branch "no-such-branch" does not exist' in failure
+        assert dendrify.repo_has_branch(repo_1, 'dendrified')
+        assert dendrify.repo_has_branch(repo_2, 'linear-1')
+
+    def test_batch_all_succeed(self, tmpdir):
+        self._make_repo(tmpdir.join('repo-1').strpath, ['.develop', '[', '.', ']'])
+        job_file = tmpdir.join('jobs.txt')
+        job_file.write('repo-1 dendrify dendrified develop linear\n')
+        assert dendrify.cli.main(_argv=['batch', '-q', job_file.strpath]) == 0
+
+    @pytest.mark.parametrize(
+        'line, exp_msg',
+        [('repo-1 dendrify dendrified develop', 'expected 5 fields but got 4'),
+         ('repo-1 transmogrify dendrified develop linear', 'unknown operation "transmogrify"')])
+    #
+    def test_batch_bad_job_file(self, tmpdir, line, exp_msg):
+        job_file = tmpdir.join('jobs.txt')
+        job_file.write('\n' + line + '\n')
+        with pytest.raises(ValueError, match='jobs.txt:2: ' + exp_msg):
+            dendrify.cli.main(_argv=['batch', job_file.strpath])
+
+    def test_bad_verification_option(self, empty_repo):
+        with temporary_cwd_within_repo(empty_repo):
+            with pytest.raises(docopt.DocoptExit, match='unknown verification level'):
+                dendrify.cli.main(_argv=['linearize', '--verify=bogus',
+                                         'linear-1', 'develop', 'dendrified'])
+
     def test_bad_command(self):
         with pytest.raises(docopt.DocoptExit, match='Usage:'):
             dendrify.cli.main(_argv=['hello', 'world'])
+
+
+class TestWatchDaemon:
+    @staticmethod
+    def _wait_for(predicate, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            assert time.monotonic() < deadline, 'timed out'
+            time.sleep(0.02)
+
+    @contextmanager
+    def _running_daemon(self, tmpdir, poll_interval=None,
+                        job_lines=('repo dendrify dendrified develop linear',
+                                   'repo linearize linear-1 develop dendrified')):
+        repo = TestCommandLine._make_repo(tmpdir.join('repo').strpath,
+                                          ['.develop', '[', '.', ']'])
+        job_file = tmpdir.join('jobs.txt')
+        job_file.write(''.join(line + '\n' for line in job_lines))
+        socket_path = dendrify.watch.default_socket_path(job_file.strpath)
+        jobs = dendrify.batch.jobs_from_file(job_file.strpath)
+        daemon = dendrify.watch.WatchDaemon(jobs, socket_path, poll_interval=poll_interval)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            self._wait_for(lambda: os.path.exists(socket_path))
+            yield repo, job_file, socket_path, daemon
+        finally:
+            dendrify.watch.send_request(socket_path, 'stop')
+            thread.join()
+        assert not os.path.exists(socket_path)
+
+    @pytest.mark.parametrize('poll_interval', [None, 0.05], ids=['inotify', 'polling'])
+    #
+    def test_watch(self, tmpdir, poll_interval):
+        with self._running_daemon(tmpdir, poll_interval) as (repo, _, socket_path, daemon):
+            def status():
+                return dendrify.watch.send_request(socket_path, 'status')
+
+            states = status()
+            assert [s['n_runs'] for s in states] == [1, 1]
+            assert [s['error'] for s in states] == [None, None]
+            # Linearizing re-creates the existing linear commits:
+            assert [s['n_commits_written'] for s in states] == [3, 0]
+
+            extend_repo(repo, ['.'], first_idx=4)
+            self._wait_for(lambda: [s['n_runs'] for s in status()] == [2, 2])
+            states = status()
+            assert states[0]['source_oid'] == str(repo.lookup_branch('linear').target)
+            assert [s['n_commits_written'] for s in states] == [1, 0]
+            linear_1_tip = repo[repo.lookup_branch('linear-1').target]
+            assert linear_1_tip.message == 'Work item 4'
+
+            # The dendrify job's commit map has been kept since the first run:
+            dendrifier, = daemon.dendrifiers.values()
+            map_path = dendrify.CommitMap.path_for(repo, 'dendrified')
+            assert len(dendrifier.commit_maps[map_path]) == 4
+
+            states = dendrify.watch.send_request(socket_path, 'trigger')
+            assert [s['n_runs'] for s in states] == [3, 3]
+            assert [s['n_commits_written'] for s in states] == [0, 0]
+
+            reply = dendrify.watch.send_request(socket_path, 'bogus')
+            assert reply == {'error': 'unknown request "bogus"'}
+
+            with pytest.raises(ValueError, match='already listening'):
+                dendrify.watch.WatchDaemon([], socket_path).serve_forever()
+
+    def test_client_commands_no_daemon(self, tmpdir, capsys):
+        job_file = tmpdir.join('jobs.txt')
+        job_file.write('repo dendrify dendrified develop linear\n')
+        socket_path = dendrify.watch.default_socket_path(job_file.strpath)
+        for command in ['status', 'trigger']:
+            assert dendrify.cli.main(_argv=[command, job_file.strpath]) == 2
+        # A socket left behind by a daemon which has gone:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(socket_path)
+        assert dendrify.cli.main(_argv=['status', job_file.strpath]) == 2
+        out_lines = capsys.readouterr().out.splitlines()
+        assert out_lines == ['no watch daemon listening on {}'.format(socket_path)] * 3
+
+    def test_watch_new_ref_directory(self, tmpdir):
+        job_lines = ['repo dendrify dendrified-x develop feature/x']
+        with self._running_daemon(tmpdir, job_lines=job_lines) as (repo, _, socket_path,
+                                                                    daemon):
+            if daemon.watcher is None:
+                pytest.skip('inotify not available')
+            def status():
+                return dendrify.watch.send_request(socket_path, 'status')
+
+            self._wait_for(lambda: status()[0]['n_runs'] == 1)
+            assert status()[0]['source_oid'] is None
+            feature_dir = os.path.join(repo.path, 'refs', 'heads', 'feature')
+            os.makedirs(feature_dir)
+            self._wait_for(lambda: feature_dir in daemon.watcher._directories.values())
+            repo.create_branch('feature/x', repo[repo.lookup_branch('linear').target])
+            self._wait_for(lambda: status()[0]['source_oid'] is not None)
+            assert status()[0]['error'] is None
+            assert repo.lookup_branch('dendrified-x') is not None
+
+    def test_client_commands(self, tmpdir, capsys):
+        with self._running_daemon(tmpdir, 0.05) as (repo, job_file, _, _):
+            assert dendrify.cli.main(_argv=['status', job_file.strpath]) == 0
+            out_lines = capsys.readouterr().out.splitlines()
+            assert len(out_lines) == 2
+            assert out_lines[0].startswith('ok      ')
+            assert out_lines[0].endswith(', 1 runs]')
+
+            repo.lookup_branch('dendrified').delete()
+            repo.create_branch('dendrified', repo[repo.lookup_branch('develop').target])
+            assert dendrify.cli.main(_argv=['trigger', job_file.strpath]) == 1
+            out_lines = capsys.readouterr().out.splitlines()
+            assert out_lines[0].startswith('FAILED  ')
+            assert 'has moved since it was made' in out_lines[0]
+
+
+class TestCommitGraph:
+    @staticmethod
+    def _write_commit_graph(repo, split=False):
+        args = ['git', 'commit-graph', 'write', '--reachable']
+        if split:
+            args.append('--split=no-merge')
+        subprocess.run(args, cwd=repo.path, check=True)
+
+    @pytest.mark.parametrize('split', [False, True], ids=['single', 'split'])
+    def test_reader(self, empty_repo, split):
+        repo = empty_repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        self._write_commit_graph(repo, split)
+        extend_repo(repo, ['.', '.'], first_idx=4)
+        # An octopus merge:
+        sig = dendrify.create_signature(repo)
+        tip = repo.revparse_single('linear')
+        octopus_oid = repo.create_commit(None, sig, sig, 'octopus', tip.tree_id,
+                                         [tip.id, tip.parent_ids[0],
+                                          repo.revparse_single('develop').id])
+        repo.create_branch('octopus', repo[octopus_oid])
+        self._write_commit_graph(repo, split)
+        extend_repo(repo, ['.'], first_idx=6)
+
+        with dendrify.CommitGraph.open(repo.path) as graph:
+            assert len(graph.layers) == (2 if split else 1)
+            n_covered = 0
+            for commit in repo.walk(repo.lookup_branch('linear').target):
+                entry = graph.commit_entry(commit.id.raw)
+                if commit.message == 'Work item 6':
+                    assert entry is None
+                    continue
+                parents, tree_raw, generation = entry
+                assert parents == [oid.raw for oid in commit.parent_ids]
+                assert tree_raw == commit.tree_id.raw
+                assert generation == len(list(repo.walk(commit.id)))
+                n_covered += 1
+            assert n_covered == 7
+            parents, _, generation = graph.commit_entry(octopus_oid.raw)
+            assert len(parents) == 3
+            assert generation == 8
+
+    def test_no_commit_graph(self, empty_repo):
+        assert dendrify.CommitGraph.open(empty_repo.path) is None
+
+    @staticmethod
+    def _dendrifiers(repo):
+        with_graph = dendrify.Dendrifier(repo.path)
+        without_graph = dendrify.Dendrifier(repo.path, use_commit_graph=False)
+        return with_graph, without_graph
+
+    @pytest.mark.parametrize(
+        'verification',
+        [dendrify.Verification.Off, dendrify.Verification.TreeId,
+         dendrify.Verification.FullDiff])
+    def test_walks_match(self, empty_repo, verification):
+        repo = empty_repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '.', ']', '[', '.'])
+        dendrify.Dendrifier(repo.path).dendrify('dendrified-0', 'develop', 'linear')
+        self._write_commit_graph(repo, split=True)
+        # Commits not covered by the graph:
+        extend_repo(repo, ['.', ']', '.'], first_idx=9)
+        dendrify.Dendrifier(repo.path).dendrify('dendrified', 'develop', 'linear')
+
+        with_graph, without_graph = self._dendrifiers(repo)
+        with_graph.verification = without_graph.verification = verification
+        # Make sure the graph is used:
+        def no_walk(*args):
+            raise AssertionError('revwalk used')
+        with_graph._ancestry_walker = no_walk
+
+        assert (with_graph.linear_ancestry('develop', 'linear')
+                == without_graph.linear_ancestry('develop', 'linear'))
+        assert (with_graph.flattened_ancestry('develop', 'dendrified')
+                == without_graph.flattened_ancestry('develop', 'dendrified'))
+        assert with_graph.n_merges_verified == without_graph.n_merges_verified
+        with_graph.linearize('linear-1', 'develop', 'dendrified')
+        assert (repo.lookup_branch('linear-1').target
+                == repo.lookup_branch('linear').target)
+
+        with_graph.dendrify('dendrified-inc', 'develop', 'linear', incremental=True)
+        extend_repo(repo, ['.'], first_idx=12)
+        with_graph.dendrify('dendrified-inc', 'develop', 'linear', incremental=True)
+        without_graph.dendrify('dendrified-2', 'develop', 'linear')
+        assert (repo.lookup_branch('dendrified-inc').target
+                == repo.lookup_branch('dendrified-2').target)
+
+    @staticmethod
+    def _make_fork(repo):
+        populate_repo(repo, ['.develop', '.', '.'])
+        extend_repo(repo, ['.'], branch_name='develop', first_idx=3)
+        sig = dendrify.create_signature(repo)
+        develop_tip = repo.revparse_single('develop')
+        linear_tip = repo.revparse_single('linear')
+        merge_oid = repo.create_commit(None, sig, sig, 'merge', linear_tip.tree_id,
+                                       [develop_tip.id, linear_tip.id])
+        repo.create_branch('dendrified', repo[merge_oid])
+        return 'test-base'
+
+    @staticmethod
+    def _make_swapped_merge(repo):
+        populate_repo(repo, ['.dev', '.', '.', '.'], branch_name='dendrified-0')
+        dev = repo.revparse_single('dev')
+        tip = repo.revparse_single('dendrified-0')
+        sig = dendrify.create_signature(repo)
+        merge_oid = repo.create_commit(None, sig, sig, 'swapped merge test',
+                                       tip.tree_id, [tip.id, dev.id])
+        repo.create_branch('dendrified', repo[merge_oid])
+        return 'dev'
+
+    @staticmethod
+    def _make_impure_merge(repo):
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        dendrify.Dendrifier(repo.path).dendrify('dendrified-0', 'develop', 'linear')
+        tip = repo.revparse_single('dendrified-0')
+        sig = dendrify.create_signature(repo)
+        merge_oid = repo.create_commit(None, sig, sig, 'impure merge',
+                                       repo.revparse_single('develop').tree_id,
+                                       tip.parent_ids)
+        repo.create_branch('dendrified', repo[merge_oid])
+        return 'develop'
+
+    @staticmethod
+    def _make_sibling_base(repo):
+        populate_repo(repo, ['.', '.develop', '.'], branch_name='dendrified')
+        extend_repo(repo, ['.', '.'], branch_name='develop', first_idx=3)
+        return 'develop'
+
+    @pytest.mark.parametrize('make_history', ['_make_fork', '_make_swapped_merge',
+                                              '_make_impure_merge', '_make_sibling_base'])
+    @pytest.mark.parametrize(
+        'verification',
+        [dendrify.Verification.Off, dendrify.Verification.TreeId,
+         dendrify.Verification.FullDiff])
+    def test_errors_match(self, empty_repo, make_history, verification):
+        repo = empty_repo
+        base = getattr(self, make_history)(repo)
+        self._write_commit_graph(repo)
+        messages = []
+        for dendrifier in self._dendrifiers(repo):
+            dendrifier.verification = verification
+            try:
+                dendrifier.flattened_ancestry(base, 'dendrified')
+                messages.append(None)
+            except ValueError as e:
+                messages.append(str(e))
+        assert messages[0] == messages[1]
+        if verification != dendrify.Verification.Off or make_history != '_make_impure_merge':
+            assert messages[0] is not None
+
+
+class TestPartialClone:
+    @staticmethod
+    def _partial_clone(repo, tmpdir, filter_spec):
+        """
+        A bare partial clone of ``repo``, with its promisor remote then made
+        unreachable, so that any attempt to fetch a missing object fails.
+        """
+        repo.config['uploadpack.allowFilter'] = True
+        clone_path = tmpdir.join('clone.git').strpath
+        subprocess.run(['git', 'clone', '--quiet', '--bare', '--no-local',
+                        '--filter={}'.format(filter_spec),
+                        'file://{}'.format(os.path.dirname(repo.path.rstrip('/'))),
+                        clone_path],
+                       check=True)
+        clone = git.Repository(clone_path)
+        clone.config['remote.origin.url'] = 'file:///nonexistent/dendrify-test'
+        return clone
+
+    @pytest.mark.parametrize('filter_spec', ['blob:none', 'tree:0'])
+    def test_rewrite(self, empty_repo, tmpdir, filter_spec):
+        populate_repo(empty_repo, ['.develop', '[', '.', '[', '.', ']', ']', '.'])
+        empty_repo.create_reference('refs/tags/v1',
+                                    empty_repo.revparse_single('linear~1').id)
+        dendrify.Dendrifier(empty_repo.path).dendrify('dendrified', 'develop', 'linear')
+
+        clone = self._partial_clone(empty_repo, tmpdir.mkdir('clones'), filter_spec)
+        tip = clone[clone.lookup_branch('linear').target]
+        if filter_spec == 'tree:0':
+            with pytest.raises(KeyError):
+                clone[tip.tree_id]
+        else:
+            with pytest.raises(KeyError):
+                clone[tip.tree['data'].id]
+
+        dendrifier = dendrify.Dendrifier(clone.path)
+        assert dendrifier.commits_only
+        oid_map = dendrifier.dendrify('dendrified-2', 'develop', 'linear',
+                                      update_refs=['refs/tags/*'])
+        assert (clone.lookup_branch('dendrified-2').target
+                == empty_repo.lookup_branch('dendrified').target)
+        assert (clone.lookup_reference('refs/tags/v1').target
+                == oid_map[empty_repo.revparse_single('linear~1').id])
+        dendrifier.linearize('linear-2', 'develop', 'dendrified')
+        assert (clone.lookup_branch('linear-2').target
+                == empty_repo.lookup_branch('linear').target)
+
+        dendrifier.verification = dendrify.Verification.FullDiff
+        with pytest.raises(ValueError, match='full verification of merges reads trees'):
+            dendrifier.linearize('linear-3', 'develop', 'dendrified')
+        assert clone.lookup_branch('linear-3') is None
+        assert dendrify.Dendrifier(clone.path).verify('develop', 'linear', 'dendrified') is None
+
+    def test_verify_command(self, empty_repo, tmpdir):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        dendrify.Dendrifier(empty_repo.path).dendrify('dendrified', 'develop', 'linear')
+        clone = self._partial_clone(empty_repo, tmpdir.mkdir('clones'), 'tree:0')
+        # The clone is bare, so work within its git directory:
+        with tmpdir.join('clones', 'clone.git').as_cwd():
+            assert dendrify.cli.main(_argv=['verify', '-q', 'develop', 'linear',
+                                            'dendrified']) == 0
+            with pytest.raises(ValueError, match='only commits may be read'):
+                dendrify.cli.main(_argv=['verify', '--verify=full', 'develop', 'linear',
+                                         'dendrified'])
+
+    def test_detection(self, empty_repo):
+        assert not dendrify.is_partial_clone(empty_repo)
+        assert not dendrify.Dendrifier(empty_repo.path).commits_only
+        assert dendrify.Dendrifier(empty_repo.path, commits_only=True).commits_only
+        empty_repo.config['remote.origin.promisor'] = True
+        assert dendrify.is_partial_clone(empty_repo)
+
+    def test_commits_only_option(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        dendrify.Dendrifier(empty_repo.path).dendrify('dendrified', 'develop', 'linear')
+        with temporary_cwd_within_repo(empty_repo):
+            with pytest.raises(ValueError, match='only commits may be read'):
+                dendrify.cli.main(_argv=['linearize', '-q', '--commits-only',
+                                         '--verify=full',
+                                         'linear-2', 'develop', 'dendrified'])
+            dendrify.cli.main(_argv=['linearize', '-q', '--commits-only',
+                                     'linear-2', 'develop', 'dendrified'])
+        assert (empty_repo.lookup_branch('linear-2').target
+                == empty_repo.lookup_branch('linear').target)
+
+
+class TestAsync:
+    class ThreadRecordingReporter(CollectingReporter):
+        def __init__(self):
+            super().__init__()
+            self.thread_ids = set()
+
+        def commit_written(self, oid, raw_message, depth, encoding):
+            self.thread_ids.add(threading.get_ident())
+            super().commit_written(oid, raw_message, depth, encoding)
+
+    @staticmethod
+    def _run_in_new_loop(coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    @staticmethod
+    def _gated_output(first_write, gate):
+        """
+        An output which, on its first write, signals ``first_write`` and then
+        waits for ``gate``.
+        """
+        class GatedOutput(dendrify.ObjectDatabaseOutput):
+            def write_commit(self, *args):
+                first_write.set()
+                gate.wait()
+                return super().write_commit(*args)
+        return GatedOutput
+
+    def test_dendrify_async(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.', '[', '.', ']', ']'])
+        sync_reporter = CollectingReporter()
+        dendrify.Dendrifier(empty_repo.path, report=sync_reporter).dendrify(
+            'dendrified-sync', 'develop', 'linear')
+        reporter = self.ThreadRecordingReporter()
+        dendrifier = dendrify.Dendrifier(empty_repo.path, report=reporter)
+
+        async def run():
+            oid_map = await dendrifier.dendrify_async('dendrified', 'develop', 'linear')
+            # All events have arrived, in the loop's thread:
+            assert reporter.events[-1] == ('finished',)
+            assert reporter.thread_ids == {threading.get_ident()}
+            return oid_map
+
+        oid_map = self._run_in_new_loop(run())
+        assert reporter.events == sync_reporter.events
+        assert dendrifier.report is reporter
+        assert (oid_map[empty_repo.lookup_branch('linear').target]
+                == empty_repo.lookup_branch('dendrified').target
+                == empty_repo.lookup_branch('dendrified-sync').target)
+
+    def test_concurrent_operations(self, tmpdir):
+        repos = []
+        for idx in range(3):
+            repo = git.init_repository(tmpdir.join('repo-{}'.format(idx)).strpath)
+            repo.config['user.name'] = 'J.R. Hacker'
+            repo.config['user.email'] = 'j.r.hacker@example.com'
+            populate_repo(repo, ['.develop', '[', '.', ']', '.'])
+            repos.append(repo)
+        dendrifiers = [dendrify.Dendrifier(repo.path) for repo in repos]
+
+        async def run(executor):
+            await asyncio.gather(*[d.dendrify_async('dendrified', 'develop', 'linear',
+                                                    executor=executor)
+                                   for d in dendrifiers])
+            await asyncio.gather(*[d.linearize_async('linear-2', 'develop', 'dendrified',
+                                                     executor=executor)
+                                   for d in dendrifiers])
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self._run_in_new_loop(run(executor))
+        for repo in repos:
+            assert (repo.lookup_branch('linear-2').target
+                    == repo.lookup_branch('linear').target)
+
+    def test_cancel_during_rewrite(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']', '.'])
+        first_write, gate = threading.Event(), threading.Event()
+        dendrifier = dendrify.Dendrifier(empty_repo.path,
+                                         output=self._gated_output(first_write, gate))
+
+        async def run():
+            loop = asyncio.get_event_loop()
+            task = loop.create_task(dendrifier.dendrify_async('dendrified', 'develop',
+                                                              'linear'))
+            await loop.run_in_executor(None, first_write.wait)
+            task.cancel()
+            while not dendrifier._cancel_event.is_set():
+                await asyncio.sleep(0)
+            gate.set()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # The operation has stopped by the time the task is cancelled:
+            assert dendrifier._cancel_event is None
+
+        self._run_in_new_loop(run())
+        assert empty_repo.lookup_branch('dendrified') is None
+        dendrifier.output = dendrify.ObjectDatabaseOutput
+        dendrifier.dendrify('dendrified', 'develop', 'linear')
+
+    def test_cancel_before_start(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+        first_write, gate = threading.Event(), threading.Event()
+        blocking_dendrifier = dendrify.Dendrifier(
+            empty_repo.path, output=self._gated_output(first_write, gate))
+        dendrifier = dendrify.Dendrifier(empty_repo.path)
+
+        async def run(executor):
+            loop = asyncio.get_event_loop()
+            blocking_task = loop.create_task(blocking_dendrifier.dendrify_async(
+                'dendrified-1', 'develop', 'linear', executor=executor))
+            await loop.run_in_executor(None, first_write.wait)
+            task = loop.create_task(dendrifier.dendrify_async(
+                'dendrified-2', 'develop', 'linear', executor=executor))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.sleep(0)
+            gate.set()
+            await blocking_task
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self._run_in_new_loop(run(executor))
+        assert empty_repo.lookup_branch('dendrified-1') is not None
+        assert empty_repo.lookup_branch('dendrified-2') is None
+
+    def test_report_to_queue(self, empty_repo):
+        populate_repo(empty_repo, ['.develop', '[', '.', ']'])
+
+        async def run():
+            queue = asyncio.Queue()
+            dendrifier = dendrify.Dendrifier(empty_repo.path,
+                                             report=dendrify.ReportToQueue(queue))
+            await dendrifier.dendrify_async('dendrified', 'develop', 'linear')
+            events = []
+            while not queue.empty():
+                events.append(queue.get_nowait())
+            return events
+
+        events = self._run_in_new_loop(run())
+        names = [name for name, args in events]
+        assert names == ['phase_finished', 'phase_finished', 'started',
+                         'section_opened', 'commit_written', 'commit_written',
+                         'section_closed', 'commit_written',
+                         'phase_finished', 'phase_finished', 'finished']
+        assert events[2] == ('started', ('dendrify', 3))
+
+
+class TestSectionIndex:
+    @staticmethod
+    def _expected_sections(dendrifier, branch_name):
+        """
+        Map from each commit of the dendrified history ``branch_name`` to the
+        list of (start, end, depth) of the sections containing it, outermost
+        first, as found from its flattened ancestry.
+        """
+        elts = dendrifier.flat_ancestry('develop', branch_name, keep_commits=False)
+        open_starts = []
+        sections = []
+        for position, (commit_type, oid) in enumerate(elts):
+            if commit_type == dendrify.CommitType.SectionStart:
+                open_starts.append(position)
+            elif commit_type == dendrify.CommitType.SectionEnd:
+                start = open_starts.pop(-1)
+                sections.append((start, position, len(open_starts) + 1))
+        return {oid: sorted((s for s in sections if s[0] <= position <= s[1]),
+                            key=lambda s: s[2])
+                for position, (_, oid) in enumerate(elts)}
+
+    @staticmethod
+    def _summary(index, oid):
+        return [(s.start, s.end, s.depth) for s in index.sections_containing(oid)]
+
+    def _assert_index_correct(self, dendrifier, branch_name):
+        expected = self._expected_sections(dendrifier, branch_name)
+        with dendrifier.section_index('develop', branch_name) as index:
+            assert len(index.commits) == len(expected)
+            for oid, expected_sections in expected.items():
+                assert self._summary(index, oid) == expected_sections
+            for idx in range(len(index)):
+                section = index.section(idx)
+                assert len(dendrifier.repo[section.merge_oid].parent_ids) == 2
+                assert index.position(section.merge_oid) == section.end
+                if section.parent is not None:
+                    assert index.section(section.parent).depth == section.depth - 1
+
+    @pytest.mark.parametrize(
+        'descrs',
+        [['.', '.'],
+         ['[', '.', ']', '[', ']'],
+         ['[', '[', '[', '.', ']', '.', ']', '[', ']', ']', '.', '[', '.', ']']],
+        ids=['no-sections', 'flat', 'nested'])
+    def test_section_index(self, empty_dendrifier, descrs):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop'] + descrs)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        self._assert_index_correct(empty_dendrifier, 'dendrified')
+        with empty_dendrifier.section_index('develop', 'dendrified') as index:
+            assert index.position(repo.revparse_single('develop').id) is None
+            assert index.sections_containing(repo.revparse_single('develop').id) is None
+
+    def test_incremental_update(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '[', '.', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        self._assert_index_correct(empty_dendrifier, 'dendrified')
+        path = dendrify.SectionIndex.path_for(repo, 'dendrified')
+
+        # Closing the outer section nests the inner one, already indexed,
+        # within it:
+        extend_repo(repo, ['.', ']', '.', '[', '.', ']'], first_idx=10)
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear', incremental=True)
+        empty_dendrifier.stats.n_commits_read = 0
+        self._assert_index_correct(empty_dendrifier, 'dendrified')
+        assert empty_dendrifier.stats.n_commits_read == 6
+        with open(path, 'rb') as f_in:
+            updated_bytes = f_in.read()
+
+        os.remove(path)
+        empty_dendrifier.section_index('develop', 'dendrified').close()
+        with open(path, 'rb') as f_in:
+            assert f_in.read() == updated_bytes
+
+    def test_rebuilt_when_rewritten(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']', '.'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        empty_dendrifier.section_index('develop', 'dendrified').close()
+
+        repo.create_branch('linear-2', repo.revparse_single('develop'))
+        extend_repo(repo, ['.', '[', '.', '.', ']'], branch_name='linear-2', first_idx=10)
+        empty_dendrifier.dendrify('dendrified-2', 'develop', 'linear-2')
+        repo.create_branch('dendrified', repo.lookup_branch('dendrified-2').peel(), True)
+        self._assert_index_correct(empty_dendrifier, 'dendrified')
+
+        # A different base:
+        extend_repo(repo, ['.'], branch_name='develop', first_idx=20)
+        repo.create_branch('linear-3', repo.revparse_single('develop'))
+        extend_repo(repo, ['[', '.', ']'], branch_name='linear-3', first_idx=30)
+        empty_dendrifier.dendrify('dendrified-3', 'develop', 'linear-3')
+        repo.create_branch('dendrified', repo.lookup_branch('dendrified-3').peel(), True)
+        self._assert_index_correct(empty_dendrifier, 'dendrified')
+
+    def test_unreadable_index_rebuilt(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop', '[', '.', ']'])
+        empty_dendrifier.dendrify('dendrified', 'develop', 'linear')
+        path = dendrify.SectionIndex.path_for(repo, 'dendrified')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f_out:
+            f_out.write(b'DSIX\x01')
+        assert dendrify.SectionIndex.open(path) is None
+        self._assert_index_correct(empty_dendrifier, 'dendrified')
+
+    @staticmethod
+    def _commit(repo, parents, message):
+        sig = dendrify.create_signature(repo)
+        return repo.create_commit(None, sig, sig, message,
+                                  repo[parents[-1]].tree_id, parents)
+
+    def _assert_rejected_after(self, dendrifier, good_tip, bad_merge):
+        # The index is correct up to good_tip, but extending it to bad_merge,
+        # or making it from scratch, fails.
+        repo = dendrifier.repo
+        path = dendrify.SectionIndex.path_for(repo, 'dendrified')
+        if os.path.exists(path):
+            os.remove(path)
+        repo.create_branch('dendrified', repo[good_tip], True)
+        self._assert_index_correct(dendrifier, 'dendrified')
+        repo.create_branch('dendrified', repo[bad_merge], True)
+        with pytest.raises(ValueError, match='unexpected parents of {}'.format(bad_merge)):
+            dendrifier.section_index('develop', 'dendrified')
+        os.remove(path)
+        with pytest.raises(ValueError, match='unexpected parents of {}'.format(bad_merge)):
+            dendrifier.section_index('develop', 'dendrified')
+
+    def test_sections_must_nest(self, empty_dendrifier):
+        repo = empty_dendrifier.repo
+        populate_repo(repo, ['.develop'])
+        base_oid = repo.lookup_branch('linear').target
+        c1 = self._commit(repo, [base_oid], 'c1')
+        c2 = self._commit(repo, [c1], 'c2')
+        c3 = self._commit(repo, [c2], 'c3')
+        merge_1 = self._commit(repo, [c1, c3], 'merge 1')
+        c4 = self._commit(repo, [merge_1], 'c4')
+        # A section starting at c3, i.e., within the section ending at
+        # merge_1, but ending after it:
+        bad_merge = self._commit(repo, [c2, c4], 'bad merge 1')
+        self._assert_rejected_after(empty_dendrifier, c4, bad_merge)
+
+        merge_2 = self._commit(repo, [base_oid, c4], 'merge 2')
+        c5 = self._commit(repo, [merge_2], 'c5')
+        # A section starting at c4, i.e., just after the section ending at
+        # merge_1, but within the section ending at merge_2, and ending after
+        # that:
+        bad_merge = self._commit(repo, [merge_1, c5], 'bad merge 2')
+        self._assert_rejected_after(empty_dendrifier, c5, bad_merge)